@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+autotune_asp.py
+----------------------
+Test a grid of ASP parameter sets on representative windows of the GEOTIFF stack and report the Pareto-optimal parameter sets.
+The windows are selected on AMPLI_MEAN.tif (or the first image): windows with mostly valid pixels, spread from low to high amplitude texture.
+Each parameter set is processed with run_stereo.sh for a triplet of pairs (a-b, b-c, a-c) in every window. Measured are the wall time and peak memory of the run
+(RSS: summed RSS of all processes of run_stereo.sh sampled during the run, RSS_PROCESS: largest single process)
+and the quality of the correl-F.tif results: valid pixel fraction, CC coverage (fraction of pixels with CC == 1, as kept by mask_correl_results_cc.py)
+and the closure residual of the triplet (median of |D_ab + D_bc - D_ac| in pixel, after subtracting the median of each map).
+The runs are saved in DEST/autotune_runs.jsonl, a re-run only processes missing runs.
+
+Usage: autotune_asp.py --data=<path> --grid=<path> [--pairs=<path>] [--dest=<path>] [--windows=<value>] [--size=<value>] [--threads=<value>]
+autotune_asp.py -h | --help
+
+Options:
+--data=<path>       Path to working directory (with GEOTIFF and asp_parameters.txt)
+--grid=<path>       Path to parameter grid (see example/autotune_grid.txt)
+--pairs=<path>      Path to pair table (MasTer format), the triplet is selected from its pairs [default: shortest triplet of the GEOTIFF dates]
+--dest=<path>       Path to autotune directory [default: DATA/AUTOTUNE]
+--windows=<value>   Number of windows [default: 3]
+--size=<value>      Size of the windows in pixel [default: 1024]
+--threads=<value>   Number of threads of each run, overwrites THREADS of asp_parameters.txt
+-h --help           Show this screen
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os, sys
+import numpy as np
+from osgeo import gdal
+import pandas as pd
+from pathlib import Path
+import itertools
+import docopt
+import json
+import shutil
+from aspsar.process import run_monitored
+
+#############
+# FUNCTIONS #
+#############
+
+def get_run_stereo_script():
+    # run_stereo.sh is in the root of the ASP-SAR installation
+    aspsar_dir = os.environ.get('ASPSAR', os.path.dirname(os.path.realpath(__file__)))
+    return os.path.join(aspsar_dir, 'run_stereo.sh')
+
+def get_geotiff_dates(geotiff_dir):
+    return sorted([f.split('.')[0] for f in os.listdir(geotiff_dir) if f.endswith('.VV.mod_log.tif')])
+
+## WINDOWS ##
+
+def select_windows(reference_file, size, n_windows, min_valid=0.9):
+    # windows (xoff, yoff, size, size) on a grid of the reference image, read size lines at once
+    # windows with at least min_valid valid pixels (finite, != 0) sorted by their amplitude std, selected at evenly spaced ranks
+    ds = gdal.Open(reference_file)
+    ncol, nrow = ds.RasterXSize, ds.RasterYSize
+    size = min(size, ncol, nrow)
+    band = ds.GetRasterBand(1)
+
+    candidates = []
+    for y in range(0, nrow - size + 1, size):
+        rows = band.ReadAsArray(0, y, ncol, size)
+        for x in range(0, ncol - size + 1, size):
+            w = rows[:, x:x + size]
+            valid = np.isfinite(w) & (w != 0)
+            fraction = np.count_nonzero(valid) / valid.size
+            std = float(np.std(w[valid])) if fraction > 0 else 0.
+            candidates.append((x, y, fraction, std))
+
+    good = [c for c in candidates if c[2] >= min_valid]
+    if(not good):
+        print('No window with {:.0f}% valid pixels, use the windows with the most valid pixels'.format(min_valid * 100))
+        good = sorted(candidates, key=lambda c: c[2], reverse=True)[:n_windows]
+
+    good = sorted(good, key=lambda c: c[3])
+    ranks = np.unique(np.linspace(0, len(good) - 1, min(n_windows, len(good))).astype(int))
+    return [(good[r][0], good[r][1], size, size) for r in ranks]
+
+def cut_windows(geotiff_dir, dates, windows, dest_dir):
+    # GeoTIFF stack of each window in DEST/WIN_i/GEOTIFF (only the dates of the triplet)
+    window_dirs = []
+    for i, window in enumerate(windows):
+        window_dir = os.path.join(dest_dir, 'WIN_{}'.format(i))
+        out_dir = os.path.join(window_dir, 'GEOTIFF')
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        for d in dates:
+            out_file = os.path.join(out_dir, '{}.VV.mod_log.tif'.format(d))
+            if(not os.path.isfile(out_file)):
+                gdal.Translate(out_file, os.path.join(geotiff_dir, '{}.VV.mod_log.tif'.format(d)), srcWin=list(window))
+        window_dirs.append(window_dir)
+    return window_dirs
+
+## PAIRS ##
+
+def select_triplet(pairs, dates):
+    # shortest triplet a < b < c (temporal span) with all three pairs available, pairs: set of (date1, date2)
+    dates = sorted(dates)
+    best = None
+    for a, b, c in itertools.combinations(dates, 3):
+        if((a, b) in pairs and (b, c) in pairs and (a, c) in pairs):
+            span = int(c) - int(a)
+            if(best is None or span < best[0]):
+                best = (span, (a, b, c))
+    if(best is None):
+        return None
+    return best[1]
+
+## PARAMETER GRID ##
+
+def read_grid(grid_file):
+    # {variable: [values]} of the grid file
+    grid = {}
+    with open(grid_file, 'r') as f:
+        for l in f.readlines():
+            l = l.split('#')[0].strip()
+            if(l):
+                name, values = l.split('=', 1)
+                grid[name.strip()] = [v.strip().strip('"') for v in values.split(',')]
+    return grid
+
+def get_parameter_sets(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+
+def get_config_name(params):
+    return '_'.join(['{}-{}'.format(k, v.replace(' ', 'x')) for k, v in params.items()])
+
+def write_asp_parameters(base_file, out_file, params):
+    # copy of asp_parameters.txt, the variables of the grid are set again at the end (the file is sourced by run_stereo.sh)
+    with open(base_file, 'r') as f:
+        content = f.read()
+    with open(out_file, 'w') as f:
+        f.write(content)
+        f.write('\n# AUTOTUNE #\n')
+        for k, v in params.items():
+            f.write('{}="{}"\n'.format(k, v))
+
+def prepare_config_dir(window_dir, config, params, base_file):
+    # DEST/WIN_i/CONFIG with asp_parameters.txt and a link to the GEOTIFF of the window
+    config_dir = os.path.join(window_dir, config)
+    Path(os.path.join(config_dir, 'CORREL')).mkdir(parents=True, exist_ok=True)
+    write_asp_parameters(base_file, os.path.join(config_dir, 'asp_parameters.txt'), params)
+    if(not os.path.lexists(os.path.join(config_dir, 'GEOTIFF'))):
+        os.symlink(os.path.abspath(os.path.join(window_dir, 'GEOTIFF')), os.path.join(config_dir, 'GEOTIFF'))
+    return config_dir
+
+## RUNS ##
+
+def run_pair(config_dir, date1, date2, threads=None):
+    # runs run_stereo.sh and returns (exit code, wall time in s, peak of the summed RSS in MB, peak RSS of the largest process in MB)
+    # the summed RSS includes all processes started by run_stereo.sh (parallel_stereo runs several correlator processes at once)
+    # absolute paths, run_stereo.sh changes into the CORREL directory
+    config_dir = os.path.abspath(config_dir)
+    cmd = [get_run_stereo_script(), config_dir, os.path.join(config_dir, 'CORREL'), date1, date2]
+    if(threads):
+        cmd += [str(threads)]
+
+    # remove leftovers of a failed run
+    pair_dir = os.path.join(config_dir, 'CORREL', '{}_{}'.format(date1, date2))
+    if(os.path.isdir(pair_dir)):
+        shutil.rmtree(pair_dir)
+    result = run_monitored(cmd, '{}.log'.format(pair_dir))
+
+    return (result['exit'], result['time'], result['rss_tree_mb'], result['rss_process_mb'])
+
+def read_correl_bands(correl_file):
+    # H, V and CC of correl-F.tif
+    ds = gdal.OpenEx(correl_file, allowed_drivers=['GTiff'])
+    return [ds.GetRasterBand(b).ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize).astype(np.float32) for b in [1, 2, 3]]
+
+def get_quality(correl_file):
+    h, v, cc = read_correl_bands(correl_file)
+    valid = np.isfinite(h) & np.isfinite(v)
+    return {'valid': np.count_nonzero(valid) / valid.size, 'cc_coverage': np.count_nonzero(cc == 1) / cc.size}
+
+def remove_median(data):
+    finite = np.isfinite(data)
+    if(not np.any(finite)):
+        return data
+    return data - np.median(data[finite])
+
+def get_closure(correl_files):
+    # closure residual of the triplet (ab, bc, ac) in pixel, H and V together
+    maps = [read_correl_bands(f)[:2] for f in correl_files]
+    residuals = []
+    for n in range(2):
+        ab, bc, ac = [remove_median(m[n]) for m in maps]
+        r = np.abs(ab + bc - ac)
+        residuals.append(r[np.isfinite(r)])
+    residuals = np.concatenate(residuals)
+    if(residuals.size == 0):
+        return np.nan
+    return float(np.median(residuals))
+
+def load_runs(runs_file):
+    runs = {}
+    if(os.path.isfile(runs_file)):
+        with open(runs_file, 'r') as f:
+            for l in f:
+                try:
+                    record = json.loads(l)
+                except ValueError:
+                    # incomplete line of a crashed run
+                    continue
+                runs[(record['window'], record['config'], record['pair'])] = record
+    return runs
+
+def save_run(runs_file, record):
+    with open(runs_file, 'a') as f:
+        f.write('{}\n'.format(json.dumps(record)))
+
+def run_config(window_dir, config_dir, config, triplet, threads, runs, runs_file):
+    # processes the three pairs of the triplet, returns the records of the runs
+    window = os.path.basename(window_dir)
+    a, b, c = triplet
+    records = []
+    for date1, date2 in [(a, b), (b, c), (a, c)]:
+        pair = '{}_{}'.format(date1, date2)
+        correl_file = os.path.join(config_dir, 'CORREL', pair, 'asp', 'correl-F.tif')
+        record = runs.get((window, config, pair))
+        # runs without rss_process are from older versions, their rss is not the summed RSS
+        if(record is None or not record['ok'] or 'rss_process' not in record or not os.path.isfile(correl_file)):
+            print('Start: {} {} {}'.format(window, config, pair))
+            exit_code, wall_time, rss, rss_process = run_pair(config_dir, date1, date2, threads)
+            ok = exit_code == 0 and os.path.isfile(correl_file)
+            record = {'window': window, 'config': config, 'pair': pair, 'ok': ok, 'exit_code': exit_code, 'time': wall_time, 'rss': rss, 'rss_process': rss_process}
+            if(ok):
+                record.update(get_quality(correl_file))
+            save_run(runs_file, record)
+            runs[(window, config, pair)] = record
+        records.append(record)
+
+    closure = np.nan
+    if(all([r['ok'] for r in records])):
+        closure = get_closure([os.path.join(config_dir, 'CORREL', r['pair'], 'asp', 'correl-F.tif') for r in records])
+    return (records, closure)
+
+## PARETO ##
+
+def get_pareto(results, minimize, maximize):
+    # True for the parameter sets that are not dominated by another set (at least as good in all metrics and better in one)
+    values = np.hstack([results[minimize].values, -results[maximize].values]).astype(float)
+    values[np.isnan(values)] = np.inf
+    pareto = []
+    for i in range(len(values)):
+        dominated = np.any(np.all(values <= values[i], axis=1) & np.any(values < values[i], axis=1))
+        pareto.append(not dominated and np.all(np.isfinite(values[i])))
+    return pareto
+
+########
+# MAIN #
+########
+
+arguments = docopt.docopt(__doc__)
+
+data_dir = arguments['--data']
+geotiff_dir = os.path.join(data_dir, 'GEOTIFF')
+
+if(arguments['--dest']):
+    dest_dir = arguments['--dest']
+else:
+    dest_dir = os.path.join(data_dir, 'AUTOTUNE')
+Path(dest_dir).mkdir(parents=True, exist_ok=True)
+
+if(arguments['--windows']):
+    n_windows = int(arguments['--windows'])
+else:
+    n_windows = 3
+
+if(arguments['--size']):
+    size = int(arguments['--size'])
+else:
+    size = 1024
+
+if(arguments['--threads']):
+    threads = int(arguments['--threads'])
+else:
+    threads = None
+
+# triplet of pairs for the closure residual
+dates = get_geotiff_dates(geotiff_dir)
+if(arguments['--pairs']):
+    pair_df = pd.read_csv(arguments['--pairs'], sep='\s+')
+    pairs = set([(str(d1), str(d2)) for d1, d2 in zip(pair_df['Master'], pair_df['Slave'])])
+else:
+    pairs = set(itertools.combinations(dates, 2))
+triplet = select_triplet(pairs, dates)
+if(triplet is None):
+    print('No triplet of pairs (a-b, b-c, a-c) found')
+    sys.exit(1)
+print('Triplet: {}'.format(', '.join(triplet)))
+
+# representative windows of the stack
+reference_file = os.path.join(geotiff_dir, 'AMPLI_MEAN.tif')
+if(not os.path.isfile(reference_file)):
+    reference_file = os.path.join(geotiff_dir, '{}.VV.mod_log.tif'.format(dates[0]))
+windows = select_windows(reference_file, size, n_windows)
+for i, w in enumerate(windows):
+    print('WIN_{}: xoff {} yoff {} size {}'.format(i, w[0], w[1], w[2]))
+window_dirs = cut_windows(geotiff_dir, triplet, windows, dest_dir)
+
+# all parameter sets of the grid
+param_sets = get_parameter_sets(read_grid(arguments['--grid']))
+print('{} parameter sets, {} windows: {} runs of run_stereo.sh'.format(len(param_sets), len(windows), len(param_sets) * len(windows) * 3))
+
+runs_file = os.path.join(dest_dir, 'autotune_runs.jsonl')
+runs = load_runs(runs_file)
+
+rows = []
+for params in param_sets:
+    config = get_config_name(params)
+    records, closures = [], []
+    for window_dir in window_dirs:
+        config_dir = prepare_config_dir(window_dir, config, params, os.path.join(data_dir, 'asp_parameters.txt'))
+        window_records, closure = run_config(window_dir, config_dir, config, triplet, threads, runs, runs_file)
+        records += window_records
+        closures.append(closure)
+
+    ok = [r for r in records if r['ok']]
+    row = dict(params, CONFIG=config, FAILED=len(records) - len(ok), TIME=np.sum([r['time'] for r in records]), RSS=np.max([r['rss'] for r in records]),
+               RSS_PROCESS=np.max([r['rss_process'] for r in records]))
+    if(len(ok) == len(records)):
+        row.update({'VALID': np.mean([r['valid'] for r in ok]), 'CC_COVERAGE': np.mean([r['cc_coverage'] for r in ok]), 'CLOSURE': np.mean(closures)})
+    else:
+        row.update({'VALID': np.nan, 'CC_COVERAGE': np.nan, 'CLOSURE': np.nan})
+    rows.append(row)
+
+results = pd.DataFrame(rows)
+results['PARETO'] = get_pareto(results, ['TIME', 'RSS', 'CLOSURE'], ['VALID', 'CC_COVERAGE'])
+results = results.sort_values('TIME')
+results.to_csv(os.path.join(dest_dir, 'autotune_results.txt'), sep='\t', index=False, float_format='%.4f')
+
+print('##################################')
+print('PARETO-OPTIMAL PARAMETER SETS')
+print('##################################')
+print(results[results['PARETO']][list(param_sets[0]) + ['TIME', 'RSS', 'VALID', 'CC_COVERAGE', 'CLOSURE']].to_string(index=False))
+print('All results in {}'.format(os.path.join(dest_dir, 'autotune_results.txt')))
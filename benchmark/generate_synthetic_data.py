@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+generate_synthetic_data.py
+------------
+Generate a synthetic data set for the benchmark of the python processing stages (benchmark/run_benchmark.py).
+The data set has the directory structure of a processing directory, no real SAR data is needed:
+
+    DEST/ALL2GIF/DATE_SYNTH/i12/TextFiles/InSARParameters.txt and i12/InSARProducts/DATE.VV.mod (amplitude, float32)
+    DEST/DATA/DATE.VV.mod (links to the .mod files), sampling.txt and CORREL/DATE1_DATE2/asp/correl-F.tif (H, V, CC)
+    DEST/CUBE/depl_cumule_range, depl_cumule_azimuth (ENVI cubes, float32, bip), incidence.r4, aspect.tif and mask.tif
+
+Each date is paired with the next two dates (triplets a-b, b-c, a-c). The data is written block by block, large sizes can be generated.
+
+Usage: generate_synthetic_data.py --dest=<path> [--nrow=<value>] [--ncol=<value>] [--dates=<value>] [--seed=<value>]
+generate_synthetic_data.py -h | --help
+
+Options:
+-h | --help         Show this screen
+--dest              Path to destination directory
+--nrow              Number of lines of the images [default: 1024]
+--ncol              Number of columns of the images [default: 1024]
+--dates             Number of dates [default: 10]
+--seed              Seed of the random generator [default: 0]
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os, sys
+import numpy as np
+from osgeo import gdal
+import datetime
+import json
+import shutil
+from pathlib import Path
+import docopt
+from aspsar.cube import CubeWriter
+
+#############
+# FUNCTIONS #
+#############
+
+# lines generated at once
+BLOCK_ROWS = 512
+
+# fraction of the pixels with CC == 1 and without disparity (NaN) in correl-F.tif
+CC_COVERAGE = 0.85
+NAN_FRACTION = 0.02
+
+AZ_SAMPLING, RANGE_SAMPLING = 1.9, 0.9
+
+def get_dates(n_dates):
+    # 11 day repeat cycle
+    start = datetime.datetime(2023, 1, 1)
+    return [(start + datetime.timedelta(days=11 * i)).strftime('%Y%m%d') for i in range(n_dates)]
+
+def get_pairs(dates):
+    # each date with the next two dates
+    return [(dates[i], dates[j]) for i in range(len(dates)) for j in range(i + 1, min(i + 3, len(dates)))]
+
+def get_blocks(nrow, block_rows=BLOCK_ROWS):
+    return [(y, min(block_rows, nrow - y)) for y in range(0, nrow, block_rows)]
+
+def get_texture(y, rows, ncol):
+    # smooth amplitude texture of the scene, the same for all dates
+    yy, xx = np.mgrid[y:y + rows, 0:ncol].astype(np.float32)
+    return 1.5 + np.sin(yy / 37.) * np.cos(xx / 53.) + 0.5 * np.sin((xx + yy) / 211.)
+
+def write_insar_parameters(param_file, ncol, nrow):
+    # only the lines read by aspsar.catalog.parse_insar_parameters
+    with open(param_file, 'w') as f:
+        f.write('/* Synthetic InSARParameters.txt of generate_synthetic_data.py */\n')
+        f.write('{}\t\t/* Azimuth sampling [m] */\n'.format(AZ_SAMPLING))
+        f.write('{}\t\t/* Slant range sampling [m] */\n'.format(RANGE_SAMPLING))
+        f.write('/* -5- Interferometric products computation */\n')
+        f.write('\n')
+        f.write('{}\t\t/* Number of columns */\n'.format(ncol))
+        f.write('{}\t\t/* Number of lines */\n'.format(nrow))
+
+def write_amplitude_stack(dest, dates, nrow, ncol, rng):
+    all2gif_dir = os.path.join(dest, 'ALL2GIF')
+    data_dir = os.path.join(dest, 'DATA')
+
+    for date in dates:
+        result_dir = os.path.join(all2gif_dir, '{}_SYNTH'.format(date))
+        Path(os.path.join(result_dir, 'i12', 'TextFiles')).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(result_dir, 'i12', 'InSARProducts')).mkdir(parents=True, exist_ok=True)
+        write_insar_parameters(os.path.join(result_dir, 'i12', 'TextFiles', 'InSARParameters.txt'), ncol, nrow)
+
+        mod_file = os.path.join(result_dir, 'i12', 'InSARProducts', '{}.VV.mod'.format(date))
+        m = np.memmap(mod_file, dtype=np.float32, mode='w+', shape=(nrow, ncol))
+        for y, rows in get_blocks(nrow):
+            # speckle: Rayleigh distributed amplitude
+            m[y:y + rows] = get_texture(y, rows, ncol) * rng.rayleigh(1., (rows, ncol)).astype(np.float32)
+        m.flush()
+        del m
+
+        os.symlink(os.path.abspath(mod_file), os.path.join(data_dir, '{}.VV.mod'.format(date)))
+
+def create_geotiff(output_path, ncol, nrow, n_bands=1):
+    drv = gdal.GetDriverByName('GTiff')
+    return drv.Create(output_path, ncol, nrow, n_bands, gdal.GDT_Float32)
+
+def write_correl_files(dest, pairs, nrow, ncol, rng):
+    correl_dir = os.path.join(dest, 'DATA', 'CORREL')
+
+    for k, (date1, date2) in enumerate(pairs):
+        asp_dir = os.path.join(correl_dir, '{}_{}'.format(date1, date2), 'asp')
+        Path(asp_dir).mkdir(parents=True, exist_ok=True)
+
+        # constant offset of the pair (removed by the median), displacement ramp and noise in pixel
+        offset = rng.normal(0., 0.5, 2)
+        dst_ds = create_geotiff(os.path.join(asp_dir, 'correl-F.tif'), ncol, nrow, 3)
+        for y, rows in get_blocks(nrow):
+            yy, xx = np.mgrid[y:y + rows, 0:ncol].astype(np.float32)
+            ramp = 0.2 * (k % 3 + 1) * np.sin(xx / ncol * np.pi) * np.cos(yy / nrow * np.pi)
+            h = offset[0] + ramp + rng.normal(0., 0.05, (rows, ncol))
+            v = offset[1] - 0.5 * ramp + rng.normal(0., 0.05, (rows, ncol))
+            cc = (rng.random((rows, ncol)) < CC_COVERAGE).astype(np.float32)
+
+            nan = rng.random((rows, ncol)) < NAN_FRACTION
+            h[nan], v[nan] = np.nan, np.nan
+
+            for n_band, data in [(1, h), (2, v), (3, cc)]:
+                dst_ds.GetRasterBand(n_band).WriteArray(data.astype(np.float32), 0, y)
+        dst_ds.FlushCache()
+        dst_ds = None
+
+def write_sampling(dest):
+    with open(os.path.join(dest, 'DATA', 'sampling.txt'), 'w') as f:
+        f.write('AZ\tSR\n')
+        f.write('{}\t{}\n'.format(AZ_SAMPLING, RANGE_SAMPLING))
+
+def write_cubes(dest, n_img, nrow, ncol, rng):
+    cube_dir = os.path.join(dest, 'CUBE')
+
+    # cumulative displacement: linear rate of each pixel and noise
+    for name, scale in [('depl_cumule_range', 1.), ('depl_cumule_azimuth', -0.5)]:
+        with CubeWriter(cube_dir, name, nrow, ncol, n_img) as writer:
+            for y, rows in get_blocks(nrow):
+                rate = scale * get_texture(y, rows, ncol)[:, :, np.newaxis]
+                writer.write_rows(y, rate * np.arange(n_img, dtype=np.float32) + rng.normal(0., 0.1, (rows, ncol, n_img)).astype(np.float32))
+
+    # incidence (raw float32 like the AMSTer products), aspect and binary mask
+    inc = np.memmap(os.path.join(cube_dir, 'incidence.r4'), dtype=np.float32, mode='w+', shape=(nrow, ncol))
+    aspect_ds = create_geotiff(os.path.join(cube_dir, 'aspect.tif'), ncol, nrow)
+    mask_ds = create_geotiff(os.path.join(cube_dir, 'mask.tif'), ncol, nrow)
+    for y, rows in get_blocks(nrow):
+        inc[y:y + rows] = np.linspace(30., 45., ncol, dtype=np.float32)[np.newaxis, :]
+        aspect_ds.GetRasterBand(1).WriteArray(rng.uniform(0., 360., (rows, ncol)).astype(np.float32), 0, y)
+        mask_ds.GetRasterBand(1).WriteArray((rng.random((rows, ncol)) < CC_COVERAGE).astype(np.float32), 0, y)
+    inc.flush()
+    del inc
+    aspect_ds.FlushCache()
+    mask_ds.FlushCache()
+
+def generate_data_set(dest, nrow, ncol, n_dates, seed):
+    rng = np.random.default_rng(seed)
+    dates = get_dates(n_dates)
+    pairs = get_pairs(dates)
+
+    for d in ['ALL2GIF', 'DATA', 'CUBE']:
+        Path(os.path.join(dest, d)).mkdir(parents=True, exist_ok=True)
+
+    print('Write amplitude stack: {} dates of {}x{} pixel'.format(len(dates), nrow, ncol))
+    write_amplitude_stack(dest, dates, nrow, ncol, rng)
+
+    print('Write correl-F.tif of {} pairs'.format(len(pairs)))
+    write_correl_files(dest, pairs, nrow, ncol, rng)
+    write_sampling(dest)
+
+    print('Write cubes of {} maps'.format(len(dates)))
+    write_cubes(dest, len(dates), nrow, ncol, rng)
+
+    # parameters of the data set, benchmark/run_benchmark.py reuses the data set if they are the same
+    info = {'nrow': nrow, 'ncol': ncol, 'dates': n_dates, 'pairs': len(pairs), 'seed': seed}
+    with open(os.path.join(dest, 'synthetic_info.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    return info
+
+########
+# MAIN #
+########
+
+arguments = docopt.docopt(__doc__)
+
+dest = arguments['--dest']
+
+if(arguments['--nrow']):
+    nrow = int(arguments['--nrow'])
+else:
+    nrow = 1024
+
+if(arguments['--ncol']):
+    ncol = int(arguments['--ncol'])
+else:
+    ncol = 1024
+
+if(arguments['--dates']):
+    n_dates = int(arguments['--dates'])
+else:
+    n_dates = 10
+
+if(arguments['--seed']):
+    seed = int(arguments['--seed'])
+else:
+    seed = 0
+
+if(n_dates < 3):
+    print('At least 3 dates are needed for the pair triplets')
+    sys.exit(1)
+
+# always a complete new data set, the links and ENVI cubes are not updated in place
+if(os.path.exists(os.path.join(dest, 'synthetic_info.json'))):
+    print('Remove previous synthetic data set in {}'.format(dest))
+    for d in ['ALL2GIF', 'DATA', 'CUBE']:
+        shutil.rmtree(os.path.join(dest, d), ignore_errors=True)
+    os.remove(os.path.join(dest, 'synthetic_info.json'))
+
+info = generate_data_set(dest, nrow, ncol, n_dates, seed)
+print('Synthetic data set saved in {}: {}'.format(dest, info))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+run_benchmark.py
+------------
+Benchmark of the python processing stages on synthetic data (benchmark/generate_synthetic_data.py).
+The stages are run end to end as in the processing chain, each stage as its own process:
+
+    convert_geotiff         convert_geotiff.py (amplitude .mod files to GeoTIFF, AMPLI_MEAN/SIGMA)
+    export                  prepare_result_export.py (EXPORT/ADJUSTED, CC, NSBAS)
+    mask_cc                 utils/mask_correl_results_cc.py (EXPORT/MASKED)
+    mask_cc_virtual         utils/mask_correl_results_cc.py --virtual (EXPORT/MASKS/BENCH)
+    export_mask             prepare_result_export.py --mask (NSBAS/MASKED from the virtual masks)
+    export_direct           prepare_result_export.py --f --direct --masked --geotiff
+    invert_cube             utils/invert_cube.py
+    mask_cube               utils/mask_cube_binary.py (binary mask GeoTIFF)
+    mask_cube_virtual       utils/mask_cube_binary.py (virtual mask .npz)
+    deconstruct_cube        utils/deconstruct_cube.py (last map)
+    invert_cube2slope       projection/invert_cube2slope.py
+
+For each stage the wall time, the peak memory and the I/O of /proc/PID/io are measured (aspsar.process):
+RSS is the peak of the summed RSS of the stage and its child processes (f.e. the --jobs workers), sampled during the run,
+RSS_PROC the peak of the largest single process. rchar/wchar are the bytes of read/write calls (also served by the page cache,
+not the memory mapped files), read_bytes/write_bytes the bytes read from/written to the storage (includes the memory mapped files).
+The results are appended to a JSON history and compared to the last run with the same data set, jobs and host.
+The data set of each size is generated once in DEST/SYNTH_NROWxNCOL_DATES and reused, the outputs of the selected stages are removed before the run.
+
+Usage: run_benchmark.py --dest=<path> [--size=<values>] [--dates=<value>] [--jobs=<value>] [--stages=<values>] [--history=<path>] [--note=<value>]
+run_benchmark.py -h | --help
+
+Options:
+-h | --help         Show this screen
+--dest              Path to benchmark directory (synthetic data sets, outputs and logs of the stages)
+--size              Image sizes NROWxNCOL, comma separated to benchmark several sizes (f.e. 1024x1024,4096x4096) [default: 1024x1024]
+--dates             Number of dates of the synthetic stack [default: 10]
+--jobs              Value of --jobs of the stages that process in parallel [default: 1]
+--stages            Comma separated stages to run, in the order of the chain (the inputs of the other stages must exist) [default: all]
+--history           Path to JSON history of the benchmark [default: benchmark/benchmark_history.json]
+--note              Note saved with the results (f.e. the change that is benchmarked)
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os, sys
+import numpy as np
+import subprocess
+import shutil
+import time
+import datetime
+import platform
+import json
+from pathlib import Path
+import docopt
+from aspsar.process import run_monitored
+
+#############
+# FUNCTIONS #
+#############
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# name of the virtual masks of the benchmark
+MASK_NAME = 'BENCH'
+
+STAGES = ['convert_geotiff', 'export', 'mask_cc', 'mask_cc_virtual', 'export_mask', 'export_direct',
+          'invert_cube', 'mask_cube', 'mask_cube_virtual', 'deconstruct_cube', 'invert_cube2slope']
+
+def get_script(path):
+    return os.path.join(REPO_DIR, path)
+
+def get_first_mask(data_dir):
+    # one of the virtual masks, the synthetic cubes have the size of the pairs
+    mask_dir = os.path.join(data_dir, 'EXPORT', 'MASKS', MASK_NAME)
+    if(not os.path.isdir(mask_dir)):
+        return os.path.join(mask_dir, 'missing.npz')
+    return os.path.join(mask_dir, sorted(os.listdir(mask_dir))[0])
+
+def get_stage(name, data_dir, cube_dir, run_dir, jobs):
+    # returns the command of the stage and the outputs removed before the run
+    exp_dir = os.path.join(data_dir, 'EXPORT')
+    cube = os.path.join(run_dir, 'depl_cumule_range')
+
+    if(name == 'convert_geotiff'):
+        return ([get_script('convert_geotiff.py'), '--data={}'.format(data_dir), '--jobs={}'.format(jobs)], [os.path.join(data_dir, 'GEOTIFF')])
+    if(name == 'export'):
+        return ([get_script('prepare_result_export.py'), '--data={}'.format(data_dir), '--jobs={}'.format(jobs)], [exp_dir])
+    if(name == 'mask_cc'):
+        return ([get_script('utils/mask_correl_results_cc.py'), '--data={}'.format(exp_dir), '--jobs={}'.format(jobs)], [os.path.join(exp_dir, 'MASKED')])
+    if(name == 'mask_cc_virtual'):
+        return ([get_script('utils/mask_correl_results_cc.py'), '--data={}'.format(exp_dir), '--jobs={}'.format(jobs), '--virtual={}'.format(MASK_NAME)],
+                [os.path.join(exp_dir, 'MASKS', MASK_NAME)])
+    if(name == 'export_mask'):
+        return ([get_script('prepare_result_export.py'), '--data={}'.format(data_dir), '--jobs={}'.format(jobs), '--mask={}'.format(MASK_NAME)],
+                [os.path.join(exp_dir, 'NSBAS', 'MASKED')])
+    if(name == 'export_direct'):
+        # --f: all products of the export are written again
+        return ([get_script('prepare_result_export.py'), '--data={}'.format(data_dir), '--jobs={}'.format(jobs), '--f', '--direct', '--masked', '--geotiff'], [])
+    if(name == 'invert_cube'):
+        return ([get_script('utils/invert_cube.py'), '--cube={}'.format(cube)], [])
+    if(name == 'mask_cube'):
+        return ([get_script('utils/mask_cube_binary.py'), '--cube={}'.format(cube), '--mask={}'.format(os.path.join(cube_dir, 'mask.tif')), '--dest={}'.format(run_dir)], [])
+    if(name == 'mask_cube_virtual'):
+        # no --dest option for the name, the output of mask_cube is overwritten
+        return ([get_script('utils/mask_cube_binary.py'), '--cube={}'.format(cube), '--mask={}'.format(get_first_mask(data_dir)), '--dest={}'.format(run_dir)], [])
+    if(name == 'deconstruct_cube'):
+        return ([get_script('utils/deconstruct_cube.py'), '--cube={}'.format(cube), '--dest={}'.format(run_dir), '--nimg=-1'], [])
+    if(name == 'invert_cube2slope'):
+        return ([get_script('projection/invert_cube2slope.py'), '--range_cube={}'.format(cube), '--azimuth_cube={}'.format(os.path.join(run_dir, 'depl_cumule_azimuth')),
+                 '--inc={}'.format(os.path.join(cube_dir, 'incidence.r4')), '--aspect={}'.format(os.path.join(cube_dir, 'aspect.tif')),
+                 '--heading=100', '--dest={}'.format(run_dir), '--ext=bench', '--jobs={}'.format(jobs)], [])
+    raise ValueError('Unknown stage: {} ({})'.format(name, ', '.join(STAGES)))
+
+def get_env():
+    # the stages import aspsar from contrib/python, no display for matplotlib
+    env = dict(os.environ)
+    python_dir = os.path.join(REPO_DIR, 'contrib', 'python')
+    env['PYTHONPATH'] = os.pathsep.join([python_dir] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    env['MPLBACKEND'] = 'Agg'
+    return env
+
+def run_stage(cmd, log_file, env):
+    # returns exit code, wall time (s), memory peaks (MB), CPU times and I/O of the stage
+    return run_monitored([sys.executable] + cmd, log_file, env)
+
+def prepare_data_set(dest, nrow, ncol, n_dates, env):
+    # data set of the size, only generated if missing or generated with other parameters
+    data_set_dir = os.path.join(dest, 'SYNTH_{}x{}_{}'.format(nrow, ncol, n_dates))
+    info_file = os.path.join(data_set_dir, 'synthetic_info.json')
+
+    if(os.path.isfile(info_file)):
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        if(info['nrow'] == nrow and info['ncol'] == ncol and info['dates'] == n_dates):
+            print('Use synthetic data set {}'.format(data_set_dir))
+            return (data_set_dir, info)
+
+    print('Generate synthetic data set {}'.format(data_set_dir))
+    start = time.time()
+    cmd = [sys.executable, os.path.join(BENCHMARK_DIR, 'generate_synthetic_data.py'), '--dest={}'.format(data_set_dir),
+           '--nrow={}'.format(nrow), '--ncol={}'.format(ncol), '--dates={}'.format(n_dates)]
+    subprocess.run(cmd, env=env, check=True)
+    print('Generated in {:.1f} s'.format(time.time() - start))
+
+    with open(info_file, 'r') as f:
+        return (data_set_dir, json.load(f))
+
+def prepare_run_dir(run_dir, cube_dir):
+    # links to the cubes, the cube tools write their outputs next to the input cube
+    shutil.rmtree(run_dir, ignore_errors=True)
+    Path(run_dir).mkdir(parents=True, exist_ok=True)
+    for f in os.listdir(cube_dir):
+        if(f.startswith('depl_cumule')):
+            os.symlink(os.path.abspath(os.path.join(cube_dir, f)), os.path.join(run_dir, f))
+
+def get_git_version():
+    # commit of the benchmarked code, with -dirty if there are uncommitted changes
+    try:
+        commit = subprocess.run(['git', '-C', REPO_DIR, 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', '-C', REPO_DIR, 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return '{}-dirty'.format(commit) if status else commit
+
+def load_history(history_file):
+    if(not os.path.isfile(history_file)):
+        return []
+    with open(history_file, 'r') as f:
+        return json.load(f)
+
+def save_history(history_file, history):
+    # write to temporary file first, an interrupted benchmark must not destroy the history
+    tmp_file = '{}.tmp'.format(history_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_file, history_file)
+
+def get_previous_run(history, run):
+    # last run with the same data set, jobs and host
+    for previous in reversed(history):
+        if(previous['data'] == run['data'] and previous['jobs'] == run['jobs'] and previous['host'] == run['host']):
+            return previous
+    return None
+
+def format_change(value, previous):
+    if(value is None or previous is None or previous == 0):
+        return ''
+    return '{:+.0f}%'.format(100. * (value - previous) / previous)
+
+def format_mb(value):
+    if(value is None):
+        return '-'
+    return '{:.0f}'.format(value / 1024. ** 2)
+
+def print_results(run, previous):
+    if(previous is not None):
+        print('Compared to {} ({}, {})'.format(previous['date'], previous['commit'], previous.get('note') or 'no note'))
+    print('{:<20}{:>6}{:>10}{:>8}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('STAGE', 'EXIT', 'TIME[s]', '', 'RSS[MB]', '', 'RSS_PROC', 'READ[MB]', 'WRITE[MB]', 'DISK_R', 'DISK_W'))
+    for name, r in run['stages'].items():
+        # runs of older versions have no summed RSS (rss_mb was the largest process), they are not compared
+        p = previous['stages'].get(name, {}) if previous is not None else {}
+        print('{:<20}{:>6}{:>10.2f}{:>8}{:>10.0f}{:>8}{:>10.0f}{:>10}{:>10}{:>10}{:>10}'.format(name, r['exit'], r['time'], format_change(r['time'], p.get('time')),
+              r['rss_tree_mb'], format_change(r['rss_tree_mb'], p.get('rss_tree_mb')), r['rss_process_mb'], format_mb(r['rchar']), format_mb(r['wchar']),
+              format_mb(r['read_bytes']), format_mb(r['write_bytes'])))
+
+def run_benchmark(dest, nrow, ncol, n_dates, jobs, stages, note, env):
+    data_set_dir, info = prepare_data_set(dest, nrow, ncol, n_dates, env)
+    data_dir, cube_dir = os.path.join(data_set_dir, 'DATA'), os.path.join(data_set_dir, 'CUBE')
+    run_dir, log_dir = os.path.join(data_set_dir, 'RUN'), os.path.join(data_set_dir, 'LOGS')
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    if(any([s in stages for s in ['invert_cube', 'mask_cube', 'mask_cube_virtual', 'deconstruct_cube', 'invert_cube2slope']])):
+        prepare_run_dir(run_dir, cube_dir)
+
+    run = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': get_git_version(), 'note': note,
+           'host': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+           'data': info, 'jobs': jobs, 'stages': {}}
+
+    for name in stages:
+        cmd, outputs = get_stage(name, data_dir, cube_dir, run_dir, jobs)
+        for output in outputs:
+            shutil.rmtree(output, ignore_errors=True)
+
+        print('Run {}'.format(name))
+        result = run_stage(cmd, os.path.join(log_dir, '{}.log'.format(name)), env)
+        if(result['exit'] != 0):
+            print('{} failed (exit code {}), see {}'.format(name, result['exit'], os.path.join(log_dir, '{}.log'.format(name))))
+        run['stages'][name] = result
+
+    run['total_time'] = sum([r['time'] for r in run['stages'].values()])
+    return run
+
+########
+# MAIN #
+########
+
+arguments = docopt.docopt(__doc__)
+
+dest = os.path.abspath(arguments['--dest'])
+
+if(arguments['--size']):
+    sizes = [tuple(map(int, s.lower().split('x'))) for s in arguments['--size'].split(',')]
+else:
+    sizes = [(1024, 1024)]
+
+if(arguments['--dates']):
+    n_dates = int(arguments['--dates'])
+else:
+    n_dates = 10
+
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
+
+if(arguments['--stages']):
+    selected = arguments['--stages'].split(',')
+    unknown = [s for s in selected if s not in STAGES]
+    if(unknown):
+        print('Unknown stages: {} (available: {})'.format(', '.join(unknown), ', '.join(STAGES)))
+        sys.exit(1)
+    # always in the order of the processing chain
+    stages = [s for s in STAGES if s in selected]
+else:
+    stages = STAGES
+
+if(arguments['--history']):
+    history_file = arguments['--history']
+else:
+    history_file = os.path.join(BENCHMARK_DIR, 'benchmark_history.json')
+
+note = arguments['--note']
+
+env = get_env()
+Path(dest).mkdir(parents=True, exist_ok=True)
+
+for nrow, ncol in sizes:
+    print('##################################')
+    print('BENCHMARK {}x{} PIXEL, {} DATES, {} JOB(S)'.format(nrow, ncol, n_dates, jobs))
+    print('##################################')
+
+    run = run_benchmark(dest, nrow, ncol, n_dates, jobs, stages, note, env)
+
+    # the history is saved after each size, the results of finished sizes are kept if a larger size fails
+    history = load_history(history_file)
+    previous = get_previous_run(history, run)
+    history.append(run)
+    save_history(history_file, history)
+
+    print_results(run, previous)
+    print('Total time {:.1f} s, results saved in {}'.format(run['total_time'], history_file))
@@ -4,13 +4,20 @@
 check_all2gif.py
 -----------
 Check the ALL2GIF.sh results before processing with ASP
+The dimensions are read from the catalog ALL2GIF_DIR/aspsar_catalog.sqlite (aspsar.catalog), which is updated first
+The .mod files are checked against the dimensions of their InSARParameters.txt (file size ncol*nrow*4) and the most common dimensions of the stack.
+With --deep, lines sampled over the image are read to find images with only 0 or NaN values.
+All results are written to a report (tab separated, one line per .mod file), use it with convert_geotiff.py --report to skip the bad dates.
 
-Usage: check_all2gif.py --check=<path>
+Usage: check_all2gif.py --check=<path> [--deep] [--jobs=<value>] [--report=<path>]
 check_all2gif.py -h | --help
 
 Options:
 -h --help       Show this screen
 --check         Path to ALL2GIF.sh results
+--deep          Also check the content of the .mod files (sampled lines)
+--jobs          Number of files checked at the same time [default: 16]
+--report        Path to report file [default: ALL2GIF_DIR/all2gif_report.txt]
 
 
 """
@@ -20,31 +27,75 @@ Options:
 
 import os, sys
 import numpy as np
+import pandas as pd
 import docopt
+from concurrent.futures import ThreadPoolExecutor
+from aspsar.catalog import Catalog, REPORT_COLUMNS
 
 #############
 # FUNCTIONS #
 #############
 
+# number of lines read per image with --deep
+SAMPLE_LINES = 64
 
-def check_for_empty_files(all2gif_dir):
+def check_for_empty_files(catalog):
+    # dimensions of the results from the catalog (i12/TextFiles/InSARParameters.txt, only new or changed results are read)
     out = []
-    for d in os.listdir(all2gif_dir):
-        # need to filter bc of _AMPLI directory
-        if(os.path.isdir(os.path.join(all2gif_dir, d)) and d[0] == '2'):
-            insar_param_file = os.path.join(all2gif_dir, d, 'i12', 'TextFiles', 'InSARParameters.txt')
-            with open(insar_param_file, 'r') as f:
-            # read lines of file and remove whitespace and comments (comments after \t\t)
-                lines = [''.join(l.strip().split('\t\t')[0]) for l in f.readlines()]
-                jump_index = lines.index('/* -5- Interferometric products computation */')
-                img_dim = lines[jump_index + 2: jump_index + 4]
-
-                ncol, nrow = int(img_dim[0].strip()), int(img_dim[1].strip())
-                if(ncol == 0):
-                    out += [d]
-                #print('{}\t{}\t{}'.format(d.split('_')[1], ncol, nrow))
+    for entry in catalog.results():
+        if(entry['ncol'] == 0):
+            out += [entry['dir']]
+            #print('{}\t{}\t{}'.format(entry['dir'].split('_')[1], entry['ncol'], entry['nrow']))
     return out
 
+def get_stack_dimensions(catalog):
+    # most common dimensions of the non empty results (all images have the same dimension after ALL2GIF processing, except f.e. S1)
+    dims = pd.DataFrame([(e['ncol'], e['nrow']) for e in catalog.results() if e['ncol'] != 0], columns=['ncol', 'nrow'])
+    if(dims.empty):
+        return None
+    return (int(dims['ncol'].value_counts().idxmax()), int(dims['nrow'].value_counts().idxmax()))
+
+def sample_content(mod_file, ncol, nrow, n_lines=SAMPLE_LINES):
+    # True if the sampled lines contain finite values != 0
+    m = np.memmap(mod_file, dtype=np.float32, mode='r', shape=(nrow, ncol))
+    for y in np.unique(np.linspace(0, nrow - 1, min(n_lines, nrow)).astype(int)):
+        line = np.array(m[y])
+        if(np.any(np.isfinite(line) & (line != 0))):
+            return True
+    return False
+
+def check_mod_file(all2gif_dir, entry, mod, stack_dims, deep):
+    # returns the report line (dict of REPORT_COLUMNS) of one .mod file
+    mod_file = os.path.join(all2gif_dir, entry['dir'], 'i12', 'InSARProducts', mod)
+    ncol, nrow = entry['ncol'], entry['nrow']
+    size = os.path.getsize(mod_file)
+    problems = []
+
+    if(entry['error'] is not None):
+        problems += ['PARAMETERS']
+    elif(ncol == 0):
+        problems += ['EMPTY']
+    else:
+        if(size != ncol * nrow * 4):
+            problems += ['SIZE']
+        if(stack_dims is not None and (ncol, nrow) != stack_dims):
+            problems += ['DIMENSION']
+        # content only if the file is complete
+        if(deep and 'SIZE' not in problems and not sample_content(mod_file, ncol, nrow)):
+            problems += ['NODATA']
+
+    return {'DATE': mod.split('.')[0], 'DIR': entry['dir'], 'FILE': mod, 'NCOL': ncol, 'NROW': nrow, 'SIZE': size,
+            'STATUS': 'BAD' if problems else 'OK', 'PROBLEMS': ','.join(problems)}
+
+def check_stack(all2gif_dir, catalog, deep=False, jobs=16):
+    stack_dims = get_stack_dimensions(catalog)
+    tasks = [(entry, mod) for entry in catalog.results() for mod in entry['mod_files']]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        report = list(pool.map(lambda t: check_mod_file(all2gif_dir, t[0], t[1], stack_dims, deep), tasks))
+
+    return pd.DataFrame(report, columns=REPORT_COLUMNS)
+
 ########
 # MAIN #
 ########
@@ -53,7 +104,21 @@ arguments = docopt.docopt(__doc__)
 
 all2gif_dir = arguments["--check"]
 
-empty_files = check_for_empty_files(all2gif_dir)
+deep = arguments['--deep']
+
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 16
+
+if(arguments['--report']):
+    report_file = arguments['--report']
+else:
+    report_file = os.path.join(all2gif_dir, 'all2gif_report.txt')
+
+catalog = Catalog(all2gif_dir, jobs)
+
+empty_files = check_for_empty_files(catalog)
 
 if(not empty_files):
     print('Everything should be fine, can continue with process_stereo')
@@ -61,5 +126,12 @@ else:
     print('Check following directories; adjust LLRGCO & LLAZCO and process ALL2GIF again')
     for d in empty_files:
         print(os.path.join(all2gif_dir, d))
-        
 
+# check of the .mod files (size, dimensions and with --deep content)
+report = check_stack(all2gif_dir, catalog, deep, jobs)
+report.to_csv(report_file, sep='\t', index=False)
+
+bad = report[report['STATUS'] != 'OK']
+print('{} of {} .mod files OK, report saved in {}'.format(len(report) - len(bad), len(report), report_file))
+for _, r in bad.iterrows():
+    print('{}\t{}\t{}'.format(r['DATE'], r['PROBLEMS'], os.path.join(all2gif_dir, r['DIR'])))
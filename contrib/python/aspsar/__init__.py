@@ -0,0 +1,2 @@
+# shared functions of the ASP-SAR scripts
+# contrib/python has to be in $PYTHONPATH (see contrib/modufiles/asp-dsm)
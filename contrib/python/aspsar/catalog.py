@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+catalog.py
+--------------
+Index of the ALL2GIF results. The i12/TextFiles/InSARParameters.txt files (dimensions and sampling) and the .mod files of
+i12/InSARProducts of all result directories are read once and saved in ALL2GIF_DIR/aspsar_catalog.sqlite.
+A result directory is only read again if the modification time of its InSARParameters.txt or InSARProducts changed.
+The directories are scanned with a thread pool (the time is spent waiting for the file system, f.e. NFS).
+If the ALL2GIF directory is not writable, the index is only kept in memory.
+
+Usage in the scripts:
+    from aspsar.catalog import Catalog
+    catalog = Catalog(all2gif_dir)
+    for r in catalog.results():
+        print(r['dir'], r['ncol'], r['nrow'], r['az_sampling'], r['range_sampling'], r['mod_files'])
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+#############
+# FUNCTIONS #
+#############
+
+CATALOG_FILE = 'aspsar_catalog.sqlite'
+SCAN_THREADS = 16
+
+COLUMNS = ['dir', 'param_mtime', 'products_mtime', 'ncol', 'nrow', 'az_sampling', 'range_sampling', 'mod_files', 'error']
+
+# columns of the check_all2gif.py report, STATUS is OK or BAD, PROBLEMS the comma separated checks that failed
+REPORT_COLUMNS = ['DATE', 'DIR', 'FILE', 'NCOL', 'NROW', 'SIZE', 'STATUS', 'PROBLEMS']
+
+def get_insar_param_file(result_dir):
+    return os.path.join(result_dir, 'i12', 'TextFiles', 'InSARParameters.txt')
+
+def get_products_dir(result_dir):
+    return os.path.join(result_dir, 'i12', 'InSARProducts')
+
+def get_all2gif_dir(mod_file):
+    # ALL2GIF_DIR/DIR/i12/InSARProducts/DATE.VV.mod -> (ALL2GIF_DIR, DIR), links are resolved
+    products_dir = os.path.dirname(os.path.realpath(mod_file))
+    result_dir = os.path.dirname(os.path.dirname(products_dir))
+    return (os.path.dirname(result_dir), os.path.basename(result_dir))
+
+def parse_insar_parameters(insar_param_file):
+    # returns ncol, nrow (interferometric products) and azimuth, slant range sampling (as written in the file)
+    with open(insar_param_file, 'r') as f:
+        raw_lines = [l.strip() for l in f.readlines()]
+
+    # remove whitespace and comments (comments after \t\t)
+    lines = [l.split('\t\t')[0] for l in raw_lines]
+    jump_index = lines.index('/* -5- Interferometric products computation */')
+    img_dim = lines[jump_index + 2: jump_index + 4]
+    ncol, nrow = int(img_dim[0].strip()), int(img_dim[1].strip())
+
+    az_sampling, range_sampling = None, None
+    for l in [''.join(l.split('\t\t')) for l in raw_lines]:
+        if('Azimuth sampling' in l):
+            az_sampling = l.split('/')[0].strip()
+        if('Slant range sampling' in l):
+            range_sampling = l.split('/')[0].strip()
+            break
+
+    return (ncol, nrow, az_sampling, range_sampling)
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def scan_result_dir(all2gif_dir, d, previous=None):
+    # entry of one result directory, previous entry is returned if nothing changed
+    result_dir = os.path.join(all2gif_dir, d)
+    param_mtime = get_mtime(get_insar_param_file(result_dir))
+    products_mtime = get_mtime(get_products_dir(result_dir))
+
+    if(previous is not None and previous['param_mtime'] == param_mtime and previous['products_mtime'] == products_mtime):
+        return previous
+
+    entry = {'dir': d, 'param_mtime': param_mtime, 'products_mtime': products_mtime, 'ncol': 0, 'nrow': 0,
+             'az_sampling': None, 'range_sampling': None, 'mod_files': [], 'error': None}
+    try:
+        entry['ncol'], entry['nrow'], entry['az_sampling'], entry['range_sampling'] = parse_insar_parameters(get_insar_param_file(result_dir))
+    except (OSError, ValueError, IndexError) as e:
+        # missing or incomplete InSARParameters.txt, handled like a result with empty dimensions
+        entry['error'] = str(e)
+
+    if(products_mtime is not None):
+        entry['mod_files'] = sorted([f for f in os.listdir(get_products_dir(result_dir)) if os.path.splitext(f)[1] == '.mod'])
+
+    return entry
+
+class Catalog:
+    def __init__(self, all2gif_dir, threads=SCAN_THREADS, update=True):
+        self.all2gif_dir = all2gif_dir
+        self.threads = threads
+
+        catalog_file = os.path.join(all2gif_dir, CATALOG_FILE)
+        if(os.path.isfile(catalog_file)):
+            writable = os.access(catalog_file, os.W_OK)
+        else:
+            writable = os.access(all2gif_dir, os.W_OK)
+
+        if(writable):
+            self.db = sqlite3.connect(catalog_file)
+        else:
+            print('Cannot write {}, keep the catalog in memory'.format(catalog_file))
+            self.db = sqlite3.connect(':memory:')
+        self.create_table()
+
+        if(update):
+            self.update()
+
+    def create_table(self):
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (dir TEXT PRIMARY KEY, param_mtime REAL, products_mtime REAL, ncol INTEGER, nrow INTEGER, '
+                        'az_sampling TEXT, range_sampling TEXT, mod_files TEXT, error TEXT)')
+        self.db.commit()
+
+    def read_entries(self):
+        entries = {}
+        for row in self.db.execute('SELECT {} FROM results'.format(', '.join(COLUMNS))):
+            entry = dict(zip(COLUMNS, row))
+            entry['mod_files'] = json.loads(entry['mod_files'])
+            entries[entry['dir']] = entry
+        return entries
+
+    def update(self):
+        # scan the result directories (DATE_... directories, not f.e. _AMPLI) and read the changed ones again
+        previous = self.read_entries()
+        dirs = [e.name for e in os.scandir(self.all2gif_dir) if e.name[0] == '2' and e.is_dir()]
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            entries = list(pool.map(lambda d: scan_result_dir(self.all2gif_dir, d, previous.get(d)), dirs))
+
+        changed = [e for e in entries if e is not previous.get(e['dir'])]
+        removed = [d for d in previous if d not in set(dirs)]
+        if(changed or removed):
+            print('Catalog {}: {} result directories read, {} removed'.format(self.all2gif_dir, len(changed), len(removed)))
+
+        self.db.executemany('INSERT OR REPLACE INTO results VALUES ({})'.format(', '.join(['?'] * len(COLUMNS))),
+                            [[json.dumps(e[c]) if c == 'mod_files' else e[c] for c in COLUMNS] for e in changed])
+        self.db.executemany('DELETE FROM results WHERE dir = ?', [(d,) for d in removed])
+        self.db.commit()
+
+        self.entries = dict((e['dir'], e) for e in entries)
+
+    def results(self):
+        # entries of all result directories, sorted by directory name
+        return [self.entries[d] for d in sorted(self.entries)]
+
+    def get(self, d):
+        return self.entries.get(d)
+
+def get_bad_dates(report_file):
+    # dates (YYYYMMDD) of the .mod files that failed a check of check_all2gif.py
+    with open(report_file, 'r') as f:
+        lines = [l.rstrip('\n').split('\t') for l in f.readlines()]
+    header = lines[0]
+    return sorted(set([l[header.index('DATE')] for l in lines[1:] if l[header.index('STATUS')] != 'OK']))
+
+def get_catalogs(mod_files, threads=SCAN_THREADS):
+    # one catalog for each ALL2GIF directory of the (linked) .mod files
+    catalogs = {}
+    for mod_file in mod_files:
+        all2gif_dir = get_all2gif_dir(mod_file)[0]
+        if(all2gif_dir not in catalogs):
+            catalogs[all2gif_dir] = Catalog(all2gif_dir, threads)
+    return catalogs
+
+def get_mod_entry(catalogs, mod_file):
+    # entry of the result directory of a (linked) .mod file
+    all2gif_dir, d = get_all2gif_dir(mod_file)
+    return catalogs[all2gif_dir].get(d)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+cube.py
+--------------
+Read and write the cube files of the NSBAS processing (ENVI, float32, band interleaved by pixel).
+The cube is memory mapped and only the requested band, pixel or window is read. NSBAS nodata values (9990, 9999) are set to NaN on access.
+An optional virtual mask (aspsar.masks.Mask) is applied on access as well.
+CubeWriter preallocates the output cube and writes it map by map or block by block, the .hdr and lect_*.in files are written on close.
+
+Usage in the scripts:
+    from aspsar.cube import Cube, CubeWriter
+    cube = Cube(cube_file)
+    nlines, ncols, n_img = cube.shape
+    with CubeWriter(dest_path, out_filename, nlines, ncols, n_img) as writer:
+        for l in range(n_img):
+            writer.write_band(l, -cube.band(l))
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os
+import numpy as np
+from osgeo import gdal
+
+#############
+# FUNCTIONS #
+#############
+
+NODATA_VALUES = (9990, 9999)
+
+def get_cube_dimension(cube_file):
+    # read dimensions from the .hdr file of the cube
+    ds = gdal.Open(cube_file)
+    ncols, nlines = ds.RasterXSize, ds.RasterYSize
+    n_img = ds.RasterCount
+
+    return (nlines, ncols, n_img)
+
+def mask_nodata(data, nodata=NODATA_VALUES):
+    # returns a float32 copy of data with the nodata values set to NaN
+    data = np.array(data, dtype=np.float32)
+    for v in nodata:
+        data[data == v] = np.nan
+    return data
+
+class Cube:
+    # ncol, nlines, n_img are read from the .hdr file if not given (f.e. given from lect_ts.in)
+    # mask: aspsar.masks.Mask with the extent of the maps, masked pixels are NaN
+    def __init__(self, cube_file, ncol=None, nlines=None, n_img=None, nodata=NODATA_VALUES, mask=None):
+        if(ncol is None or nlines is None or n_img is None):
+            nlines, ncol, n_img = get_cube_dimension(cube_file)
+
+        self.cube_file = cube_file
+        self.nlines, self.ncol, self.n_img = nlines, ncol, n_img
+        self.nodata = nodata
+
+        if(mask is not None and mask.shape != (nlines, ncol)):
+            raise ValueError('Mask shape {} does not match the cube ({}, {})'.format(mask.shape, nlines, ncol))
+        self.mask = mask
+
+        # files can be longer than the cube (f.e. NSBAS depl_cumule), only map the cube itself
+        self.maps = np.memmap(cube_file, dtype=np.float32, mode='r', shape=(nlines, ncol, n_img))
+
+    @property
+    def shape(self):
+        return (self.nlines, self.ncol, self.n_img)
+
+    def band(self, l, crop=None):
+        # map l of the cube (nlines, ncols), optional only the crop extent (ymin, ymax, xmin, xmax)
+        if(crop):
+            return self.apply_mask(mask_nodata(self.maps[crop[0]:crop[1], crop[2]:crop[3], l], self.nodata), crop[0], crop[2])
+        return self.apply_mask(mask_nodata(self.maps[:, :, l], self.nodata))
+
+    def pixel(self, i, j):
+        # time series of pixel (line i, column j)
+        data = mask_nodata(self.maps[i, j, :], self.nodata)
+        if(self.mask is not None and self.mask.window(i, i + 1, j, j + 1)[0, 0]):
+            data[:] = np.nan
+        return data
+
+    def window(self, ymin, ymax, xmin, xmax, bands=None):
+        # all maps (or the given band indices) of the window (nlines, ncols, n_img)
+        if(bands is None):
+            return self.apply_mask(mask_nodata(self.maps[ymin:ymax, xmin:xmax, :], self.nodata), ymin, xmin)
+        return self.apply_mask(mask_nodata(self.maps[ymin:ymax, xmin:xmax, bands], self.nodata), ymin, xmin)
+
+    def apply_mask(self, data, ymin=0, xmin=0):
+        if(self.mask is None):
+            return data
+        return self.mask.apply(data, ymin, xmin)
+
+    def read(self, crop=None):
+        # complete cube (or crop extent) in memory, only use if all maps are needed at once
+        if(crop):
+            return self.window(crop[0], crop[1], crop[2], crop[3])
+        return self.window(0, self.nlines, 0, self.ncol)
+
+def save_cube_metadata(dest_path, out_filename, img_data, interleave='bip'):
+    nrow, ncol, nimg = img_data[0], img_data[1], img_data[2]
+
+    # be careful here with ncol, nrow (normal: lines=nrow; samples=ncol)
+    with open(os.path.join(dest_path, '{}.hdr'.format(out_filename)), 'w') as hdr_file:
+        hdr_file.write("ENVI\n")
+        hdr_file.write("samples = {}\n".format(ncol))
+        hdr_file.write("lines = {}\n".format(nrow))
+        hdr_file.write("bands = {}\n".format(nimg))
+        hdr_file.write("header offset = 0\n")
+        hdr_file.write("file type = ENVI Standard\n")
+        hdr_file.write("data type = 4\n")  # 4 represents float32
+        hdr_file.write("interleave = {}".format(interleave)) # add this to display in QGIS and Insar-viz
+
+    # save also .in file to plot pixel
+    with open(os.path.join(dest_path, 'lect_{}.in'.format(out_filename)), 'w') as lect_file:
+        lect_file.write('\t{}\t{}\t{}'.format(ncol, nrow, nimg))
+
+class CubeWriter:
+    # interleave: bip (NSBAS cubes) or bsq (one map after the other)
+    # the data of all write functions is given in the (nlines, ncols) order of the maps, independent of the interleave
+    # mode='r+' opens a cube preallocated by another writer (f.e. in worker processes writing tiles), only call flush() there
+    def __init__(self, dest_path, out_filename, nlines, ncol, n_img, interleave='bip', mode='w+'):
+        self.dest_path, self.out_filename = dest_path, out_filename
+        self.nlines, self.ncol, self.n_img = nlines, ncol, n_img
+        self.interleave = interleave
+
+        if(mode == 'w+'):
+            print('Writing cube {}'.format(out_filename))
+        if(interleave == 'bip'):
+            self.maps = np.memmap(os.path.join(dest_path, out_filename), dtype=np.float32, mode=mode, shape=(nlines, ncol, n_img))
+        elif(interleave == 'bsq'):
+            self.maps = np.memmap(os.path.join(dest_path, out_filename), dtype=np.float32, mode=mode, shape=(n_img, nlines, ncol))
+        else:
+            raise ValueError('Unknown interleave: {} (bip or bsq)'.format(interleave))
+
+    @property
+    def shape(self):
+        return (self.nlines, self.ncol, self.n_img)
+
+    def write_band(self, l, data):
+        # map l of the cube (nlines, ncols)
+        if(self.interleave == 'bip'):
+            self.maps[:, :, l] = data
+        else:
+            self.maps[l, :, :] = data
+
+    def write_window(self, ymin, xmin, data):
+        # all maps of a window (lines, cols, n_img) starting at line ymin and column xmin
+        ymax, xmax = ymin + data.shape[0], xmin + data.shape[1]
+        if(self.interleave == 'bip'):
+            self.maps[ymin:ymax, xmin:xmax, :] = data
+        else:
+            self.maps[:, ymin:ymax, xmin:xmax] = np.moveaxis(data, 2, 0)
+
+    def write_rows(self, ymin, data):
+        # all maps of a block of complete lines (lines, ncols, n_img)
+        self.write_window(ymin, 0, data)
+
+    def flush(self):
+        self.maps.flush()
+
+    def close(self):
+        self.maps.flush()
+        del self.maps
+        save_cube_metadata(self.dest_path, self.out_filename, self.shape, self.interleave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+masks.py
+--------------
+Virtual masks of the correlation results. A mask is saved once per pair as packed bits (1 bit per pixel, compressed .npz)
+in EXPORT/MASKS/<name>/<pair>.npz and applied when the data is read, instead of writing masked copies of the maps.
+True (1) means the pixel is masked (set to NaN).
+
+Usage in the scripts:
+    from aspsar.masks import Mask, save_mask, get_mask_file
+    save_mask(get_mask_file(exp_dir, 'cc_05', pair), bad, {'MIN_CC': 0.5})
+    mask = Mask(get_mask_file(exp_dir, 'cc_05', pair))
+    data = mask.apply(data, y)
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os
+import json
+import numpy as np
+
+#############
+# FUNCTIONS #
+#############
+
+def get_mask_dir(exp_dir, name):
+    return os.path.join(exp_dir, 'MASKS', name)
+
+def get_mask_file(exp_dir, name, pair):
+    return os.path.join(get_mask_dir(exp_dir, name), '{}.npz'.format(pair))
+
+def pack_rows(bad):
+    # bits packed per line, so windows of lines can be unpacked alone
+    return np.packbits(bad.astype(bool), axis=1)
+
+def save_mask_bits(mask_file, bits, shape, metadata={}):
+    # bits: packed lines (see pack_rows) of the mask with shape (nrow, ncol)
+    tmp_file = '{}.tmp'.format(mask_file)
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, bits=bits, shape=np.array(shape), metadata=json.dumps(metadata))
+    os.replace(tmp_file, mask_file)
+
+def save_mask(mask_file, bad, metadata={}):
+    save_mask_bits(mask_file, pack_rows(bad), bad.shape, metadata)
+
+class Mask:
+    def __init__(self, mask_file):
+        with np.load(mask_file) as data:
+            self.bits = data['bits']
+            self.nrow, self.ncol = [int(v) for v in data['shape']]
+            self.metadata = json.loads(str(data['metadata']))
+        self.mask_file = mask_file
+
+    @property
+    def shape(self):
+        return (self.nrow, self.ncol)
+
+    def window(self, ymin, ymax, xmin=0, xmax=None):
+        # boolean mask of the window, True = masked
+        if(xmax is None):
+            xmax = self.ncol
+        rows = np.unpackbits(self.bits[ymin:ymax], axis=1, count=self.ncol).astype(bool)
+        return rows[:, xmin:xmax]
+
+    def read(self):
+        return self.window(0, self.nrow)
+
+    def apply(self, data, ymin=0, xmin=0):
+        # data is a map or window (lines, cols) or a cube window (lines, cols, n_img) starting at ymin, xmin
+        bad = self.window(ymin, ymin + data.shape[0], xmin, xmin + data.shape[1])
+        if(data.ndim == 3):
+            bad = bad[:, :, np.newaxis]
+        return np.where(bad, np.float32(np.nan), data.astype(np.float32))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+process.py
+--------------
+Run a command and measure its resources: wall time, peak memory and I/O.
+Two peaks of the memory are measured:
+    rss_tree_mb     peak of the summed RSS of the process and all its descendants (f.e. the --jobs workers or the correlator processes
+                    of parallel_stereo), sampled every SAMPLE_INTERVAL s from /proc - shorter peaks can be missed,
+                    pages shared by the processes (f.e. after fork) are counted in each process
+    rss_process_mb  peak RSS of the largest single process of the tree (ru_maxrss of wait4), not the sum
+The I/O of /proc/PID/io includes the finished child processes: rchar/wchar (bytes of read/write calls, also served by the page cache,
+not the memory mapped files) and read_bytes/write_bytes (bytes read from/written to the storage, includes the memory mapped files).
+
+Usage in the scripts:
+    from aspsar.process import run_monitored
+    result = run_monitored(cmd, log_file)
+    print(result['exit'], result['time'], result['rss_tree_mb'])
+
+"""
+
+##########
+# IMPORT #
+##########
+
+import os
+import subprocess
+import threading
+import time
+
+#############
+# FUNCTIONS #
+#############
+
+SAMPLE_INTERVAL = 0.2
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+def read_proc_stats():
+    # ppid and RSS (bytes) of all processes
+    stats = {}
+    for d in os.listdir('/proc'):
+        if(not d.isdigit()):
+            continue
+        try:
+            with open('/proc/{}/stat'.format(d), 'r') as f:
+                stat = f.read()
+        except OSError:
+            # process finished in the meantime
+            continue
+        # the command name can contain spaces, the fields start after the last ')'
+        fields = stat[stat.rfind(')') + 2:].split()
+        stats[int(d)] = (int(fields[1]), int(fields[21]) * PAGE_SIZE)
+    return stats
+
+def get_tree_rss(pid, stats):
+    # summed RSS of the process and its descendants
+    children = {}
+    for p, (ppid, rss) in stats.items():
+        children.setdefault(ppid, []).append(p)
+    total, todo = 0, [pid]
+    while(todo):
+        p = todo.pop()
+        if(p in stats):
+            total += stats[p][1]
+        todo += children.get(p, [])
+    return total
+
+class TreeRSSMonitor(threading.Thread):
+    # samples the summed RSS of the process tree until stop() is called
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid, self.interval = pid, interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while(not self.done.is_set()):
+            self.peak = max(self.peak, get_tree_rss(self.pid, read_proc_stats()))
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+def read_proc_io(pid):
+    # I/O counters of the process and its finished child processes
+    io = {}
+    with open('/proc/{}/io'.format(pid), 'r') as f:
+        for l in f:
+            key, value = l.split(':')
+            io[key.strip()] = int(value)
+    return dict((k, io.get(k)) for k in IO_FIELDS)
+
+def run_monitored(cmd, log_file, env=None, interval=SAMPLE_INTERVAL):
+    # runs cmd (list), its output goes to log_file, returns exit code, wall time (s), memory peaks (MB), CPU times (s) and I/O (bytes)
+    with open(log_file, 'w') as log:
+        start = time.time()
+        p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env if env is not None else os.environ)
+        monitor = TreeRSSMonitor(p.pid, interval)
+        monitor.start()
+        # wait for the end of the process without reaping it, /proc/PID/io is readable until wait4
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        wall_time = time.time() - start
+        monitor.stop()
+        try:
+            io = read_proc_io(p.pid)
+        except OSError:
+            io = dict((k, None) for k in IO_FIELDS)
+        _, status, rusage = os.wait4(p.pid, 0)
+    # the process is already waited for, set the exit code for Popen
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kB on Linux, the process itself is at least as large as the largest process
+    rss_process = rusage.ru_maxrss / 1024.
+    return dict({'exit': p.returncode, 'time': wall_time, 'rss_tree_mb': max(monitor.peak / 1024. ** 2, rss_process), 'rss_process_mb': rss_process,
+                 'user_time': rusage.ru_utime, 'sys_time': rusage.ru_stime}, **io)
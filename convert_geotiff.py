@@ -4,15 +4,23 @@
 convert_geotiff.py
 ------------
 Converts the ALL2GIF results to GeoTIFF. It takes the log() of the input image.
-An additional file is created (AMPLI_STACK_SIGMA_3.tif) with mean, 1/sigma and sigma as bands.
+Additional files are created with the mean and sigma of the amplitude stack (AMPLI_MEAN, AMPLI_SIGMA, AMPLI_dSIMGA, AMPLI_MEAN_NORM, AMPLI_SIGMA_NORM).
+The running moments of the stack are kept in GEOTIFF/AMPLI_MOMENTS.npy|.json together with the size and modification time of each included image.
+Added or excluded images are added to or removed from the moments without reading the other images again.
 
-Usage: prepare_correl_dir.py --data=<path> [--f]
+Usage: prepare_correl_dir.py --data=<path> [--f] [--jobs=<value>] [--block=<value>] [--compress] [--dtype=<value>] [--exclude=<path>] [--report=<path>]
 prepare_correl_dir.py -h | --help
 
 Options:
 -h | --help         Show this screen
 --data              Path to directory with linked data
 --f                 Force recomputation of all files
+--jobs              Number of images converted at the same time [Default: 1]
+--block             Number of lines converted at once, the .mod files are streamed block by block [Default: 512]
+--compress          Write DEFLATE compressed GeoTIFFs
+--dtype             Precision of the running moments of the amplitude stack, float32 or float64 [Default: float64]
+--exclude           Path to text file with dates (YYYYMMDD, one per line) to exclude from the amplitude stack statistics
+--report            Path to report of check_all2gif.py, the dates with bad .mod files are not converted and excluded from the statistics
 
 """
 ##########
@@ -27,6 +35,10 @@ from pathlib import Path
 from math import *
 import docopt
 import shutil
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from aspsar.catalog import get_catalogs, get_mod_entry, get_bad_dates
 
 #############
 # FUNCTIONS #
@@ -38,7 +50,7 @@ def save_to_file(data, output_path, ncol, nrow):
     dst_band = dst_ds.GetRasterBand(1)
     dst_band.WriteArray(data)
 
-def convert_single_file(input_file, img_dim):
+def convert_single_file(input_file, img_dim, block_rows=512, compress=False):
 
     # AT ONE POINT: CHECK VARIABLES AND PATHS - NECESSARY?
     # filename is linked file
@@ -50,36 +62,45 @@ def convert_single_file(input_file, img_dim):
     ncol, nrow = img_dim[0], img_dim[1]
 ## prepare conversion
 
-    # read image
-    m = np.fromfile(input_file,dtype=np.float32)
-    amp = m[:nrow*ncol].reshape((nrow,ncol))
+    # map image instead of reading it, only block_rows lines are in memory at once
+    m = np.memmap(input_file, dtype=np.float32, mode='r', shape=(nrow, ncol))
 
 # get log of amplitude 
 
     output_path_log = os.path.join(geotiff_dir, '{}_log.tif'.format(os.path.basename(input_file)))    
-    amp[amp>0] = np.log(amp[amp>0])
+    # write to temporary file first, an interrupted conversion must not be skipped in the next run
+    tmp_path = '{}.tmp'.format(output_path_log)
 
-    save_to_file(amp, output_path_log, ncol, nrow)
+    options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'BIGTIFF=IF_SAFER']
+    if(compress):
+        # floating point predictor for REAL4 data
+        options += ['COMPRESS=DEFLATE', 'PREDICTOR=3']
+
+    drv = gdal.GetDriverByName('GTiff')
+    dst_ds = drv.Create(tmp_path, ncol, nrow, 1, gdal.GDT_Float32, options=options)
+    dst_band = dst_ds.GetRasterBand(1)
+
+    for y in range(0, nrow, block_rows):
+        amp = np.array(m[y:y+block_rows])
+        amp[amp>0] = np.log(amp[amp>0])
+        dst_band.WriteArray(amp, 0, y)
+
+    dst_band.FlushCache()
+    dst_band, dst_ds = None, None
+    del m
+
+    os.replace(tmp_path, output_path_log)
 
     print('Done processing: {}'.format(filename))
 
 
 # get the dimensions of the coregistered images
-def get_img_dimensions(input_file):
-    real_path = os.path.realpath(input_file)
-    i12_path = os.path.dirname(os.path.dirname(real_path))
-    insar_param_file = os.path.join(i12_path, 'TextFiles', 'InSARParameters.txt')
-    
-    #print('InSAR file: {}'.format(insar_param_file))
-    with open(insar_param_file, 'r') as f:
-        # read lines of file and remove whitespace and comments (comments after \t\t)
-        lines = [''.join(l.strip().split('\t\t')[0]) for l in f.readlines()]
-        #print(lines)
-        jump_index = lines.index('/* -5- Interferometric products computation */')
-        img_dim = lines[jump_index + 2: jump_index + 4]
-        #print(img_dim)
-
-    ncol, nrow = int(img_dim[0].strip()), int(img_dim[1].strip())
+def get_img_dimensions(input_file, catalogs):
+    # dimensions of the ALL2GIF result of the linked .mod file, from the catalog of its ALL2GIF directory (aspsar.catalog)
+    entry = get_mod_entry(catalogs, input_file)
+    if(entry is None):
+        return (0, 0, False)
+    ncol, nrow = entry['ncol'], entry['nrow']
     #print(input_file, ncol, nrow)
     
     # return results as tupels with bool flag, True if dimensions != 0
@@ -89,59 +110,171 @@ def get_img_dimensions(input_file):
         return (ncol, nrow, True)
 
 
-def get_mean_sigma_amplitude(geotiff_dir, img_dim, corrupt_file_df):
+## AMPLITUDE STACK STATISTICS ##
+# the stack statistics are computed with running moments (Welford) for each pixel: count, mean, M2 (sum of squared differences)
+# for the amplitude and the amplitude normalized by the mean of its image
+# moments are stored in AMPLI_MOMENTS.npy (5, nrow, ncol), the included images in AMPLI_MOMENTS.json
 
+def load_moments(geotiff_dir, img_dim, dtype):
+    ncol, nrow = img_dim[0], img_dim[1]
+    moments_file = os.path.join(geotiff_dir, 'AMPLI_MOMENTS.npy')
+    info_file = os.path.join(geotiff_dir, 'AMPLI_MOMENTS.json')
+
+    if(os.path.isfile(info_file) and os.path.isfile(moments_file)):
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        # moments of an interrupted update are not usable
+        if(info['complete'] and info['ncol'] == ncol and info['nrow'] == nrow and info['dtype'] == dtype):
+            return (np.load(moments_file, mmap_mode='r+'), info)
+        print('AMPLI_MOMENTS can not be updated, recompute them')
+
+    moments = np.lib.format.open_memmap(moments_file, mode='w+', dtype=dtype, shape=(5, nrow, ncol))
+    info = {'ncol': ncol, 'nrow': nrow, 'dtype': dtype, 'complete': True, 'files': {}}
+    return (moments, info)
+
+def save_moments_info(geotiff_dir, info):
+    info_file = os.path.join(geotiff_dir, 'AMPLI_MOMENTS.json')
+    with open('{}.tmp'.format(info_file), 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace('{}.tmp'.format(info_file), info_file)
+
+def update_welford(count, mean, m2, x, valid):
+    # add x to the running moments where valid, arrays are updated in place
+    c = count[valid] + 1
+    delta = x[valid] - mean[valid]
+    new_mean = mean[valid] + delta / c
+    m2[valid] = m2[valid] + delta * (x[valid] - new_mean)
+    mean[valid] = new_mean
+    count[valid] = c
+
+def remove_welford(count, mean, m2, x, valid):
+    # remove x, that was added before, from the running moments where valid, arrays are updated in place
+    c = count[valid] - 1
+    delta = x[valid] - mean[valid]
+    new_mean = np.where(c > 0, mean[valid] - delta / np.maximum(c, 1), 0)
+    m2[valid] = np.where(c > 0, np.maximum(m2[valid] - delta * (x[valid] - new_mean), 0), 0)
+    mean[valid] = new_mean
+    count[valid] = c
+
+def get_file_fingerprint(input_file):
+    stat = os.stat(input_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def get_image_mean(ds_band, ncol, nrow, block_rows):
+    # same as np.nanmean of the full image, but read block by block
+    total, n = 0.0, 0
+    for y in range(0, nrow, block_rows):
+        amp = ds_band.ReadAsArray(0, y, ncol, min(block_rows, nrow - y))
+        finite = np.isfinite(amp)
+        total += np.sum(amp[finite], dtype=np.float64)
+        n += np.count_nonzero(finite)
+    return total / n
+
+# remove=True subtracts the image again, img_mean has to be the mean used when it was added
+def add_image_to_moments(moments, input_file, img_dim, block_rows, remove=False, img_mean=None):
     ncol, nrow = img_dim[0], img_dim[1]
-    stack, sigma, weight = np.zeros((nrow, ncol)), np.zeros((nrow, ncol)), np.zeros((nrow, ncol))
-    stack_norm, sigma_norm = np.zeros((nrow, ncol)), np.zeros((nrow, ncol))
+    ds = gdal.OpenEx(input_file, allowed_drivers=['GTiff'])
+    ds_band = ds.GetRasterBand(1)
 
-    for f in os.listdir(geotiff_dir):
-        # just use DATE.VV.mod_log.tif images; important if AMPLI_STACK_SIGMA was already calculated
-        if(f in corrupt_file_df['file'].values):
-            print('Skip: {}'.format(f))    
-        else:
-            #if(len(f.split('.')[0]) == 8):
-            if('.mod_log.tif' in f):
-                print('Start: {}'.format(f))
-        # change to read data with gdal
-                ds = gdal.OpenEx(os.path.join(geotiff_dir, f), allowed_drivers=['GTiff'])
-                ds_band = ds.GetRasterBand(1)
-        
-        # geotiff data contains log of amplitude
-                amp = ds_band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-        
-                stack = stack + amp
-                sigma = sigma + amp**2
-            
-                stack_norm = stack_norm + (amp / np.nanmean(amp))
-                sigma_norm = sigma_norm + (amp / np.nanmean(amp))**2
-
-        # weight == N
-        # weight is a matrix -> have the N information for every pixel
-                w = np.zeros((nrow, ncol))
-                index = np.nonzero(amp)
-        # if img is empty/NaN, will not be added to N(weight)
-                w[index] = 1
-                weight = weight + w
-                print('Finished: {}'.format(f))
-
-    # compute mean of amplitude stack and sigma
-    # mean_stack = stack / N_img (weight)
-    stack[weight > 0] = stack[weight > 0] / weight[weight > 0]
-    sigma[weight > 0] = np.sqrt(sigma[weight > 0] / weight[weight > 0] - (stack[weight > 0])**2)
-    da = np.zeros((nrow, ncol))
-    da[sigma > 0] = 1./sigma[sigma > 0]
-   
-    #stack_norm[weight > 0] = stack[weight > 0] / np.nanmean(stack[weight > 0])
-    stack_norm[weight > 0] = stack_norm[weight > 0] / weight[weight > 0]
-    sigma_norm[weight > 0] = np.sqrt(sigma_norm[weight > 0] / weight[weight > 0] - stack_norm[weight > 0]**2)
-
-    save_to_file(stack, os.path.join(geotiff_dir, 'AMPLI_MEAN.tif'), ncol, nrow)
-    save_to_file(sigma, os.path.join(geotiff_dir, 'AMPLI_SIGMA.tif'), ncol, nrow)
-    save_to_file(da, os.path.join(geotiff_dir, 'AMPLI_dSIMGA.tif'), ncol, nrow)
-
-    save_to_file(stack_norm, os.path.join(geotiff_dir, 'AMPLI_MEAN_NORM.tif'), ncol, nrow)
-    save_to_file(sigma_norm, os.path.join(geotiff_dir, 'AMPLI_SIGMA_NORM.tif'), ncol, nrow)
+    # geotiff data contains log of amplitude
+    if(img_mean is None):
+        img_mean = get_image_mean(ds_band, ncol, nrow, block_rows)
+    welford = remove_welford if(remove) else update_welford
+
+    for y in range(0, nrow, block_rows):
+        rows = min(block_rows, nrow - y)
+        amp = ds_band.ReadAsArray(0, y, ncol, rows).astype(moments.dtype)
+        # if img is empty/NaN, will not be added to N
+        valid = np.isfinite(amp) & (amp != 0)
+
+        block = moments[:, y:y+rows, :]
+        # normalized moments share the count
+        count = np.array(block[0])
+        welford(block[0], block[1], block[2], amp, valid)
+        welford(count, block[3], block[4], amp / img_mean, valid)
+
+    return img_mean
+
+def save_stack_statistics(moments, geotiff_dir, img_dim, block_rows):
+    ncol, nrow = img_dim[0], img_dim[1]
+    names = ['AMPLI_MEAN', 'AMPLI_SIGMA', 'AMPLI_dSIMGA', 'AMPLI_MEAN_NORM', 'AMPLI_SIGMA_NORM']
+
+    drv = gdal.GetDriverByName('GTiff')
+    dst_ds = [drv.Create(os.path.join(geotiff_dir, '{}.tif'.format(n)), ncol, nrow, 1, gdal.GDT_Float32) for n in names]
+
+    for y in range(0, nrow, block_rows):
+        block = np.array(moments[:, y:y+block_rows, :], dtype=np.float64)
+        count, mean, m2, mean_norm, m2_norm = block[0], block[1], block[2], block[3], block[4]
+        weight = count > 0
+
+        sigma, sigma_norm = np.zeros(count.shape), np.zeros(count.shape)
+        sigma[weight] = np.sqrt(m2[weight] / count[weight])
+        sigma_norm[weight] = np.sqrt(m2_norm[weight] / count[weight])
+        da = np.zeros(count.shape)
+        da[sigma > 0] = 1./sigma[sigma > 0]
+
+        for ds, data in zip(dst_ds, [mean, sigma, da, mean_norm, sigma_norm]):
+            ds.GetRasterBand(1).WriteArray(data, 0, y)
+
+    for ds in dst_ds:
+        ds.FlushCache()
+
+def get_mean_sigma_amplitude(geotiff_dir, img_dim, corrupt_file_df, block_rows=512, dtype='float64', exclude_dates=[]):
+
+    # just use DATE.VV.mod_log.tif images; important if AMPLI_STACK_SIGMA was already calculated
+    stack_files = []
+    for f in sorted(os.listdir(geotiff_dir)):
+        if(f.endswith('.mod_log.tif')):
+            if(f[:-len('_log.tif')] in corrupt_file_df['file'].values or f.split('.')[0] in exclude_dates):
+                print('Skip: {}'.format(f))
+            else:
+                stack_files += [f]
+
+    moments, info = load_moments(geotiff_dir, img_dim, dtype)
+
+    # images in the moments that are not part of the stack anymore
+    # they can only be subtracted if they are unchanged on disk, otherwise recompute everything
+    removed_files = [f for f in info['files'] if f not in stack_files]
+    changed_files = [f for f in info['files'] if not os.path.isfile(os.path.join(geotiff_dir, f)) or get_file_fingerprint(os.path.join(geotiff_dir, f)) != {k: info['files'][f].get(k) for k in ['size', 'mtime']}]
+    if(changed_files):
+        print('Images were deleted or changed ({}), recompute AMPLI_MOMENTS'.format(', '.join(changed_files)))
+        del moments
+        os.remove(os.path.join(geotiff_dir, 'AMPLI_MOMENTS.npy'))
+        moments, info = load_moments(geotiff_dir, img_dim, dtype)
+        removed_files = []
+
+    new_files = [f for f in stack_files if f not in info['files']]
+    print('{} images in AMPLI_MOMENTS, add {} and remove {} images'.format(len(info['files']), len(new_files), len(removed_files)))
+
+    if(new_files or removed_files):
+        # mark moments as incomplete during the update, an interrupted update is recomputed in the next run
+        info['complete'] = False
+        info['saved'] = False
+        save_moments_info(geotiff_dir, info)
+
+        for f in removed_files:
+            print('Remove: {}'.format(f))
+            add_image_to_moments(moments, os.path.join(geotiff_dir, f), img_dim, block_rows, remove=True, img_mean=info['files'][f]['mean'])
+            del info['files'][f]
+
+        for f in new_files:
+            print('Start: {}'.format(f))
+            img_mean = add_image_to_moments(moments, os.path.join(geotiff_dir, f), img_dim, block_rows)
+            info['files'][f] = dict(get_file_fingerprint(os.path.join(geotiff_dir, f)), mean=img_mean)
+            print('Finished: {}'.format(f))
+
+        moments.flush()
+        info['complete'] = True
+        save_moments_info(geotiff_dir, info)
+
+    names = ['AMPLI_MEAN', 'AMPLI_SIGMA', 'AMPLI_dSIMGA', 'AMPLI_MEAN_NORM', 'AMPLI_SIGMA_NORM']
+    if(info.get('saved') and all([os.path.isfile(os.path.join(geotiff_dir, '{}.tif'.format(n))) for n in names])):
+        print('AMPLI_MEAN and SIGMA are up to date')
+        return
+
+    save_stack_statistics(moments, geotiff_dir, img_dim, block_rows)
+    info['saved'] = True
+    save_moments_info(geotiff_dir, info)
 
 ########
 # MAIN #
@@ -154,6 +287,37 @@ all_file_df = pd.DataFrame(columns=['file', 'ncol', 'nrow'])
 
 force = arguments['--f']
 
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
+
+if(arguments['--block']):
+    block_rows = int(arguments['--block'])
+else:
+    block_rows = 512
+
+compress = arguments['--compress']
+
+if(arguments['--dtype']):
+    dtype = arguments['--dtype']
+else:
+    dtype = 'float64'
+
+if(arguments['--exclude']):
+    with open(arguments['--exclude'], 'r') as f:
+        exclude_dates = [l.strip() for l in f.readlines() if l.strip()]
+else:
+    exclude_dates = []
+
+# bad dates found by check_all2gif.py
+if(arguments['--report']):
+    bad_dates = get_bad_dates(arguments['--report'])
+    print('Skip {} dates of report {}'.format(len(bad_dates), arguments['--report']))
+    exclude_dates += bad_dates
+else:
+    bad_dates = []
+
 geotiff_dir = os.path.join(input_path, 'GEOTIFF')
 
 if(force):
@@ -162,13 +326,16 @@ if(force):
 # create GEOTIFF directory
 Path(geotiff_dir).mkdir(parents=True, exist_ok=True)
 
-for f in os.listdir(input_path):
-    if(os.path.splitext(f)[1] == '.mod'):
-        img_dims = get_img_dimensions(os.path.join(input_path, f))
-        # if true, dimensions found and use them for processing, else continue
-        # bc all images have same dimension after ALL2GIF processing
-        new_row = pd.DataFrame([{'file': f, 'ncol': img_dims[0], 'nrow': img_dims[1]}])
-        all_file_df = pd.concat([all_file_df, new_row], ignore_index=True)
+# dimensions of all images from the catalogs of their ALL2GIF directories, instead of parsing each InSARParameters.txt
+mod_files = [f for f in os.listdir(input_path) if os.path.splitext(f)[1] == '.mod' and f.split('.')[0] not in bad_dates]
+catalogs = get_catalogs([os.path.join(input_path, f) for f in mod_files])
+
+for f in mod_files:
+    img_dims = get_img_dimensions(os.path.join(input_path, f), catalogs)
+    # if true, dimensions found and use them for processing, else continue
+    # bc all images have same dimension after ALL2GIF processing
+    new_row = pd.DataFrame([{'file': f, 'ncol': img_dims[0], 'nrow': img_dims[1]}])
+    all_file_df = pd.concat([all_file_df, new_row], ignore_index=True)
         
 # more stable way to get image dimension, get value with most occurences for ncol and nrow as final values
 # after this - use values to find images with different dimensions
@@ -194,19 +361,30 @@ print('START CONVERSION')
 print('############################')
 
 # only process non existing files 
-for f in os.listdir(input_path):
-    if(os.path.splitext(f)[1] == '.mod'):
-        if(os.path.isfile(os.path.join(geotiff_dir, '{}_log.tif'.format(f)))):
+convert_list = []
+# bad dates of the check_all2gif.py report are already removed from mod_files
+for f in mod_files:
+    if(os.path.isfile(os.path.join(geotiff_dir, '{}_log.tif'.format(f)))):
+        continue
+    else:
+        # if file has different extent - skip
+        if(f in corrupt_file_df['file'].values):
             continue
         else:
-            # if file has different extent - skip
-            if(f in corrupt_file_df['file'].values):
-                continue
-            else:
-                print('Start processing: {}'.format(f))
-                convert_single_file(os.path.join(input_path, f), IMG_DIM)
+            convert_list += [os.path.join(input_path, f)]
+
+if(jobs > 1):
+    # fork: the workers only need the functions of this script
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(convert_single_file, f, IMG_DIM, block_rows, compress) for f in convert_list]
+        for f in futures:
+            f.result()
+else:
+    for f in convert_list:
+        print('Start processing: {}'.format(os.path.basename(f)))
+        convert_single_file(f, IMG_DIM, block_rows, compress)
 
 
-# process AMPLI_STACK_SIGMA each time to always include all images
+# update AMPLI_STACK_SIGMA each time to always include all images
 print('Start AMPLI_MEAN and SIGMA calculation')
-get_mean_sigma_amplitude(os.path.join(input_path, 'GEOTIFF'), IMG_DIM, corrupt_file_df)    
+get_mean_sigma_amplitude(os.path.join(input_path, 'GEOTIFF'), IMG_DIM, corrupt_file_df, block_rows, dtype, exclude_dates)    
@@ -30,6 +30,7 @@ import shutil
 from dateutil import parser
 import docopt
 from matplotlib import pyplot as plt
+from aspsar.cube import CubeWriter
 
 
 #############
@@ -44,48 +45,20 @@ def get_image_dimension(data_path, bil_files):
 
     return (nrow, ncol, nimg)
 
-def build_cube(data_path, bil_files, maps, img_data):
+def build_cube(data_path, bil_files, writer, img_data):
     nrow, ncol, nimg = img_data[0], img_data[1], img_data[2]
 
     for i in range(nimg):
         curr_name = bil_files[i].split('.')[1]
         print('Read {}'.format(curr_name))
 
-    # read image
-        m = np.fromfile(os.path.join(data_path, bil_files[i]),dtype=np.float32)
-        map_i = m[:nrow*ncol].reshape((nrow,ncol))
+        # read image and write it directly in the cube file
+        map_i = np.memmap(os.path.join(data_path, bil_files[i]), dtype=np.float32, mode='r', shape=(nrow, ncol))
 
-        maps[:,:,i] = map_i[:,:]
+        writer.write_band(i, map_i)
 
         del map_i
 
-    return maps
-
-def save_cube(dest_path, out_filename, maps):
-    print('Writing cube')
-
-    fid = open(os.path.join(dest_path, out_filename), 'wb')
-    maps[:,:,:].flatten().astype('float32').tofile(fid)
-    fid.close()
-
-def save_cube_metadata(dest_path, out_filename, img_data):
-    nrow, ncol, nimg = img_data[0], img_data[1], img_data[2]
-
-    # be careful here with ncol, nrow (normal: lines=nrow; samples=ncol)
-    with open(os.path.join(dest_path, '{}.hdr'.format(out_filename)), 'w') as hdr_file:
-        hdr_file.write("ENVI\n")
-        hdr_file.write("samples = {}\n".format(ncol))
-        hdr_file.write("lines = {}\n".format(nrow))
-        hdr_file.write("bands = {}\n".format(nimg))
-        hdr_file.write("header offset = 0\n")
-        hdr_file.write("file type = ENVI Standard\n")
-        hdr_file.write("data type = 4\n")  # 4 represents float32, adjust if needed
-        hdr_file.write("interleave = bip") # add this to display in QGIS and Insar-viz
-
-    # save also .in file to plot pixel
-    with open(os.path.join(dest_path, 'lect_{}.in'.format(out_filename)), 'w') as lect_file:
-        lect_file.write('\t{}\t{}\t{}'.format(ncol, nrow, nimg))
-
 ########
 # MAIN #
 ########
@@ -113,13 +86,7 @@ bil_files = sorted([f for f in os.listdir(data_path) if os.path.splitext(f)[1] =
 # get information for building cube -> ncol, nrow, nimg
 img_data = get_image_dimension(data_path, bil_files)
 
-# init cube structure
-#maps = np.zeros((nrow, ncol, nimg))
-maps = np.zeros(img_data)
-
-# get data from files and save in maps
-maps = build_cube(data_path, bil_files, maps, img_data)
-
-# save cube and additional files (.hdr, lect_geocoded.in)
-save_cube(dest_path, out_filename, maps)
-save_cube_metadata(dest_path, out_filename, img_data)
+# get data from files and save them map by map in the cube file
+# additional files (.hdr, lect_geocoded.in) are written when the cube is closed
+with CubeWriter(dest_path, out_filename, img_data[0], img_data[1], img_data[2]) as writer:
+    build_cube(data_path, bil_files, writer, img_data)
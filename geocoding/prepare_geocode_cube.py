@@ -23,34 +23,24 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
 import pandas as pd
 from pathlib import Path
 import shutil
 from dateutil import parser
 import docopt
+from aspsar.cube import Cube
 
 
 #############
 # FUNCTIONS #
 #############
 
-def save_single_map(output_dir, filename, maps):
+def save_single_map(output_dir, filename, single_map):
     fid = open(os.path.join(output_dir, filename), 'wb')
-    maps[:,:,l].flatten().astype('float32').tofile(fid)
+    single_map.astype('float32').tofile(fid)
     fid.close()
 
-def read_cube(cube_file, ncol, nlines, n_img):
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
-    
-    return maps
 
 ########
 # MAIN #
@@ -104,8 +94,8 @@ else:
 dates_df = pd.read_csv(os.path.join(data_path, 'list_dates'), sep=' ', header=None)
 dates = list(dates_df.iloc[:,0])
 
-# read cube file
-maps = read_cube(cube_file, ncol, nlines, n_img)
+# open cube file, maps are read one by one
+cube = Cube(cube_file, ncol, nlines, n_img)
 
 # save individual map
 for l in range(n_img):
@@ -116,7 +106,7 @@ for l in range(n_img):
         filename = 'REGEOC.{}_{}_{}.r4'.format(direction_name, os.path.basename(cube_file), curr_date)
     print('saving: {}'.format(filename))
 
-    save_single_map(output_dir, filename, maps) 
+    save_single_map(output_dir, filename, cube.band(l)) 
 
 
 
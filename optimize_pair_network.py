@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+optimize_pair_network.py
+------------
+Analyse the pair network of a MasTer pair table (table_*.txt, prepa_MSBAS.sh) and propose a pruned pair list before the correlation with process_stereo.py.
+The dates are the nodes and the pairs the edges of the network. Connectivity (connected components), degree of the dates and redundancy are reported.
+With --budget, pairs are removed until the budget is reached: a minimum spanning tree of each component is kept (the network stays connected as before),
+then the dates get pairs until they have --min_degree pairs, the remaining budget is filled with the pairs with the lowest weight.
+The weight of a pair is Bt/max(Bt) + |Bp|/max(|Bp|), short temporal and perpendicular baselines are preferred.
+
+Usage: optimize_pair_network.py --pairs=<path> [--budget=<value>] [--min_degree=<value>] [--out=<path>] [--report=<path>]
+optimize_pair_network.py -h | --help
+
+Options:
+-h | --help         Show this screen
+--pairs             Path to pair table (MasTer format, table_*.txt)
+--budget            Number of pairs to keep, or fraction of the pairs if <= 1 (f.e. 0.6). Without budget only the report is printed
+--min_degree        Minimal number of pairs of each date in the pruned network (if the date has enough pairs) [default: 2]
+--out               Path to pruned pair table [default: PAIRS_pruned.txt]
+--report            Path to report of the dates (tab separated: date, number of pairs before and after pruning)
+
+"""
+##########
+# IMPORT #
+##########
+
+import os, sys
+import numpy as np
+import pandas as pd
+import datetime
+import docopt
+
+#############
+# FUNCTIONS #
+#############
+
+def read_pair_table(pair_table):
+    # returns the header lines and the data lines of the table (kept as in the file) with the pairs DataFrame (date1, date2, bp)
+    with open(pair_table, 'r') as f:
+        lines = f.readlines()
+
+    # header and empty line of prepa_MSBAS.sh
+    header = lines[:2]
+    data_lines = [l for l in lines[2:] if l.strip()]
+    values = [l.split() for l in data_lines]
+    pair_df = pd.DataFrame({'date1': [str(v[0]) for v in values], 'date2': [str(v[1]) for v in values], 'bp': [float(v[2]) for v in values]})
+
+    return (header, data_lines, pair_df)
+
+def get_weights(pair_df):
+    # Bt/max(Bt) + |Bp|/max(|Bp|)
+    bt = np.array([abs((datetime.datetime.strptime(d2, '%Y%m%d') - datetime.datetime.strptime(d1, '%Y%m%d')).days) for d1, d2 in zip(pair_df['date1'], pair_df['date2'])], dtype=float)
+    bp = np.abs(pair_df['bp'].values)
+    return bt / max(bt.max(), 1) + bp / max(bp.max(), 1)
+
+class UnionFind:
+    def __init__(self, nodes):
+        self.parent = dict((n, n) for n in nodes)
+
+    def find(self, n):
+        root = n
+        while(self.parent[root] != root):
+            root = self.parent[root]
+        # path compression
+        while(self.parent[n] != root):
+            self.parent[n], n = root, self.parent[n]
+        return root
+
+    def union(self, a, b):
+        # returns False if a and b are already connected
+        ra, rb = self.find(a), self.find(b)
+        if(ra == rb):
+            return False
+        self.parent[rb] = ra
+        return True
+
+def get_dates(pair_df):
+    return sorted(set(pair_df['date1']) | set(pair_df['date2']))
+
+def get_components(dates, edges):
+    # connected components (list of date lists, largest first)
+    uf = UnionFind(dates)
+    for d1, d2 in edges:
+        uf.union(d1, d2)
+    components = {}
+    for d in dates:
+        components.setdefault(uf.find(d), []).append(d)
+    return sorted(components.values(), key=len, reverse=True)
+
+def get_degrees(dates, edges):
+    degrees = dict((d, 0) for d in dates)
+    for d1, d2 in edges:
+        degrees[d1] += 1
+        degrees[d2] += 1
+    return degrees
+
+def print_network_report(name, dates, edges, min_degree):
+    components = get_components(dates, edges)
+    degrees = np.array(list(get_degrees(dates, edges).values()))
+    # independent cycles of the network, 0 for a tree (no redundancy)
+    cycles = len(edges) - len(dates) + len(components)
+
+    print('{}: {} dates, {} pairs'.format(name, len(dates), len(edges)))
+    print('  connected components: {} (sizes {})'.format(len(components), ', '.join([str(len(c)) for c in components])))
+    print('  pairs per date: min {}, median {:.0f}, max {}'.format(degrees.min(), np.median(degrees), degrees.max()))
+    print('  redundancy: {} independent cycles, {:.2f} pairs per spanning tree pair'.format(cycles, len(edges) / max(len(dates) - len(components), 1)))
+    print('  dates with less than {} pairs: {}'.format(min_degree, int(np.sum(degrees < min_degree))))
+    if(len(components) > 1):
+        for c in components[1:]:
+            print('  not connected to the main network: {}'.format(', '.join(c)))
+
+def prune_network(pair_df, budget, min_degree):
+    # returns the indices of the kept pairs (in the order of the table)
+    dates = get_dates(pair_df)
+    weights = get_weights(pair_df)
+    order = np.argsort(weights, kind='stable')
+    edges = list(zip(pair_df['date1'], pair_df['date2']))
+
+    # minimum spanning tree of each component (Kruskal), keeps the connectivity of the network
+    uf = UnionFind(dates)
+    keep = set([i for i in order if uf.union(edges[i][0], edges[i][1])])
+
+    # minimum degree, cheapest pairs of the dates with too few pairs first
+    degrees = get_degrees(dates, [edges[i] for i in keep])
+    for i in order:
+        d1, d2 = edges[i]
+        if(i not in keep and (degrees[d1] < min_degree or degrees[d2] < min_degree)):
+            keep.add(i)
+            degrees[d1] += 1
+            degrees[d2] += 1
+
+    if(len(keep) > budget):
+        print('Connectivity and minimum degree need {} pairs, more than the budget of {} pairs'.format(len(keep), budget))
+
+    # fill the budget with the cheapest remaining pairs
+    for i in order:
+        if(len(keep) >= budget):
+            break
+        keep.add(i)
+
+    return sorted(keep)
+
+def save_pair_table(out_file, header, data_lines, keep):
+    # same format as the input table, only the kept lines
+    with open(out_file, 'w') as f:
+        f.writelines(header)
+        f.writelines([data_lines[i] for i in keep])
+
+def save_date_report(report_file, dates, edges, kept_edges):
+    degrees, kept_degrees = get_degrees(dates, edges), get_degrees(dates, kept_edges)
+    report = pd.DataFrame({'DATE': dates, 'PAIRS': [degrees[d] for d in dates], 'PAIRS_PRUNED': [kept_degrees[d] for d in dates]})
+    report.to_csv(report_file, sep='\t', index=False)
+
+########
+# MAIN #
+########
+
+arguments = docopt.docopt(__doc__)
+
+pair_table = arguments['--pairs']
+
+if(arguments['--min_degree']):
+    min_degree = int(arguments['--min_degree'])
+else:
+    min_degree = 2
+
+if(arguments['--out']):
+    out_file = arguments['--out']
+else:
+    out_file = '{}_pruned.txt'.format(os.path.splitext(pair_table)[0])
+
+header, data_lines, pair_df = read_pair_table(pair_table)
+dates = get_dates(pair_df)
+edges = list(zip(pair_df['date1'], pair_df['date2']))
+
+print_network_report('Pair table', dates, edges, min_degree)
+
+kept_edges = edges
+if(arguments['--budget']):
+    budget = float(arguments['--budget'])
+    if(budget <= 1):
+        budget = int(round(budget * len(edges)))
+    budget = int(budget)
+
+    keep = prune_network(pair_df, budget, min_degree)
+    kept_edges = [edges[i] for i in keep]
+
+    print_network_report('Pruned network', dates, kept_edges, min_degree)
+    print('Keep {} of {} pairs ({:.0f}% removed)'.format(len(keep), len(edges), 100 * (1 - len(keep) / len(edges))))
+
+    save_pair_table(out_file, header, data_lines, keep)
+    print('Pruned pair table saved in {}'.format(out_file))
+
+if(arguments['--report']):
+    save_date_report(arguments['--report'], dates, edges, kept_edges)
@@ -4,6 +4,8 @@
 prepare_correl_dir.py
 --------------
 Prepare the directory structure for further processing. Link all ALL2GIF results in the given destination dir.
+Dimensions, sampling and .mod files of the ALL2GIF results are read from the catalog ALL2GIF_DIR/aspsar_catalog.sqlite (aspsar.catalog),
+only new or changed result directories are read again.
 
 Usage: prepare_correl_dir.py --data=<path> --dest=<path> [--u] 
 prepare_correl_dir.py -h | --help
@@ -28,56 +30,25 @@ import re
 from pathlib import Path
 from init_asp_parameters import init_asp_parameters 
 import docopt
+from aspsar.catalog import Catalog
 
 #############
 # FUNCTIONS #
 #############
 
-def filter_mod_files(input_file):
-    real_path = os.path.realpath(input_file)
-    i12_path = os.path.dirname(os.path.dirname(real_path))
-    insar_param_file = os.path.join(i12_path, 'TextFiles', 'InSARParameters.txt')
-    with open(insar_param_file, 'r') as f:
-        # read lines of file and remove whitespace and comments (comments after \t\t)
-        lines = [''.join(l.strip().split('\t\t')[0]) for l in f.readlines()]
-        #print(lines)
-        jump_index = lines.index('/* -5- Interferometric products computation */')
-        img_dim = lines[jump_index + 2: jump_index + 4]
-        #print(img_dim)
-
-    ncol, nrow = int(img_dim[0].strip()), int(img_dim[1].strip())
-    if(ncol == 0):
-        return False
-    else:
-        return True
-
-def prepare_dir_list(input_path):
+def prepare_dir_list(input_path, catalog):
    
     # for preparation with ALL2GIF.sh
-    # maybe problem with region name if condition is coded like this
-    # data_dirs_paths = [os.path.join(input_path, d, 'i12', 'InSARProducts') for d in os.listdir(input_path) if(len(d.split('_')) == 7 and os.path.isdir(os.path.join(input_path, d)))]
-    # this solution should work with ALL2GIF and other MasTer Massprocessing results (to be checked) 
-    data_dirs_paths = [os.path.join(input_path, d, 'i12', 'InSARProducts') for d in os.listdir(input_path) if(d[0] == '2' and os.path.isdir(os.path.join(input_path, d)))]
-
-
-    for d in os.listdir(input_path):
-        if(os.path.isdir(d)):
-            print(print(len(d.split('_'))))
-
-    #compare_list = []
+    # the catalog contains the DATE_... directories, this should work with ALL2GIF and other MasTer Massprocessing results (to be checked) 
     out_list = []
     
-    # walk through all i12/InSARProducts directories and save paths to DATE.VV.mod files in list
+    # all i12/InSARProducts directories with their DATE.VV.mod files
     # need to filter te results to link the mod files where interferometric dimensions in i12/TextFiles/InSARParameters.txt != 0
-    for d in data_dirs_paths:
-        for f in os.listdir(d):
-            if(os.path.splitext(f)[1] == '.mod'):
-                # only add mod files to list, where dimensions are != 0
-                #compare_list += [os.path.join(d, f)]
-                if(filter_mod_files(os.path.join(d, f))):
-                    out_list += [os.path.join(d, f)]
-                else:
-                    continue
+    for entry in catalog.results():
+        if(entry['ncol'] == 0):
+            continue
+        data_dir = os.path.join(input_path, entry['dir'], 'i12', 'InSARProducts')
+        out_list += [os.path.join(data_dir, f) for f in entry['mod_files']]
     
     # return list with path to mod files f.e. 
     # input_path/20220717_20220919/i12/InSARProducts/[DATE].VV.mod
@@ -93,21 +64,13 @@ def link_files(data_path_list, dst_path):
             os.symlink(p, os.path.join(dst_path, os.path.basename(p)))
     print('Finished linking files')
 
-def get_az_range_sampling(data_path_list, correl_path):
+def get_az_range_sampling(data_path_list, correl_path, catalog):
     # only need one InSARParameters.txt file bc azimuth and slant range sampling are same for all
-    # need parent of parent dir bc in data_path_list are paths to DATE.mod files
-    result_dir = os.path.dirname(os.path.dirname(data_path_list[0]))
-    insar_param_file = os.path.join(result_dir, 'TextFiles', 'InSARParameters.txt')
-    print(insar_param_file)
-    with open(insar_param_file, 'r') as f:
-        # read lines of file and remove whitespace
-        lines = [''.join(l.strip().split('\t\t')) for l in f.readlines()]
-        for l in lines:
-            if('Azimuth sampling' in l):
-                azimuth_sampl = l.split('/')[0].strip()
-            if('Slant range sampling' in l):
-                range_sampl = l.split('/')[0].strip()
-                break
+    # need parent of parent of parent dir bc in data_path_list are paths to DATE.mod files
+    result_dir = os.path.dirname(os.path.dirname(os.path.dirname(data_path_list[0])))
+    entry = catalog.get(os.path.basename(result_dir))
+    print('Sampling of {}'.format(result_dir))
+    azimuth_sampl, range_sampl = entry['az_sampling'], entry['range_sampling']
 
     sampling = pd.DataFrame(data={'AZ':[azimuth_sampl], 'SR':[range_sampl]})
     sampling.to_csv(os.path.join(correl_path, 'sampling.txt'), sep='\t', index=None)
@@ -126,7 +89,10 @@ dst_path = arguments['--dest']
 # update flag
 update = arguments['--u']
 
-data_path_list = prepare_dir_list(input_path)
+# dimensions, sampling and .mod files of all ALL2GIF results (only new or changed results are read)
+catalog = Catalog(input_path)
+
+data_path_list = prepare_dir_list(input_path, catalog)
 
 if(update):
     print('Update directory')
@@ -142,7 +108,7 @@ else:
     # save asp_parameters and sampling in destination directory instead of CORREL
     init_asp_parameters(dst_path)
 
-    get_az_range_sampling(data_path_list, dst_path)
+    get_az_range_sampling(data_path_list, dst_path, catalog)
 
 
 
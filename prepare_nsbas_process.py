@@ -4,14 +4,17 @@
 prepare_nsbas_process.py
 ---------------
 Prepare the necessary files and directory structure for the NSBAS time series processing.
+With --mask the .r4 files of EXPORT/NSBAS/H|V are masked with the virtual masks of EXPORT/MASKS/<name> (utils/mask_correl_results_cc.py --virtual)
+and written to NSBAS_PROCESS/MASKS/<name>/H|V/LN_DATA, EXPORT/NSBAS/MASKED is not needed.
 
-Usage: prepare_nsbas_process.py --data=<path> [--masked]
+Usage: prepare_nsbas_process.py --data=<path> [--masked] [--mask=<name>]
 prepare_nsbas_process.py -h | --help
 
 Options:
 -h | --help         Show this screen
 --data              Path to working directory to prepare
 --masked            Use the masked files to prepare NSBAS processing
+--mask              Apply the virtual mask EXPORT/MASKS/<name> to the .r4 files
 
 """
 ##########
@@ -26,6 +29,8 @@ from pathlib import Path
 import shutil
 from dateutil import parser
 import docopt
+from scipy import sparse
+from aspsar.masks import Mask, get_mask_file
 
 #############
 # FUNCTIONS #
@@ -51,39 +56,49 @@ def get_perp_baseline_each_date(pair_table, date_list_file):
 
     # load bp for each pair and dates1 + dates2
     dates1, dates2, bp = get_dates_and_Bp(pair_table)
-    M = len(bp)
 
     # load list of dates
     date_list = pd.read_csv(date_list_file, header=None).iloc[:,0].to_list()
-    N = len(date_list)
 
-    # build G
-    G = np.zeros((M,N))
-    
-    for k in range((M)):
-        for n in range((N)):
-            if(dates1[k] == date_list[n]):
-                G[k, n] = -1
-            if(dates2[k] == date_list[n]):
-                G[k, n] = 1
+    return invert_perp_baseline(dates1, dates2, bp, date_list)
 
-    
-    # set first column of G to 0 -> get first date as reference; Bp of first date = 0
-    G[:,0] = 0
-    m = np.linalg.lstsq(G, bp, rcond=-1)
+def build_incidence_matrix(dates1, dates2, date_list):
+    # sparse G (M pairs x N-1 dates): -1 at date1, +1 at date2 of each pair
+    # the first date is the reference (Bp = 0) and has no column, dates missing in date_list are ignored
+    date_index = dict((d, n - 1) for n, d in enumerate(date_list) if n > 0)
+
+    rows, cols, values = [], [], []
+    for k, (d1, d2) in enumerate(zip(dates1, dates2)):
+        for d, v in [(d1, -1.), (d2, 1.)]:
+            if(d in date_index):
+                rows.append(k)
+                cols.append(date_index[d])
+                values.append(v)
+
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(dates1), len(date_list) - 1))
+
+def invert_perp_baseline(dates1, dates2, bp, date_list):
+    G = build_incidence_matrix(dates1, dates2, date_list)
+
+    # normal equations on the small (N-1 x N-1) system, lstsq gives the minimum norm solution if the network is not connected
+    GtG = (G.T @ G).toarray()
+    Gtb = G.T @ np.asarray(bp, dtype=np.float64)
+    m = np.linalg.lstsq(GtG, Gtb, rcond=None)[0]
 
-    return list(m[0])
+    # first date as reference; Bp of first date = 0
+    return [0.] + list(m)
 
-# generate list_pair file and saves it in /NSBAS_PROCESS/H|V
-def generate_list_pair(process_orient_dir, pair_table):
+# list_pair file content, written in /NSBAS_PROCESS/H|V
+def get_list_pair(pair_table):
     
     # get only master and slave dates - keep as pairs
     pairs= pd.read_csv(pair_table, sep='\t').iloc[:,0:2]
-    pairs.to_csv(os.path.join(process_orient_dir, 'list_pair'), sep='\t', header=False, index=False)
+    return pairs.to_csv(sep='\t', header=False, index=False)
     
 # for first try, run with Bp=0 for each date -> add calculation later with get_perp_baseline_each_date
-# generate list_dates file and saves it in /NSBAS_PROCESS/H|V
-def generate_list_dates(process_orient_dir, date_list_file, pair_table):
+# list_dates file content, written in /NSBAS_PROCESS/H|V
+# bp: Bp of each date (get_perp_baseline_each_date)
+def get_list_dates(date_list_file, bp):
     # read all dates in DataFrame structure (just one column)
     date_list = pd.read_csv(date_list_file, header=None).iloc[:,0].to_list()
     # convert all dates to decimal
@@ -95,9 +110,6 @@ def generate_list_dates(process_orient_dir, date_list_file, pair_table):
     # calculate Bt
     date_diff = [d_dec - ref_date for d_dec in date_dec_list]
 
-    # calculates Bp for each date with first date as reference
-    bp = get_perp_baseline_each_date(pair_table, date_list_file)
-
     # prepare DataFrame for output
     out_df = pd.DataFrame({
         'dates': date_list,
@@ -106,27 +118,51 @@ def generate_list_dates(process_orient_dir, date_list_file, pair_table):
         'bp': bp
         })
 
-    out_df.to_csv(os.path.join(process_orient_dir, 'list_dates'), sep=' ', header=False, index=False)
+    return out_df.to_csv(sep=' ', header=False, index=False)
+
+def write_masked_r4(input_file, output_file, mask, block_rows=512):
+    # .r4 file (float32, lines of the map) masked block by block with the virtual mask
+    nrow, ncol = mask.shape
+    if(os.path.getsize(input_file) != nrow * ncol * 4):
+        print('Size of {} does not match the mask ({} x {}), skip'.format(os.path.basename(input_file), ncol, nrow))
+        return
+
+    los = np.memmap(input_file, dtype=np.float32, mode='r', shape=(nrow, ncol))
+    tmp_file = '{}.tmp'.format(output_file)
+    with open(tmp_file, 'wb') as fid:
+        for y in range(0, nrow, block_rows):
+            fid.write(mask.apply(los[y:y + block_rows], y).astype('float32').tobytes())
+    os.replace(tmp_file, output_file)
+
+def is_outdated(output_file, input_files):
+    # output missing or older than one of its inputs
+    if(not os.path.isfile(output_file)):
+        return True
+    return any([os.path.getmtime(f) > os.path.getmtime(output_file) for f in input_files])
+
+# writes the files shared by H and V (input_inv_send, list_pair, list_dates) in /NSBAS_PROCESS/H|V
+# shared_files: {filename: content}, computed once for both orientations
+def write_shared_files(process_orient_dir, nsbas_input_dir, shared_files):
+    # copy the input_inv_send in each dir
+    shutil.copy(os.path.join(nsbas_input_dir, 'input_inv_send'), os.path.join(process_orient_dir, 'input_inv_send'))
+
+    for filename, content in shared_files.items():
+        with open(os.path.join(process_orient_dir, filename), 'w') as f:
+            f.write(content)
 
 # orientation is 'H' or 'V'
 # if masked data is used, nsbas_input_dir = NSBAS/MASKED
 # if masked data is used, nsbas_process_path = NSBAS_PROCESS/MASKED/H|V
-def prepare_process_directories(nsbas_input_dir, nsbas_process_path, orientation, pair_table, date_list_file, masked):
+# mask_name: virtual mask of EXPORT/MASKS, the masked .r4 files are written in LN_DATA instead of linked
+def prepare_process_directories(nsbas_input_dir, nsbas_process_path, orientation, shared_files, masked, mask_name=None):
     # create subdir in NSBAS_PROCESS based on orientation
     process_orient_dir = os.path.join(nsbas_process_path, orientation)
     Path(process_orient_dir).mkdir(parents=True, exist_ok=True)
 
-    # copy the input_inv_send in each dir
-    shutil.copy(os.path.join(nsbas_input_dir, 'input_inv_send'), os.path.join(process_orient_dir, 'input_inv_send'))
-
-    # generate list_pair based on table_... (created with PrepaMSBAS)
-    generate_list_pair(process_orient_dir, pair_table)
-
-    # generate list_dates
-    generate_list_dates(process_orient_dir, date_list_file, pair_table)
+    # input_inv_send, list_pair (based on table_... created with PrepaMSBAS) and list_dates
+    write_shared_files(process_orient_dir, nsbas_input_dir, shared_files)
 
-
-    if(masked):
+    if(masked and not mask_name):
         input_orient_dir = os.path.join(nsbas_input_dir, 'MASKED', orientation) 
     # get /EXPORT/NSBAS/orientation dir
     else:
@@ -136,28 +172,38 @@ def prepare_process_directories(nsbas_input_dir, nsbas_process_path, orientation
     ln_data_dir = os.path.join(process_orient_dir, 'LN_DATA')
     Path(ln_data_dir).mkdir(parents=True, exist_ok=True)
 
-    # generates links in /orientation/LN_DATA to .r4 and .r4.rsc files
-    for f in os.listdir(input_orient_dir):
-        # need to put string into specific format
-        # is: DATE1-DATE2_DIRECTION.r4/.rsc; need: DATE1-DATE2.r4/.rsc
-        # need to check extensions because otherwise -> two with same name
-        if(len(f.split('.')) == 3):
-            ext = '.r4.rsc'
-        else:
-            ext = '.r4'
-        if(os.path.isfile(os.path.join(ln_data_dir, '{}{}'.format(f.split('_')[0], ext)))):
-            continue
-        else:
-            os.symlink(os.path.join(input_orient_dir, f), os.path.join(ln_data_dir, '{}{}'.format(f.split('_')[0], ext)))
+    # one listing of LN_DATA and one scan of the input dir, instead of a check per file
+    existing = set(os.listdir(ln_data_dir))
+    links = []
 
-    # copy the input_inv_send in each dir
-    #shutil.copy(os.path.join(nsbas_input_dir, 'input_inv_send'), os.path.join(process_orient_dir, 'input_inv_send'))
-
-    # generate list_pair based on table_... (created with PrepaMSBAS)
-    #generate_list_pair(process_orient_dir, pair_table)
-
-    # generate list_dates
-    #generate_list_dates(process_orient_dir, date_list_file, pair_table)
+    # generates links in /orientation/LN_DATA to .r4 and .r4.rsc files
+    with os.scandir(input_orient_dir) as entries:
+        for entry in entries:
+            f = entry.name
+            # need to put string into specific format
+            # is: DATE1-DATE2_DIRECTION.r4/.rsc; need: DATE1-DATE2.r4/.rsc
+            # need to check extensions because otherwise -> two with same name
+            if(len(f.split('.')) == 3):
+                ext = '.r4.rsc'
+            else:
+                ext = '.r4'
+            link_name = '{}{}'.format(f.split('_')[0], ext)
+            if(mask_name and ext == '.r4'):
+                # DATE1-DATE2_DIRECTION.r4 -> mask of DATE1_DATE2
+                pair = f.split('_')[0].replace('-', '_')
+                mask_file = get_mask_file(os.path.dirname(nsbas_input_dir), mask_name, pair)
+                out_file = os.path.join(ln_data_dir, link_name)
+                if(not os.path.isfile(mask_file)):
+                    print('No mask {} found for {}, skip'.format(mask_name, pair))
+                elif(is_outdated(out_file, [entry.path, mask_file])):
+                    write_masked_r4(entry.path, out_file, Mask(mask_file))
+                continue
+            if(link_name not in existing):
+                links.append((os.path.join(input_orient_dir, f), os.path.join(ln_data_dir, link_name)))
+
+    for src, dst in links:
+        os.symlink(src, dst)
+    print('{} links created in {}'.format(len(links), ln_data_dir))
 
 ########
 # MAIN #
@@ -171,7 +217,13 @@ work_dir = arguments['--data']
 # check if masked is set
 masked = arguments['--masked']
 
-if(masked):
+# virtual mask, applied to the unmasked .r4 files
+mask_name = arguments['--mask']
+
+if(mask_name):
+    nsbas_process_dir = os.path.join(work_dir, 'NSBAS_PROCESS', 'MASKS', mask_name)
+    Path(nsbas_process_dir).mkdir(parents=True, exist_ok=True)
+elif(masked):
     nsbas_process_dir = os.path.join(work_dir, 'NSBAS_PROCESS', 'MASKED')
     Path(nsbas_process_dir).mkdir(parents=True, exist_ok=True)
 else:
@@ -186,12 +238,16 @@ correl_dir = os.path.join(work_dir, 'CORREL')
 pair_table = [os.path.join(correl_dir, f) for f in os.listdir(correl_dir) if os.path.isfile(os.path.join(work_dir, f)) and f.split('_')[0] == 'table'][0]
 date_list_file = os.path.join(nsbas_input_dir, 'dates_list.txt')
 
+# files shared by H and V, computed once
+# calculates Bp for each date with first date as reference
+bp = get_perp_baseline_each_date(pair_table, date_list_file)
+shared_files = {'list_pair': get_list_pair(pair_table), 'list_dates': get_list_dates(date_list_file, bp)}
 
 print('START PREPARING H DIRECTORY')
-prepare_process_directories(nsbas_input_dir, nsbas_process_dir, 'H', pair_table, date_list_file, masked)
+prepare_process_directories(nsbas_input_dir, nsbas_process_dir, 'H', shared_files, masked, mask_name)
 print('FINISHED H')
 
 print('START PREPARING V DIRECTORY')
-prepare_process_directories(nsbas_input_dir, nsbas_process_dir, 'V', pair_table, date_list_file, masked)
+prepare_process_directories(nsbas_input_dir, nsbas_process_dir, 'V', shared_files, masked, mask_name)
 print('FINISHED V')
 
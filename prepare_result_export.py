@@ -5,7 +5,7 @@ prepare_result_export.py
 -------------
 Prepares an EXPORT directory to easily download the data. Adjusts the data by subtracting the median from each disparity map. Prepares the necessary files for the NSBAS processing.
 
-Usage: prepare_result_export.py [--f] --data=<path> [--masked]
+Usage: prepare_result_export.py [--f] --data=<path> [--masked] [--direct] [--geotiff] [--jobs=<value>] [--block=<value>] [--quantile_error=<value>] [--hash] [--mask=<name>]
 prepare_result_export.py -h | --help
 
 Options:
@@ -13,6 +13,13 @@ Options:
 --data              Path to working directory 
 --f                 Force recomputation of EXPORT directory
 --masked            Use the masked data as input
+--direct            Write the NSBAS .r4 files directly from correl-F.tif (median shift, sampling and with --masked the CC mask in one pass), without the ADJUSTED/MASKED GeoTIFFs
+--geotiff           With --direct, also write the ADJUSTED and CC GeoTIFFs in the same pass
+--jobs              Number of pairs processed in parallel [default: 1]
+--block             Number of lines read at once from correl-F.tif [default: 512]
+--quantile_error    Maximal absolute error (pixel) of the median and quantiles, faster than the exact computation [default: exact]
+--hash              Compare the inputs by their content (sha1) instead of their modification time to find outdated products
+--mask              Use the virtual masks of EXPORT/MASKS/<name> (utils/mask_correl_results_cc.py --virtual) on the ADJUSTED files instead of EXPORT/MASKED, implies --masked
 
 """
 ##########
@@ -26,11 +33,19 @@ import pandas as pd
 from pathlib import Path
 import shutil
 import docopt
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from aspsar.masks import Mask, get_mask_dir, get_mask_file
 
 #############
 # FUNCTIONS #
 #############
 
+# quantiles of the disparity maps saved in the metadata of the adjusted files and in EXPORT/disparity_stats.txt
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
 # n_band=1 - H
 # n_band=2 - V
 # add n_band to input param
@@ -43,29 +58,488 @@ def read_from_file(input_file, n_band):
     # return (raw_disparity, ncol, nrow) XSize=col YSize=row
     return (raw_disparity, ncol, nrow)
 
-def save_to_file(data, output_path, ncol, nrow):
+def read_band_blocks(ds_band, ncol, nrow, block_rows):
+    # yields (first line, window of complete lines) of the band
+    for y in range(0, nrow, block_rows):
+        yield (y, ds_band.ReadAsArray(0, y, ncol, min(block_rows, nrow - y)))
+
+def select_interval(values, interval):
+    # values in [lo, hi[ (or [lo, hi] if the interval is closed)
+    lo, hi, closed = interval[0], interval[1], interval[4]
+    if(closed):
+        return values[(values >= lo) & (values <= hi)]
+    return values[(values >= lo) & (values < hi)]
+
+def read_valid_blocks(ds_band, ncol, nrow, block_rows):
+    # finite values of each window in float64, compared and binned with the float64 interval edges
+    for y, data in read_band_blocks(ds_band, ncol, nrow, block_rows):
+        yield data[np.isfinite(data)].astype(np.float64)
+
+def get_band_quantiles(ds_band, ncol, nrow, quantiles, block_rows=512, error=None, nbins=4096, max_candidates=1000000):
+    # quantiles of the finite values of a band (linear interpolation like np.nanquantile), the band is only read in windows
+    # histogram passes narrow the interval that contains each needed order statistic
+    # error=None: exact, the values of the final intervals are selected in memory (at most max_candidates per order statistic)
+    # error=<value>: stops when an interval is smaller than 2*error and uses its center (absolute error <= error)
+
+    # pass 1: number of valid values, min, max
+    count, vmin, vmax = 0, np.inf, -np.inf
+    for valid in read_valid_blocks(ds_band, ncol, nrow, block_rows):
+        if(valid.size > 0):
+            count += valid.size
+            vmin, vmax = min(vmin, valid.min()), max(vmax, valid.max())
+
+    stats = {'COUNT': count}
+    if(count == 0):
+        for q in quantiles:
+            stats[q] = np.nan
+        return stats
+
+    # order statistics needed for the interpolation
+    positions = [q * (count - 1) for q in quantiles]
+    ranks = sorted(set([int(np.floor(pos)) for pos in positions] + [int(np.ceil(pos)) for pos in positions]))
+
+    # interval of each rank: [lo, hi, number of values below lo, number of values in interval, closed]
+    intervals = {r: [float(vmin), float(vmax), 0, count, True] for r in ranks}
+
+    def needs_refinement(interval):
+        lo, hi, n_in = interval[0], interval[1], interval[3]
+        if(hi <= lo or n_in <= 1):
+            return False
+        if(error is not None and hi - lo <= 2 * error):
+            return False
+        if(error is None and n_in <= max_candidates):
+            return False
+        # bins smaller than the float32 spacing cannot separate the values, they are counted by value in the final pass
+        return (hi - lo) / nbins >= np.spacing(np.float32(max(abs(lo), abs(hi))))
+
+    while(True):
+        todo = [r for r in ranks if needs_refinement(intervals[r])]
+        if(not todo):
+            break
+
+        # the same float64 edges for counting and for the new interval, bin b is [edges[b], edges[b+1][
+        edges = dict((r, np.linspace(intervals[r][0], intervals[r][1], nbins + 1)) for r in todo)
+        hists = dict((r, np.zeros(nbins, dtype=np.int64)) for r in todo)
+        for valid in read_valid_blocks(ds_band, ncol, nrow, block_rows):
+            for r in todo:
+                # hi of a closed interval is counted in the last bin
+                b = np.minimum(np.searchsorted(edges[r], select_interval(valid, intervals[r]), side='right') - 1, nbins - 1)
+                hists[r] += np.bincount(b, minlength=nbins)
+
+        for r in todo:
+            lo, hi, n_below, n_in, closed = intervals[r]
+            cum = np.cumsum(hists[r])
+            # first bin with more than (r - n_below) values up to its end
+            b = int(np.searchsorted(cum, r - n_below, side='right'))
+            intervals[r] = [float(edges[r][b]), float(edges[r][b + 1]), n_below + (int(cum[b - 1]) if b > 0 else 0), int(hists[r][b]), closed and b == nbins - 1]
+
+    # final pass: select the exact values (or use the center of the interval)
+    values = {}
+    collect = []
+    for r in ranks:
+        lo, hi, n_below, n_in, closed = intervals[r]
+        if(hi <= lo):
+            values[r] = lo
+        elif(error is not None and hi - lo <= 2 * error):
+            values[r] = (lo + hi) / 2
+        else:
+            collect.append(r)
+
+    if(collect):
+        # intervals with more than max_candidates values are narrower than nbins float32 spacings,
+        # their values are counted by value (at most nbins + 1 different values) instead of collected
+        candidates = dict((r, []) for r in collect)
+        for valid in read_valid_blocks(ds_band, ncol, nrow, block_rows):
+            for r in collect:
+                sel = select_interval(valid, intervals[r])
+                if(intervals[r][3] > max_candidates):
+                    sel = np.unique(sel, return_counts=True)
+                candidates[r].append(sel)
+        for r in collect:
+            k = r - intervals[r][2]
+            if(intervals[r][3] > max_candidates):
+                unique_values = np.concatenate([c[0] for c in candidates[r]])
+                counts = np.concatenate([c[1] for c in candidates[r]])
+                unique_values, index = np.unique(unique_values, return_inverse=True)
+                counts = np.bincount(index, weights=counts)
+                values[r] = unique_values[int(np.searchsorted(np.cumsum(counts), k, side='right'))]
+            else:
+                c = np.concatenate(candidates[r])
+                values[r] = np.partition(c, k)[k]
+
+    for q, pos in zip(quantiles, positions):
+        lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+        stats[q] = float(values[lo]) + (pos - lo) * (float(values[hi]) - float(values[lo]))
+
+    return stats
+
+def get_stats_metadata(stats, sampling, error):
+    # quantiles of the raw disparity (pixel) saved in the metadata of the adjusted file
+    metadata = {'COUNT': str(stats['COUNT']), 'SAMPLING': str(sampling), 'QUANTILE_ERROR': 'exact' if error is None else str(error)}
+    for q in QUANTILES:
+        metadata['Q{:02d}'.format(int(round(q * 100)))] = str(stats[q])
+    metadata['MEDIAN'] = str(stats[0.5])
+
+    return metadata
+
+def read_stats_metadata(input_file):
+    # stats of an existing adjusted file, None if not saved (older files)
+    ds = gdal.OpenEx(input_file, allowed_drivers=['GTiff'])
+    metadata = ds.GetMetadata()
+    if('MEDIAN' not in metadata):
+        return None
+
+    stats = {'COUNT': int(metadata['COUNT'])}
+    for q in QUANTILES:
+        stats[q] = float(metadata['Q{:02d}'.format(int(round(q * 100)))])
+    return stats
+
+def create_output_file(output_path, ncol, nrow):
     drv = gdal.GetDriverByName('GTiff')
-    dst_ds = drv.Create(output_path, ncol, nrow, 1, gdal.GDT_Float32)
+    return drv.Create(output_path, ncol, nrow, 1, gdal.GDT_Float32)
+
+def subtract_median(ds, n_band, output_path, sampling, block_rows=512, error=None):
+    # n_band=1 - H, n_band=2 - V
+    ncol, nrow = ds.RasterXSize, ds.RasterYSize
+    ds_band = ds.GetRasterBand(n_band)
+
+    stats = get_band_quantiles(ds_band, ncol, nrow, QUANTILES, block_rows, error)
+    # median in the precision of the disparity map
+    median = np.float32(stats[0.5])
+
+    # write to temporary file first, an interrupted export must not leave a truncated product
+    tmp_path = '{}.tmp'.format(output_path)
+    dst_ds = create_output_file(tmp_path, ncol, nrow)
     dst_band = dst_ds.GetRasterBand(1)
-    dst_band.WriteArray(data)
+    for y, raw_disparity in read_band_blocks(ds_band, ncol, nrow, block_rows):
+        # add conversion from pixel to m displacement here
+        dst_band.WriteArray((raw_disparity - median) * sampling, 0, y)
+    dst_ds.SetMetadata(get_stats_metadata(stats, sampling, error))
+    dst_ds.FlushCache()
+    dst_band, dst_ds = None, None
+
+    os.replace(tmp_path, output_path)
+
+    return stats
+
+def get_cc_map(ds, n_band, output_path, block_rows=512):
+    ncol, nrow = ds.RasterXSize, ds.RasterYSize
 
-def subtract_median(input_file, output_path, n_band, sampling):
-    # img_data = (raw_disparity, ncol, nrow)
-    img_data = read_from_file(input_file, n_band)
-    raw_disparity, ncol, nrow = img_data[0], img_data[1], img_data[2]
-    median = np.nanmedian(raw_disparity)
+    tmp_path = '{}.tmp'.format(output_path)
+    dst_ds = create_output_file(tmp_path, ncol, nrow)
+    dst_band = dst_ds.GetRasterBand(1)
+    for y, cc in read_band_blocks(ds.GetRasterBand(n_band), ncol, nrow, block_rows):
+        dst_band.WriteArray(cc, 0, y)
+    dst_ds.FlushCache()
+    dst_band, dst_ds = None, None
+
+    os.replace(tmp_path, output_path)
+
+## EXPORT MANIFEST ##
+# EXPORT/export_manifest.json: for each product (path relative to EXPORT) the pair, the input file (size, mtime, optional sha1) and the parameters
+
+def load_manifest(exp_dir):
+    manifest_file = os.path.join(exp_dir, 'export_manifest.json')
+    if(os.path.isfile(manifest_file)):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(exp_dir, manifest):
+    manifest_file = os.path.join(exp_dir, 'export_manifest.json')
+    tmp_file = '{}.tmp'.format(manifest_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def get_pair_entries(manifest):
+    # entries of each pair, only these are given to the processing of a pair
+    pair_entries = {}
+    for key, entry in manifest.items():
+        pair_entries.setdefault(entry['pair'], {})[key] = entry
+    return pair_entries
+
+def get_file_fingerprint(input_file, use_hash=False, entries={}):
+    # with use_hash the sha1 of a previous entry is reused if size and mtime did not change
+    st = os.stat(input_file)
+    fingerprint = {'file': os.path.abspath(input_file), 'size': st.st_size, 'mtime': st.st_mtime}
+
+    if(use_hash):
+        for entry in entries.values():
+            previous = entry['input']
+            if(previous['file'] == fingerprint['file'] and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime and 'sha1' in previous):
+                fingerprint['sha1'] = previous['sha1']
+                return fingerprint
+
+        sha1 = hashlib.sha1()
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                sha1.update(chunk)
+        fingerprint['sha1'] = sha1.hexdigest()
+
+    return fingerprint
+
+def same_input(previous, fingerprint):
+    if(previous['file'] != fingerprint['file'] or previous['size'] != fingerprint['size']):
+        return False
+    if('sha1' in previous and 'sha1' in fingerprint):
+        return previous['sha1'] == fingerprint['sha1']
+    return previous['mtime'] == fingerprint['mtime']
+
+def check_product(output_file, exp_dir, pair, entries, fingerprint, params, new_entries):
+    # returns True if the product is up to date
+    # existing products without entry (older exports) are only kept and added if they are newer than their input
+    key = os.path.relpath(output_file, exp_dir)
+    entry = entries.get(key)
+
+    if(not os.path.isfile(output_file)):
+        return False
+    if(entry is None and os.path.getmtime(output_file) <= fingerprint['mtime']):
+        print('{} is older than its input, recompute'.format(os.path.basename(output_file)))
+        return False
+    if(entry is not None and not (same_input(entry['input'], fingerprint) and entry['params'] == params)):
+        print('{} is outdated, recompute'.format(os.path.basename(output_file)))
+        return False
+
+    print('Skip {}, up to date'.format(os.path.basename(output_file)))
+    new_entries[key] = {'pair': pair, 'input': fingerprint, 'params': params}
+    return True
+
+def add_products(output_files, exp_dir, pair, fingerprint, params_list, new_entries):
+    for output_file, params in zip(output_files, params_list):
+        new_entries[os.path.relpath(output_file, exp_dir)] = {'pair': pair, 'input': fingerprint, 'params': params}
+
+def get_error_param(error):
+    return 'exact' if error is None else error
+
+def get_masked_params(masked, mask_file=None):
+    # with a virtual mask the products are also recomputed if the mask changes
+    params = {'masked': bool(masked)}
+    if(mask_file):
+        st = os.stat(mask_file)
+        params['mask'] = {'file': os.path.abspath(mask_file), 'size': st.st_size, 'mtime': st.st_mtime}
+    return params
+
+def find_mask_file(exp_dir, mask_name, curr_pair):
+    # path to the virtual mask of the pair or None if it is missing
+    mask_file = get_mask_file(exp_dir, mask_name, curr_pair)
+    if(not os.path.isfile(mask_file)):
+        print('No mask {} found for {}, run utils/mask_correl_results_cc.py --virtual={}'.format(mask_name, curr_pair, mask_name))
+        return None
+    return mask_file
+
+## EXPORT ##
+
+def process_pair(d, exp_dir, adj_dir, cc_dir, raw_dir, range_sampl, az_sampl, block_rows=512, error=None, entries={}, use_hash=False):
+    # returns (False, [], {}) if no correl-F.tif exists for the pair, otherwise (True, [(direction, stats)], manifest entries)
+    curr_pair = os.path.basename(d)
+    # use here the complete correl-F instead of the disparitydebug results
+    correl_path = os.path.join(d, 'asp', 'correl-F.tif')
 
-    adj_disparity = np.zeros((nrow, ncol))
-    adj_disparity = (raw_disparity - median) * sampling
-    # add conversion from pixel to m displacement here
-    save_to_file(adj_disparity, output_path, ncol, nrow)
+    if(not os.path.isfile(correl_path)):
+        print('No correl-F.tif file found in {}'.format(curr_pair))
+        return (False, [], {})
+
+    print('Start pair: {}'.format(curr_pair))
+    h_file = os.path.join(adj_dir, '{}-F-H_wm.tif'.format(curr_pair))
+    v_file = os.path.join(adj_dir, '{}-F-V_wm.tif'.format(curr_pair))
+    cc_file = os.path.join(cc_dir, '{}_CC.tif'.format(curr_pair))
+
+    # products are recomputed if they do not exist or their input or parameters changed
+    fingerprint = get_file_fingerprint(correl_path, use_hash, entries)
+    params = {h_file: {'band': 1, 'sampling': float(range_sampl), 'quantile_error': get_error_param(error)},
+              v_file: {'band': 2, 'sampling': float(az_sampl), 'quantile_error': get_error_param(error)},
+              cc_file: {'band': 3}}
+    new_entries = {}
+    todo = [f for f in [h_file, v_file, cc_file] if not check_product(f, exp_dir, curr_pair, entries, fingerprint, params[f], new_entries)]
+
+    # correl-F.tif is opened once for all products
+    if(todo):
+        ds = gdal.OpenEx(correl_path, allowed_drivers=['GTiff'])
+
+    pair_stats = []
+    for direction, n_band, out_file, sampl in [('H', 1, h_file, range_sampl), ('V', 2, v_file, az_sampl)]:
+        if(out_file in todo):
+            stats = subtract_median(ds, n_band, out_file, sampl, block_rows, error)
+        else:
+            stats = read_stats_metadata(out_file)
+        if(stats is not None):
+            pair_stats.append((direction, stats))
+
+    if(cc_file in todo):
+        # 3rd band of correl-F.tif contains the correlation coefficient map
+        get_cc_map(ds, 3, cc_file, block_rows)
+
+    add_products(todo, exp_dir, curr_pair, fingerprint, [params[f] for f in todo], new_entries)
+
+    link_raw_file(correl_path, raw_dir, curr_pair)
+
+    print('Finished pair: {}'.format(curr_pair))
+    return (True, pair_stats, new_entries)
+
+def link_raw_file(correl_path, raw_dir, curr_pair):
+    # instead of copying, just link raw data to save space (maybe remove later)
+    if(os.path.lexists(os.path.join(raw_dir, '{}-F-H.tif'.format(curr_pair)))):
+        print('Skip linking of {}'.format(curr_pair))
+    else:
+        os.symlink(correl_path, os.path.join(raw_dir, '{}-F-H.tif'.format(curr_pair)))
+        os.symlink(correl_path, os.path.join(raw_dir, '{}-F-V.tif'.format(curr_pair)))
+
+def get_nsbas_dir(nsbas_dir, direction, masked):
+    # NSBAS/H||V or NSBAS/MASKED/H||V
+    if(masked):
+        return os.path.join(nsbas_dir, 'MASKED', direction)
+    return os.path.join(nsbas_dir, direction)
+
+def export_pair_direct(d, exp_dir, nsbas_dir, adj_dir, cc_dir, raw_dir, range_sampl, az_sampl, masked, geotiff, block_rows=512, error=None, entries={}, use_hash=False, mask_name=None):
+    # correl-F.tif -> NSBAS .r4/.rsc (and optional ADJUSTED/CC GeoTIFFs) without intermediate files
+    # with mask_name the virtual mask of the pair is used instead of CC == 1
+    # returns (False, [], {}) if no correl-F.tif exists for the pair, otherwise (True, [(direction, stats)], manifest entries)
+    curr_pair = os.path.basename(d)
+    dates_pair = '{}-{}'.format(curr_pair.split('_')[0], curr_pair.split('_')[1])
+    correl_path = os.path.join(d, 'asp', 'correl-F.tif')
+
+    if(not os.path.isfile(correl_path)):
+        print('No correl-F.tif file found in {}'.format(curr_pair))
+        return (False, [], {})
+
+    mask_file = None
+    if(masked and mask_name):
+        mask_file = find_mask_file(exp_dir, mask_name, curr_pair)
+        if(mask_file is None):
+            return (True, [], {})
+
+    directions = [('H', 1, range_sampl), ('V', 2, az_sampl)]
+    r4_files = dict((direction, os.path.join(get_nsbas_dir(nsbas_dir, direction, masked), '{}_{}.r4'.format(dates_pair, direction))) for direction, n_band, sampl in directions)
+    tif_files = dict((direction, os.path.join(adj_dir, '{}-F-{}_wm.tif'.format(curr_pair, direction))) for direction, n_band, sampl in directions)
+    cc_file = os.path.join(cc_dir, '{}_CC.tif'.format(curr_pair))
+
+    out_files = list(r4_files.values())
+    params_list = [dict({'band': n_band, 'sampling': float(sampl), 'quantile_error': get_error_param(error)}, **get_masked_params(masked, mask_file)) for direction, n_band, sampl in directions]
+    if(geotiff):
+        out_files = out_files + list(tif_files.values()) + [cc_file]
+        params_list = params_list + [{'band': n_band, 'sampling': float(sampl), 'quantile_error': get_error_param(error)} for direction, n_band, sampl in directions] + [{'band': 3}]
+
+    # all products of the pair are written in one pass, recompute all if one is missing or outdated
+    fingerprint = get_file_fingerprint(correl_path, use_hash, entries)
+    new_entries = {}
+    if(all([check_product(f, exp_dir, curr_pair, entries, fingerprint, params, new_entries) for f, params in zip(out_files, params_list)])):
+        print('Skip {}, already exported'.format(curr_pair))
+        link_raw_file(correl_path, raw_dir, curr_pair)
+        return (True, [], new_entries)
+    new_entries = {}
+
+    print('Start pair: {}'.format(curr_pair))
+    ds = gdal.OpenEx(correl_path, allowed_drivers=['GTiff'])
+    ncol, nrow = ds.RasterXSize, ds.RasterYSize
 
-def get_cc_map(input_file, output_path, n_band):
-    # img_data = (correlation coefficient, ncol, nrow)
-    img_data = read_from_file(input_file, n_band)
-    cc, ncol, nrow = img_data[0], img_data[1], img_data[2]
+    # median (and quantiles) of the raw disparity
+    pair_stats, medians = [], {}
+    for direction, n_band, sampl in directions:
+        stats = get_band_quantiles(ds.GetRasterBand(n_band), ncol, nrow, QUANTILES, block_rows, error)
+        pair_stats.append((direction, stats))
+        medians[direction] = np.float32(stats[0.5])
+
+    # open all outputs and write them window by window, to temporary files that are renamed when all products are complete
+    r4_fids = dict((direction, open('{}.tmp'.format(r4_files[direction]), 'wb')) for direction in r4_files)
+    if(geotiff):
+        tif_ds = dict((direction, create_output_file('{}.tmp'.format(tif_files[direction]), ncol, nrow)) for direction in tif_files)
+        cc_ds = create_output_file('{}.tmp'.format(cc_file), ncol, nrow)
+    if(mask_file):
+        mask = Mask(mask_file)
+
+    for y in range(0, nrow, block_rows):
+        rows = min(block_rows, nrow - y)
+        if((masked and not mask_file) or geotiff):
+            cc = ds.GetRasterBand(3).ReadAsArray(0, y, ncol, rows)
+
+        for direction, n_band, sampl in directions:
+            adj_disparity = (ds.GetRasterBand(n_band).ReadAsArray(0, y, ncol, rows) - medians[direction]) * sampl
+            if(geotiff):
+                tif_ds[direction].GetRasterBand(1).WriteArray(adj_disparity, 0, y)
+            if(mask_file):
+                adj_disparity = mask.apply(adj_disparity, y)
+            elif(masked):
+                # keep values with cc == 1 (same as utils/mask_correl_results_cc.py)
+                adj_disparity = np.where(cc == 1, adj_disparity, np.nan)
+            # windows of complete lines, written in the line order of the .r4 file
+            r4_fids[direction].write(adj_disparity.astype('float32').tobytes())
+
+        if(geotiff):
+            cc_ds.GetRasterBand(1).WriteArray(cc, 0, y)
+
+    for direction, n_band, sampl in directions:
+        r4_fids[direction].close()
+        save_rsc('{}.rsc'.format(r4_files[direction]), ncol, nrow)
+        if(geotiff):
+            tif_ds[direction].SetMetadata(get_stats_metadata(dict(pair_stats)[direction], sampl, error))
+            tif_ds[direction].FlushCache()
+    if(geotiff):
+        cc_ds.FlushCache()
+        tif_ds, cc_ds = None, None
+
+    for out_file in out_files:
+        os.replace('{}.tmp'.format(out_file), out_file)
+
+    add_products(out_files, exp_dir, curr_pair, fingerprint, params_list, new_entries)
+
+    link_raw_file(correl_path, raw_dir, curr_pair)
+
+    print('Finished pair: {}'.format(curr_pair))
+    return (True, pair_stats, new_entries)
+
+def save_disparity_stats(exp_dir, dir_list, results):
+    # table of the quantiles of all pairs (raw disparity in pixel) for masking and QC
+    # rows of pairs without new stats (skipped) are kept from the existing table
+    stats_file = os.path.join(exp_dir, 'disparity_stats.txt')
+    columns = ['Q{:02d}'.format(int(round(q * 100))) for q in QUANTILES]
+    header = 'PAIR\tDIRECTION\tCOUNT\t{}\n'.format('\t'.join(columns))
+
+    rows = {}
+    if(os.path.isfile(stats_file)):
+        with open(stats_file, 'r') as f:
+            lines = f.readlines()
+        if(lines and lines[0] == header):
+            for line in lines[1:]:
+                rows[tuple(line.split('\t')[:2])] = line
+
+    for d, r in zip(dir_list, results):
+        for direction, stats in r[1]:
+            rows[(os.path.basename(d), direction)] = '{}\t{}\t{}\t{}\n'.format(os.path.basename(d), direction, stats['COUNT'], '\t'.join([str(stats[q]) for q in QUANTILES]))
+
+    with open(stats_file, 'w') as f:
+        f.write(header)
+        for key in sorted(rows):
+            f.write(rows[key])
+
+def run_pairs(function, args_list, jobs, names, on_result=None):
+    # runs function for each args tuple, in a process pool if jobs > 1 (fork: the script has no main guard)
+    # on_result(result) is called as soon as a pair is finished (f.e. to save its manifest entries)
+    # a failing pair does not stop the others, the first error is raised when all pairs are finished
+    results, errors = [None] * len(args_list), []
+
+    def finish(i, get_result):
+        try:
+            results[i] = get_result()
+        except Exception as e:
+            print('Failed pair: {} ({}: {})'.format(names[i], type(e).__name__, e))
+            errors.append(e)
+            return
+        if(on_result):
+            on_result(results[i])
+
+    if(jobs > 1):
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = dict((pool.submit(function, *args), i) for i, args in enumerate(args_list))
+            for future in as_completed(futures):
+                finish(futures[future], future.result)
+    else:
+        for i, args in enumerate(args_list):
+            finish(i, lambda: function(*args))
 
-    save_to_file(cc, output_path, ncol, nrow)
+    if(errors):
+        raise errors[0]
+    return results
 
 def generate_input_inv_send(out_dir):
         # CHECK INPUT VARIABLE AT END OF STRING -> SET ALL TO 0
@@ -112,7 +586,8 @@ list_pair
 
 # input_file = either to H_wm or V_wm file
 # direction - information of direction; either H or V (for naming of resulting files)
-def process_single_disparity_NSBAS(input_file, direction, masked):
+# mask - virtual mask (aspsar.masks.Mask) applied to the input file, input_file is the ADJUSTED file then
+def process_single_disparity_NSBAS(input_file, direction, masked, mask=None):
 
     curr_pair = os.path.basename(input_file).split('-')[0]
     dates_pair = '{}-{}'.format(curr_pair.split('_')[0], curr_pair.split('_')[1])
@@ -141,13 +616,22 @@ def process_single_disparity_NSBAS(input_file, direction, masked):
     img_data = read_from_file(input_file, 1)
     los, ncol, nrow = img_data[0], img_data[1], img_data[2]
 
+    if(mask is not None):
+        los = mask.apply(los)
 
-    fid = open(out_file, 'wb')
+    # write to temporary file first, an interrupted export must not leave a truncated product
+    tmp_file = '{}.tmp'.format(out_file)
+    fid = open(tmp_file, 'wb')
     los.flatten().astype('float32').tofile(fid)
     fid.close()
+    os.replace(tmp_file, out_file)
 
     out_rsc = os.path.join(out_dir, '{}_{}.r4.rsc'.format(dates_pair, direction))
-    f = open(out_rsc, 'w')
+    save_rsc(out_rsc, ncol, nrow)
+
+    return out_file
+
+def save_rsc(out_rsc, ncol, nrow):
     f = open(out_rsc, "w")
     f.write("""\
       WIDTH                 %d
@@ -174,33 +658,64 @@ def get_date_list(pair_list, out_dir):
         for d in sorted(dates):
             f.write('{}\n'.format(d))
 
-def prepare_NSBAS(data_dir, masked):
+def process_pair_NSBAS(data_dir, f, masked, exp_dir, entries={}, use_hash=False, mask_name=None):
+    # returns the manifest entries of the .r4 files
+    # with mask_name data_dir is EXPORT/ADJUSTED and the virtual mask is applied on read
+    nsbas_dir = os.path.join(os.path.dirname(data_dir), 'NSBAS')
+    dates_pair = '{}-{}'.format(f.split('_')[0], f.split('_')[1])
+    new_entries = {}
+
+    mask, mask_file = None, None
+    if(mask_name):
+        mask_file = find_mask_file(exp_dir, mask_name, f)
+        if(mask_file is None):
+            return new_entries
+
+    for direction in ['H', 'V']:
+        if(masked and not mask_name):
+            input_file = os.path.join(data_dir, '{}-F-{}_wm_MASK.tif'.format(f, direction))
+        else:
+            input_file = os.path.join(data_dir, '{}-F-{}_wm.tif'.format(f, direction))
+
+        out_file = os.path.join(get_nsbas_dir(nsbas_dir, direction, masked), '{}_{}.r4'.format(dates_pair, direction))
+        fingerprint = get_file_fingerprint(input_file, use_hash, entries)
+        params = get_masked_params(masked, mask_file)
+        if(check_product(out_file, exp_dir, f, entries, fingerprint, params, new_entries)):
+            continue
+
+        if(mask_file and mask is None):
+            mask = Mask(mask_file)
+
+        print('Start: {}'.format(os.path.basename(input_file)))
+        process_single_disparity_NSBAS(input_file, direction, masked, mask)
+        add_products([out_file], exp_dir, f, fingerprint, [params], new_entries)
+        print('Finished: {}'.format(os.path.basename(input_file)))
+
+    return new_entries
+
+def prepare_NSBAS(data_dir, masked, jobs=1, manifest={}, use_hash=False, mask_name=None):
   
     # to only get unique values (bc for each pair 2 files(V&H)) - transform to set
     pair_set = set([d.split('-')[0] for d in os.listdir(data_dir)])
     # convert to list to keep list data type
     pair_list = list(pair_set)
 
-    for i, f in enumerate(pair_list):
-        print('Start pair ({}/{}): {}'.format(i+1, len(pair_list), f))
-        if(masked):
-            h_file = os.path.join(data_dir, '{}-F-H_wm_MASK.tif'.format(f))
-            v_file = os.path.join(data_dir, '{}-F-V_wm_MASK.tif'.format(f))
-        else:
-            h_file = os.path.join(data_dir, '{}-F-H_wm.tif'.format(f))
-            v_file = os.path.join(data_dir, '{}-F-V_wm.tif'.format(f))
-
-        print('Start: {}'.format(os.path.basename(h_file)))
-        process_single_disparity_NSBAS(h_file, 'H', masked)
-        print('Finished: {}'.format(os.path.basename(h_file)))
+    exp_dir = os.path.dirname(data_dir)
+    pair_entries = get_pair_entries(manifest)
 
-        print('Start: {}'.format(os.path.basename(v_file)))
-        process_single_disparity_NSBAS(v_file, 'V', masked)
-        print('Finished: {}'.format(os.path.basename(v_file)))
+    print('Process {} pairs with {} job(s)'.format(len(pair_list), jobs))
+    # the manifest is saved after each pair, the finished pairs are kept if a pair fails
+    def save_entries(new_entries):
+        manifest.update(new_entries)
+        save_manifest(exp_dir, manifest)
 
+    run_pairs(process_pair_NSBAS, [(data_dir, f, masked, exp_dir, pair_entries.get(f, {}), use_hash, mask_name) for f in pair_list], jobs, pair_list, save_entries)
 
     out_dir = os.path.join(os.path.dirname(data_dir), 'NSBAS')
+    finish_NSBAS(pair_list, out_dir)
 
+def finish_NSBAS(pair_list, out_dir):
+    # input_inv_send and dates_list.txt in EXPORT/NSBAS
     generate_input_inv_send(out_dir)
 
     get_date_list(pair_list, out_dir)
@@ -220,6 +735,33 @@ force = arguments['--f']
 # check if masked option is set - will use masked files as input
 masked = arguments['--masked']
 
+# virtual mask (EXPORT/MASKS/<name>) instead of the masked copies in EXPORT/MASKED
+mask_name = arguments['--mask']
+if(mask_name):
+    masked = True
+
+# direct export from correl-F.tif to NSBAS, optional with the ADJUSTED/CC GeoTIFFs
+direct = arguments['--direct']
+geotiff = arguments['--geotiff']
+
+# compare inputs by content in the export manifest
+use_hash = arguments['--hash']
+
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
+
+if(arguments['--block']):
+    block_rows = int(arguments['--block'])
+else:
+    block_rows = 512
+
+if(arguments['--quantile_error']):
+    quantile_error = float(arguments['--quantile_error'])
+else:
+    quantile_error = None
+
 # correl_dir is like working_dir, all the processing results are stored in data_dir/CORREL
 correl_dir = os.path.join(work_dir, 'CORREL')
 
@@ -240,10 +782,12 @@ cc_dir = os.path.join(exp_dir, 'CC')
 
 if(force):
     print('FORCE RECOMPUTATION: REMOVE EXPORT/ADJUSTED, EXPORT/NSBAS, EXPORT/RAW, EXPORT/CC')
-    shutil.rmtree(raw_dir)
-    shutil.rmtree(adj_dir)
-    shutil.rmtree(nsbas_dir)
-    shutil.rmtree(cc_dir)
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    shutil.rmtree(adj_dir, ignore_errors=True)
+    shutil.rmtree(nsbas_dir, ignore_errors=True)
+    shutil.rmtree(cc_dir, ignore_errors=True)
+    if(os.path.isfile(os.path.join(exp_dir, 'export_manifest.json'))):
+        os.remove(os.path.join(exp_dir, 'export_manifest.json'))
     
 # check and create subdirectories
 Path(raw_dir).mkdir(parents=True, exist_ok=True)
@@ -263,7 +807,12 @@ if(masked):
 
 Path(cc_dir).mkdir(parents=True, exist_ok=True)
 
-if(masked):
+if(mask_name):
+    if(not os.path.isdir(get_mask_dir(exp_dir, mask_name))):
+        print('EXPORT/MASKS/{} is not existing, run utils/mask_correl_results_cc.py --virtual={}'.format(mask_name, mask_name))
+    else:
+        print('Use virtual mask EXPORT/MASKS/{}'.format(mask_name))
+elif(masked and not direct):
     masked_input_dir = os.path.join(exp_dir, 'MASKED')
     if(not os.path.exists(masked_input_dir) or len(os.listdir(masked_input_dir)) <= 2):
         print('EXPORT/MASKED is not existing/empty, run utils/mask_correl_results_cc.py')
@@ -277,54 +826,32 @@ print('##################################')
 print('PROCESS AND COPY DISPARITY MAPS')
 print('##################################')
 
-for i, d in enumerate(dir_list):
-    print('Start pair ({}/{}): {}'.format(i+1, len(dir_list), os.path.basename(d)))
-    curr_pair = os.path.basename(d)
-    # use here the complete correl-F instead of the disparitydebug results
-    v_path = os.path.join(d, 'asp', 'correl-F.tif')
-    h_path = os.path.join(d, 'asp', 'correl-F.tif')
-    cc_path = os.path.join(d, 'asp', 'correl-F.tif')
-    
-    if(os.path.isfile(v_path)):
-        # add n_band based on direction
+# products of the last export with their inputs and parameters, only missing or outdated products are computed
+manifest = load_manifest(exp_dir)
+pair_entries = get_pair_entries(manifest)
 
-        if(os.path.isfile(os.path.join(adj_dir, '{}-F-H_wm.tif'.format(curr_pair)))):
-                print('Skip {}-F-H_wm.tif, already exists'.format(curr_pair))
-        else:
-            subtract_median(h_path, os.path.join(adj_dir, '{}-F-H_wm.tif'.format(curr_pair)), 1, range_sampl)
-        
-        if(os.path.isfile(os.path.join(adj_dir, '{}-F-V_wm.tif'.format(curr_pair)))):
-            print('Skip {}-F-V_wm.tif, already exists'.format(curr_pair))
-        else:
-            subtract_median(v_path, os.path.join(adj_dir, '{}-F-V_wm.tif'.format(curr_pair)), 2, az_sampl)
-        
-        if(os.path.isfile(os.path.join(adj_dir, '{}_CC.tif'.format(curr_pair)))):
-            print('Skip {}_CC.tif, already exists'.format(curr_pair))
-        else:
-            # gets the 3rd band from correl-F.tif which contains correlation coeffiecent map
-            get_cc_map(cc_path, os.path.join(cc_dir, '{}_CC.tif'.format(curr_pair)), 3)
+# the manifest is saved after each pair, the finished pairs are kept if a pair fails
+def save_entries(result):
+    manifest.update(result[2])
+    save_manifest(exp_dir, manifest)
 
-        # instead of copying, just link raw data to save space (maybe remove later)
-        #shutil.copy(h_path, os.path.join(raw_dir, '{}-F-H.tif'.format(curr_pair)))
-        #shutil.copy(v_path, os.path.join(raw_dir, '{}-F-V.tif'.format(curr_pair)))
+pair_names = [os.path.basename(d) for d in dir_list]
+print('Process {} pairs with {} job(s)'.format(len(dir_list), jobs))
+if(direct):
+    print('Direct export to NSBAS')
+    results = run_pairs(export_pair_direct, [(d, exp_dir, nsbas_dir, adj_dir, cc_dir, raw_dir, range_sampl, az_sampl, masked, geotiff, block_rows, quantile_error, pair_entries.get(os.path.basename(d), {}), use_hash, mask_name) for d in dir_list], jobs, pair_names, save_entries)
+else:
+    results = run_pairs(process_pair, [(d, exp_dir, adj_dir, cc_dir, raw_dir, range_sampl, az_sampl, block_rows, quantile_error, pair_entries.get(os.path.basename(d), {}), use_hash) for d in dir_list], jobs, pair_names, save_entries)
 
-        if(os.path.isfile(os.path.join(raw_dir, '{}-F-H.tif'.format(curr_pair)))):
-            print('Skip linking of {}'.format(curr_pair))
-        else:
-            os.symlink(h_path, os.path.join(raw_dir, '{}-F-H.tif'.format(curr_pair)))
-            os.symlink(v_path, os.path.join(raw_dir, '{}-F-V.tif'.format(curr_pair)))
+save_disparity_stats(exp_dir, dir_list, results)
 
-        print('Finished pair: {}'.format(os.path.basename(d)))
-    else:
-        print('No correl-F.tif file found in {}'.format(curr_pair))
-        # add to print names to list
-        missing_correl_file = os.path.join(correl_dir, 'missing_correl_files.txt')
-        if(os.path.isfile(missing_correl_file)):
-            with open(missing_correl_file, 'a') as miss_file:
-                miss_file.write('{}\t{}\n'.format(curr_pair.split('_')[0], curr_pair.split('_')[1]))
-        else:    
-            with open(missing_correl_file, 'w') as miss_file:
-                miss_file.write('{}\t{}\n'.format(curr_pair.split('_')[0], curr_pair.split('_')[1]))
+# add names of pairs without correl-F.tif to list
+missing_pairs = [os.path.basename(d) for d, r in zip(dir_list, results) if not r[0]]
+if(missing_pairs):
+    missing_correl_file = os.path.join(correl_dir, 'missing_correl_files.txt')
+    with open(missing_correl_file, 'a') as miss_file:
+        for curr_pair in missing_pairs:
+            miss_file.write('{}\t{}\n'.format(curr_pair.split('_')[0], curr_pair.split('_')[1]))
 
 # maybe add here masking based on CC_map - set input option to apply  optional 
 
@@ -334,9 +861,15 @@ print('##################################')
 
 #TODO: add update option -> import for the links/textfiles -> f.e. watch out, don't overwrite input_inv_send
 
-if(masked):
-    prepare_NSBAS(masked_input_dir, masked)
+if(direct):
+    # .r4 files are already written, only the NSBAS input files are missing
+    finish_NSBAS([os.path.basename(d) for d, r in zip(dir_list, results) if r[0]], nsbas_dir)
+elif(mask_name):
+    # ADJUSTED files masked on read
+    prepare_NSBAS(adj_dir, masked, jobs, manifest, use_hash, mask_name)
+elif(masked):
+    prepare_NSBAS(masked_input_dir, masked, jobs, manifest, use_hash)
 else:
-    prepare_NSBAS(adj_dir, masked)
+    prepare_NSBAS(adj_dir, masked, jobs, manifest, use_hash)
 
 
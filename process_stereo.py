@@ -5,15 +5,21 @@ process_stereo.py
 ----------------------
 Process all SAR data pairs with ASP parallel_stereo. It uses the current settings of asp_parameters.txt in the project directory. The list file containing the pairs has to be in the format of MasTer (see MasTer prepa_MSBAS.sh)
 
-Usage: process_stereo.py [--f] --data=<path> --pairs=<path>
+Usage: process_stereo.py [--f] --data=<path> --pairs=<path> [--jobs=<value>] [--executor=<value>] [--submit=<path>] [--order=<value>]
 proces_stereo.py -h | --help
 
 Options:
 --data=<path>       Path to directory with linked and coregistered data (prepared in prepare_correl_dir.py); if directory is to be updated, this dir must be the working directory (indicated by a timestamp)
 --pairs=<path>      Path to .txt-file with list of image pairs
+--jobs=<value>      Number of pairs processed at the same time. The log of each pair is written to CORREL/LOGS [default: 1]
+--executor=<value>  Where the pairs are processed: local or submit. local runs run_stereo.sh on this host and splits the THREADS of asp_parameters.txt between the running pairs. submit runs the command of --submit for each pair (f.e. sbatch, ssh) and waits for it to finish [default: local]
+--submit=<path>     Path to file with the submit command template (see example/submit_slurm.txt)
+--order=<value>     Order in which the pairs are started: cost or table. cost starts the pairs with the longest expected runtime first (estimated from image size, nodata fraction, temporal baseline and the runtimes of previous pairs), table keeps the order of the pair list [default: cost]
 --f                 Force complete recomputation
 -h --help           Show this screen
 
+The state of each pair (queued, running, succeeded, failed) is journaled in CORREL/pair_state.jsonl. A re-run only processes the pairs that are not succeeded or miss asp/correl-F.tif; incomplete pair directories are removed before they are processed again.
+
 """
 
 ##########
@@ -29,31 +35,304 @@ import datetime
 import shutil
 import docopt
 import subprocess 
+import json
+import time
+import threading
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 #############
 # FUNCTIONS #
 #############
 
-def stereo_single_pair(data_dir, correl_dir, date1, date2):
-    subprocess.call('/home/florian/ASP-SAR/run_stereo.sh {} {} {} {}'.format(data_dir, correl_dir, date1, date2), shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT, env=os.environ)
-    
+def get_asp_parameter(data_dir, name):
+    # read a single variable from the asp_parameters.txt in the working directory
+    with open(os.path.join(data_dir, 'asp_parameters.txt'), 'r') as f:
+        for l in f.readlines():
+            l = l.split('#')[0].strip()
+            if(l.startswith('{}='.format(name))):
+                return l.split('=', 1)[1].strip().strip('"')
+    return None
+
+def get_run_stereo_script():
+    # run_stereo.sh is in the root of the ASP-SAR installation
+    aspsar_dir = os.environ.get('ASPSAR', os.path.dirname(os.path.realpath(__file__)))
+    return os.path.join(aspsar_dir, 'run_stereo.sh')
+
+## EXECUTORS ##
+# all executors process one pair and return the exit code: executor(data_dir, correl_dir, date1, date2, threads, log_file)
+# threads overwrites THREADS of asp_parameters.txt, log_file redirects the output of the pair (None: stdout)
+
+def stereo_single_pair(data_dir, correl_dir, date1, date2, threads=None, log_file=None):
+    # local executor: run run_stereo.sh on this host
+    cmd = '{} {} {} {} {}'.format(get_run_stereo_script(), data_dir, correl_dir, date1, date2)
+    if(threads):
+        cmd = '{} {}'.format(cmd, threads)
+
+    if(log_file):
+        with open(log_file, 'w') as log:
+            return subprocess.call(cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=os.environ)
+    else:
+        return subprocess.call(cmd, shell=True, stdout=sys.stdout, stderr=subprocess.STDOUT, env=os.environ)
+
+def read_submit_template(submit_file):
+    # the template is the first line of the file that is not empty or a comment
+    with open(submit_file, 'r') as f:
+        for l in f.readlines():
+            if(l.strip() and not l.strip().startswith('#')):
+                return l.strip()
+    raise ValueError('No submit command found in {}'.format(submit_file))
+
+def stereo_submit_pair(template, data_dir, correl_dir, date1, date2, threads=None, log_file=None):
+    # submit executor: run the command of the template, it has to block until the pair is processed
+    # placeholders: {script} {data_dir} {correl_dir} {date1} {date2} {pair} {threads} {log}
+    cmd = template.format(script=get_run_stereo_script(), data_dir=os.path.abspath(data_dir), correl_dir=os.path.abspath(correl_dir), date1=date1, date2=date2, pair='{}_{}'.format(date1, date2), threads=threads, log=os.path.abspath(log_file))
+
+    # output of the submit command itself, the output of the job goes to {log}
+    with open('{}.submit'.format(log_file), 'w') as log:
+        log.write('{}\n'.format(cmd))
+        log.flush()
+        return subprocess.call(cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=os.environ)
+
+def get_executor(name, submit_file):
+    if(name == 'local'):
+        return stereo_single_pair
+    elif(name == 'submit'):
+        template = read_submit_template(submit_file)
+        return lambda data_dir, correl_dir, date1, date2, threads, log_file: stereo_submit_pair(template, data_dir, correl_dir, date1, date2, threads, log_file)
+    else:
+        raise ValueError('Unknown executor: {} (local or submit)'.format(name))
+
+# journal of the pair states, one json record per line - the last record of a pair is its current state
+# records are only appended, a crash can at most leave an incomplete last line
+state_lock = threading.Lock()
+
+def load_pair_states(state_file):
+    states = {}
+    if(os.path.isfile(state_file)):
+        with open(state_file, 'r') as f:
+            for l in f:
+                try:
+                    record = json.loads(l)
+                except ValueError:
+                    # incomplete line of a crashed run
+                    continue
+                states[record['pair']] = record
+    return states
+
+def write_pair_states(state_file, states, records):
+    with state_lock:
+        # start on a new line if the last record of a crashed run is incomplete
+        incomplete = False
+        if(os.path.isfile(state_file) and os.path.getsize(state_file) > 0):
+            with open(state_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                incomplete = f.read(1) != b'\n'
+        with open(state_file, 'a') as f:
+            if(incomplete):
+                f.write('\n')
+            for record in records:
+                f.write('{}\n'.format(json.dumps(record)))
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            states[record['pair']] = record
+
+def update_pair_state(state_file, states, pair, state, **info):
+    # keep the information of the previous record (f.e. start time) and overwrite the new values
+    record = dict(states.get(pair, {}), pair=pair, state=state, **info)
+    write_pair_states(state_file, states, [record])
+    return record
+
+def get_correl_file(correl_dir, pair):
+    return os.path.join(correl_dir, pair, 'asp', 'correl-F.tif')
+
+def pair_is_done(correl_dir, states, pair):
+    # a pair is only done if it succeeded and its result still exists
+    # pairs from runs before the journal existed are done if correl-F.tif exists
+    correl_file_exists = os.path.isfile(get_correl_file(correl_dir, pair))
+    if(pair in states):
+        return states[pair]['state'] == 'succeeded' and correl_file_exists
+    return correl_file_exists
+
+def stereo_pair_job(executor, data_dir, correl_dir, date1, date2, threads, log_dir, state_file, states):
+    # process one pair with the executor and journal its state, returns the exit code
+    pair = '{}_{}'.format(date1, date2)
+    print('Start processing: {}'.format(pair))
+
+    update_pair_state(state_file, states, pair, 'running', start=time.time(), end=None, exit_code=None, correl_file=False, error=None)
+    try:
+        if(log_dir):
+            exit_code = executor(data_dir, correl_dir, date1, date2, threads, os.path.join(log_dir, '{}.log'.format(pair)))
+        else:
+            exit_code = executor(data_dir, correl_dir, date1, date2, threads, None)
+    except Exception as e:
+        # f.e. wrong submit template or run_stereo.sh not executable, only this pair fails
+        error = '{}: {}'.format(type(e).__name__, e)
+        print('Error processing {}: {}'.format(pair, error))
+        update_pair_state(state_file, states, pair, 'failed', end=time.time(), exit_code=-1, correl_file=False, error=error)
+        return -1
+
+    # parallel_stereo can fail without error code, also check if the result exists
+    correl_file_exists = os.path.isfile(get_correl_file(correl_dir, pair))
+    state = 'succeeded' if(exit_code == 0 and correl_file_exists) else 'failed'
+    update_pair_state(state_file, states, pair, state, end=time.time(), exit_code=exit_code, correl_file=correl_file_exists)
+
+    print('Finished processing: {} ({})'.format(pair, state))
+    return exit_code
+
+## COST ESTIMATION ##
+
+def get_image_info(geotiff_dir, date, image_info):
+    # number of pixel and fraction of valid pixel (!= 0) of GEOTIFF/DATE.VV.mod_log.tif
+    # image_info caches the results, every date is only read once, None if the image is missing
+    if(date not in image_info):
+        try:
+            ds = gdal.Open(os.path.join(geotiff_dir, '{}.VV.mod_log.tif'.format(date)))
+        except RuntimeError:
+            ds = None
+        if(ds is None):
+            # f.e. date skipped by convert_geotiff.py --report, the pair fails in the executor
+            image_info[date] = None
+            return None
+        ncol, nrow = ds.RasterXSize, ds.RasterYSize
+        # decimated read of the image is enough to estimate the nodata fraction
+        step = max(1, int(max(ncol, nrow) / 512))
+        sample = ds.GetRasterBand(1).ReadAsArray(0, 0, ncol, nrow, buf_xsize=max(1, ncol // step), buf_ysize=max(1, nrow // step))
+        valid = np.count_nonzero(np.isfinite(sample) & (sample != 0)) / sample.size
+        image_info[date] = (ncol * nrow, valid)
+    return image_info[date]
+
+def get_pair_features(geotiff_dir, date1, date2, image_info):
+    # (number of valid pixel to correlate, temporal baseline in years), None if an image is missing
+    info1, info2 = get_image_info(geotiff_dir, date1, image_info), get_image_info(geotiff_dir, date2, image_info)
+    if(info1 is None or info2 is None):
+        return None
+    (npix1, valid1), (npix2, valid2) = info1, info2
+    bt = abs((datetime.datetime.strptime(str(date2), '%Y%m%d') - datetime.datetime.strptime(str(date1), '%Y%m%d')).days) / 365.0
+    return (max(npix1, npix2) * min(valid1, valid2), bt)
+
+def estimate_pair_costs(geotiff_dir, todo, states):
+    # cost model: runtime = a * valid_pixel + b * valid_pixel * Bt
+    # a and b are fitted to the runtimes of the succeeded pairs in the journal, if there are not enough use a = b = 1 (relative cost)
+    image_info = {}
+    features = {(date1, date2): get_pair_features(geotiff_dir, date1, date2, image_info) for date1, date2 in todo}
 
-def stereo_pair_list(data_dir, correl_dir, pair_list):
+    X, y = [], []
+    for pair, record in states.items():
+        if(record['state'] != 'succeeded' or not record.get('start') or not record.get('end')):
+            continue
+        date1, date2 = pair.split('_')
+        try:
+            pair_features = get_pair_features(geotiff_dir, date1, date2, image_info)
+        except ValueError:
+            continue
+        # image not available anymore or without valid pixel (no information on the runtime per pixel)
+        if(pair_features is None or pair_features[0] == 0):
+            continue
+        npix, bt = pair_features
+        X.append([npix, npix * bt])
+        y.append(record['end'] - record['start'])
+
+    a, b, unit = 1.0, 1.0, 'relative'
+    if(len(y) >= 3):
+        coef = np.linalg.lstsq(np.array(X), np.array(y), rcond=None)[0]
+        if(coef[0] > 0 and coef[1] >= 0):
+            a, b, unit = coef[0], coef[1], 's'
+        else:
+            # baseline dependency cannot be resolved, only fit the runtime per pixel
+            a, b, unit = np.median(np.array(y) / np.array(X)[:,0]), 0.0, 's'
+        print('Cost model from {} previous pairs: {:.3e} s/pixel + {:.3e} s/pixel/year'.format(len(y), a, b))
+
+    costs = {pair: a * f[0] + b * f[0] * f[1] for pair, f in features.items() if f is not None}
+    # pairs with a missing image get the median cost, they are not moved to the start or the end
+    missing = [pair for pair, f in features.items() if f is None]
+    if(missing):
+        print('Missing GEOTIFF images for {} pairs, use the median cost'.format(len(missing)))
+        neutral = np.median(list(costs.values())) if costs else 1.0
+        for pair in missing:
+            costs[pair] = neutral
+    return (costs, unit)
+
+def get_makespan(costs, jobs):
+    # expected end of the last pair if the pairs are started in the given order on jobs workers
+    workers = [0.0] * max(1, jobs)
+    for c in costs:
+        heapq.heappush(workers, heapq.heappop(workers) + c)
+    return max(workers)
+
+def stereo_pair_list(data_dir, correl_dir, pair_list, jobs=1, executor_name='local', submit_file=None, order='cost'):
     pair_df = pd.read_csv(pair_list, sep='\s+')
 
     # copy file to dir instead of using link -> if original is changed, no impact in dir
     # check if table file is already existing, if yes - replace
     shutil.copy(pair_list, os.path.join(correl_dir, os.path.basename(pair_list)))
+
+    executor = get_executor(executor_name, submit_file)
+
+    if(jobs <= 1 and executor_name == 'local'):
+        # keep the output of parallel_stereo in the terminal, run_stereo.sh reads THREADS itself
+        log_dir = None
+        threads = None
+    else:
+        asp_threads = get_asp_parameter(data_dir, 'THREADS')
+        if(asp_threads is None):
+            print('THREADS is missing in {}, needed with --jobs > 1 or the {} executor'.format(os.path.join(data_dir, 'asp_parameters.txt'), executor_name))
+            sys.exit(1)
+        if(executor_name == 'local'):
+            # split the THREADS of asp_parameters.txt between the running pairs
+            threads = max(1, int(asp_threads) // jobs)
+        else:
+            # every submitted pair runs on its own node and uses all THREADS
+            threads = int(asp_threads)
+
+        log_dir = os.path.join(correl_dir, 'LOGS')
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    state_file = os.path.join(correl_dir, 'pair_state.jsonl')
+    states = load_pair_states(state_file)
     
-    # if pair already exists - skip 
+    # if pair already succeeded - skip, remove leftovers of crashed or failed runs
+    todo = []
     for index, rows in pair_df.iterrows():
         date1, date2 = rows['Master'], rows['Slave']
-        if(os.path.isdir(os.path.join(correl_dir, '{}_{}'.format(date1, date2)))):
+        pair = '{}_{}'.format(date1, date2)
+        if(pair_is_done(correl_dir, states, pair)):
             continue
+        if(os.path.isdir(os.path.join(correl_dir, pair))):
+            print('Remove incomplete pair: {}'.format(pair))
+            shutil.rmtree(os.path.join(correl_dir, pair))
+        todo.append((date1, date2))
+
+    if(order == 'cost' and todo):
+        # longest expected runtime first, avoids a long tail with a single running pair at the end
+        costs, unit = estimate_pair_costs(os.path.join(data_dir, 'GEOTIFF'), todo, states)
+        table_makespan = get_makespan([costs[p] for p in todo], jobs)
+        todo = sorted(todo, key=lambda p: costs[p], reverse=True)
+        print('Expected makespan: {:.1f} ({}) in cost order, {:.1f} in table order'.format(get_makespan([costs[p] for p in todo], jobs), unit, table_makespan))
+
+    queued = []
+    for date1, date2 in todo:
+        pair = '{}_{}'.format(date1, date2)
+        queued.append(dict(states.get(pair, {}), pair=pair, state='queued'))
+    write_pair_states(state_file, states, queued)
+
+    print('Process {} pairs with {} jobs ({} executor)'.format(len(todo), jobs, executor_name))
+
+    # the pairs are processed by run_stereo.sh in its own process, threads are enough to wait for them
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {'{}_{}'.format(date1, date2): pool.submit(stereo_pair_job, executor, data_dir, correl_dir, date1, date2, threads, log_dir, state_file, states) for date1, date2 in todo}
+        exit_codes = {pair: f.result() for pair, f in futures.items()}
+
+    failed = [pair for pair in exit_codes if states[pair]['state'] == 'failed']
+    print('Processed {} pairs, {} failed'.format(len(exit_codes), len(failed)))
+    for pair in failed:
+        if(states[pair].get('error')):
+            print('Failed: {} ({})'.format(pair, states[pair]['error']))
+        elif(log_dir):
+            print('Failed: {} (exit code {}), see {}'.format(pair, exit_codes[pair], os.path.join(log_dir, '{}.log'.format(pair))))
         else:
-            print('Start processing: {}_{}'.format(date1, date2))
-            stereo_single_pair(data_dir, correl_dir, date1, date2)
-            print('Finished processing: {}_{}'.format(date1, date2))
+            print('Failed: {} (exit code {})'.format(pair, exit_codes[pair]))
 
     
 ########
@@ -71,6 +350,26 @@ pair_list = arguments['--pairs']
 # instead of update - only calculate new pairs from table (but already implemented in stereo_pair_list)
 force = arguments['--f']
 
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
+
+if(arguments['--executor']):
+    executor_name = arguments['--executor']
+else:
+    executor_name = 'local'
+submit_file = arguments['--submit']
+
+if(arguments['--order']):
+    order = arguments['--order']
+else:
+    order = 'cost'
+
+if(executor_name == 'submit' and submit_file is None):
+    print('The submit executor needs a command template, set --submit')
+    sys.exit(1)
+
 # if force - remove CORREL shutil.rmtree()
 
 
@@ -107,5 +406,5 @@ else:
 
 # RUN PROCESSING #
 
-stereo_pair_list(data_dir, correl_dir, pair_list)
+stereo_pair_list(data_dir, correl_dir, pair_list, jobs, executor_name, submit_file, order)
 
@@ -6,7 +6,7 @@ invert_cube2slope.py
 Project each map of LOS cube in line of steepest slope and saves it in cube. Possible to crop the result to a given extent
 
 Usage:
-    invert_cube2slope.py --range_cube=<path> --azimuth_cube=<path> --inc=<path> --aspect=<path> --heading=<value> --dest=<path> --ext=<value> [--crop=<value>]
+    invert_cube2slope.py --range_cube=<path> --azimuth_cube=<path> --inc=<path> --aspect=<path> --heading=<value> --dest=<path> --ext=<value> [--crop=<value>] [--max_cond=<value>] [--tile=<value>] [--jobs=<value>] [--geometry=<path>]
     invert_cube2slope.py --test
     invert_cube2slope.py -h | --help
 
@@ -20,6 +20,10 @@ Options:
 --dest                  Path to destination 
 --ext                   Naming extension of output file 
 --crop                  Crop dimensions ymin,ymax,xmin,xmax
+--max_cond              Pixel with a condition number of G above this value are set to NaN (default: only singular G)
+--tile                  Size of the square tiles that are inverted at once [default: 512]
+--jobs                  Number of tiles inverted in parallel [default: 1]
+--geometry              Path to geometry file (GeoTIFF with G coefficients, determinant and condition number). Computed at the full extent if it does not exist or was computed from other inputs, reused otherwise (f.e. for new cubes or other crops of the same track)
 --test                  Run synthetic test
 
 """
@@ -30,19 +34,24 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
 import pandas as pd
 from pathlib import Path
 import shutil
 from dateutil import parser
 import docopt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
+from aspsar.cube import Cube, CubeWriter
 
 #############
 # FUNCTIONS #
 #############
 
+# bands of the geometry file
+GEOMETRY_BANDS = ['g00', 'g10', 'g11', 'det', 'cond']
+
 ## TEST FUNCTIONS ##
 
 def run_synt_test(u_rg_map, u_az_map, phi, heading_rad, theta, omega):
@@ -284,72 +293,25 @@ def get_cube_dimension(cube_file):
     return img_data
 
 def read_tif(input_file, crop):
+    # only the crop extent (ymin, ymax, xmin, xmax) is read from the file
 
     ds = gdal.OpenEx(input_file, allowed_drivers=['GTiff'])
     ds_band = ds.GetRasterBand(1)
-    values = ds_band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-    
-    if(crop):
-        return values[crop[0]:crop[1], crop[2]:crop[3]]
-    else:
-        return values
-
-def read_file(input_file, nlines, ncols, crop):
-    # read file and return content as output array
-    
-    print('Read {}'.format(os.path.basename(input_file)))
-
-    m = np.fromfile(input_file, dtype=np.float32)
-    map_i = m[:nlines*ncols].reshape((nlines,ncols))
 
     if(crop):
-        return map_i[crop[0]:crop[1], crop[2]:crop[3]]
+        return ds_band.ReadAsArray(crop[2], crop[0], crop[3] - crop[2], crop[1] - crop[0])
     else:
-        return map_i
-
-def read_cube(cube_file, ncol, nlines, n_img, crop):
-    
-    print('Start reading cube file')
+        return ds_band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
 
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
+def read_file(input_file, nlines, ncols, crop):
+    # read file and return content as output array, only the crop extent is read from the file
 
-    print('Finished reading cube file')
+    m = np.memmap(input_file, dtype=np.float32, mode='r', shape=(nlines, ncols))
 
     if(crop):
-        return maps[crop[0]:crop[1], crop[2]:crop[3],:]
+        return np.array(m[crop[0]:crop[1], crop[2]:crop[3]])
     else:
-        return maps
-
-def save_cube(dest_path, out_filename, maps):
-    print('Writing cube')
-
-    fid = open(os.path.join(dest_path, out_filename), 'wb')
-    maps[:,:,:].flatten().astype('float32').tofile(fid)
-    fid.close()
-
-def save_cube_metadata(dest_path, out_filename, img_data):
-    nrow, ncol, nimg = img_data[0], img_data[1], img_data[2]
-
-    # be careful here with ncol, nrow (normal: lines=nrow; samples=ncol)
-    with open(os.path.join(dest_path, '{}.hdr'.format(out_filename)), 'w') as hdr_file:
-        hdr_file.write("ENVI\n")
-        hdr_file.write("samples = {}\n".format(ncol))
-        hdr_file.write("lines = {}\n".format(nrow))
-        hdr_file.write("bands = {}\n".format(nimg))
-        hdr_file.write("header offset = 0\n")
-        hdr_file.write("file type = ENVI Standard\n")
-        hdr_file.write("data type = 4\n")  # 4 represents float32, adjust if needed
-        hdr_file.write("interleave = bip") # add this to display in QGIS and Insar-viz
-   
-    # save also .in file to plot pixel
-    with open(os.path.join(dest_path, 'lect_{}.in'.format(out_filename)), 'w') as lect_file:
-        lect_file.write('\t{}\t{}\t{}'.format(ncol, nrow, nimg))
+        return np.array(m)
 
 def construct_G(i, j, phi, heading_rad, theta, omega):
     
@@ -373,27 +335,145 @@ def construct_G(i, j, phi, heading_rad, theta, omega):
     
     return G
 
-def invert_single_map(range_map, azimuth_map, phi, heading_rad, theta, omega):
-    
-    # print(range_map.shape)
-    uslope = np.zeros((range_map.shape[0], range_map.shape[1]))
-    uz = np.zeros((range_map.shape[0], range_map.shape[1]))
-
-    for i in range(range_map.shape[0]):
-        if (i + 1) % 100 == 0:
-            print('Process line {} from {}'.format(i, range_map.shape[0]))
-        for j in range(range_map.shape[1]):
-            
-            d = np.array([azimuth_map[i][j], range_map[i][j]])
-            G = construct_G(i, j, phi, heading_rad, theta, omega)
+def compute_G_coefficients(phi, heading_rad, theta, omega, max_cond=None):
+    # closed form of G = PROJ . R_aspect (see construct_G) for all pixels at once, G[0][1] is always 0
+    # G = [[cos(heading + omega), 0], [cos(theta) * cos(phi + omega), sin(theta)]]
+    g00 = np.cos(heading_rad + omega)
+    g10 = np.cos(theta) * np.cos(phi + omega)
+    g11 = np.sin(theta)
+    det = g00 * g11
+
+    # condition number from the singular values of the 2x2 matrix: s1/s2 = s1^2/|det|
+    s = g00**2 + g10**2 + g11**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cond = (s + np.sqrt(np.maximum(s**2 - 4*det**2, 0))) / (2*np.abs(det))
+
+    return mask_G_coefficients((g00, g10, g11, det, cond), max_cond)
+
+def mask_G_coefficients(coeffs, max_cond=None):
+    # set G of singular or ill-conditioned pixels to NaN, the inversion returns NaN there
+    g00, g10, g11, det, cond = coeffs
+
+    invalid = (det == 0) | ~np.isfinite(cond)
+    if(max_cond is not None):
+        invalid = invalid | (cond > max_cond)
+    g00 = np.where(invalid, np.nan, g00)
+    g11 = np.where(invalid, np.nan, g11)
 
-            m = np.linalg.inv(G).dot(d)
+    return (g00, g10, g11, det, cond)
 
-            uslope[i][j] = m[0]
-            uz[i][j] = m[1]
+def invert_maps(range_maps, azimuth_maps, coeffs):
+    # maps are (nlines, ncols) or blocks of all dates (nlines, ncols, n_img), G is the same for all dates
+    g00, g10, g11 = coeffs[0], coeffs[1], coeffs[2]
+    if(range_maps.ndim == 3):
+        g00, g10, g11 = g00[:, :, np.newaxis], g10[:, :, np.newaxis], g11[:, :, np.newaxis]
+
+    # lower triangular G: solve d = G.m by substitution
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uslope = azimuth_maps / g00
+        uz = (range_maps - g10 * uslope) / g11
 
     return (uslope, uz)
 
+def invert_single_map(range_map, azimuth_map, phi, heading_rad, theta, omega):
+    coeffs = compute_G_coefficients(phi, heading_rad, theta, omega)
+
+    return invert_maps(range_map, azimuth_map, coeffs)
+
+def get_tiles(nlines, ncols, tile_size):
+    # (ymin, ymax, xmin, xmax) of the tiles covering the extent
+    return [(y, min(y + tile_size, nlines), x, min(x + tile_size, ncols)) for y in range(0, nlines, tile_size) for x in range(0, ncols, tile_size)]
+
+def compute_window_coefficients(params, window):
+    # G coefficients of a window (ymin, ymax, xmin, xmax) of the full extent, only singular G are masked
+    nlines, ncols = params['img_data'][0], params['img_data'][1]
+
+    aspect = read_tif(params['aspect'], window)
+    incidence = read_file(params['inc'], nlines, ncols, window)
+
+    theta = np.radians(90 - incidence)
+    omega = np.radians(np.mod(aspect - 90, 360))
+
+    return compute_G_coefficients(params['phi'], params['heading_rad'], theta, omega)
+
+def get_geometry_metadata(heading, incidence_file, aspect_file, nlines, ncols):
+    # the geometry only depends on these inputs, not on the cubes
+    return {'HEADING': str(float(heading)), 'NLINES': str(nlines), 'NCOLS': str(ncols),
+            'INCIDENCE': os.path.abspath(incidence_file), 'INCIDENCE_MTIME': str(os.path.getmtime(incidence_file)),
+            'ASPECT': os.path.abspath(aspect_file), 'ASPECT_MTIME': str(os.path.getmtime(aspect_file))}
+
+def check_geometry_file(geometry_file, metadata):
+    if(not os.path.exists(geometry_file)):
+        return False
+
+    ds = gdal.Open(geometry_file)
+    if(ds is None or ds.RasterCount != len(GEOMETRY_BANDS)):
+        return False
+    file_metadata = ds.GetMetadata()
+
+    return all(file_metadata.get(k) == v for k, v in metadata.items())
+
+def save_geometry_file(geometry_file, metadata, params, tile_size):
+    # computed tile by tile at the full extent of the inputs, so it can be used for every crop
+    nlines, ncols = params['img_data'][0], params['img_data'][1]
+    print('Compute geometry file {}'.format(geometry_file))
+
+    tmp_file = '{}.tmp'.format(geometry_file)
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(tmp_file, ncols, nlines, len(GEOMETRY_BANDS), gdal.GDT_Float32, options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+
+    # same georeferencing as the aspect map
+    ds_aspect = gdal.OpenEx(params['aspect'], allowed_drivers=['GTiff'])
+    ds.SetGeoTransform(ds_aspect.GetGeoTransform())
+    ds.SetProjection(ds_aspect.GetProjection())
+    ds.SetMetadata(metadata)
+
+    for b, name in enumerate(GEOMETRY_BANDS):
+        ds.GetRasterBand(b + 1).SetDescription(name)
+
+    for window in get_tiles(nlines, ncols, tile_size):
+        coeffs = compute_window_coefficients(params, window)
+        for b in range(len(GEOMETRY_BANDS)):
+            ds.GetRasterBand(b + 1).WriteArray(coeffs[b].astype(np.float32), window[2], window[0])
+
+    ds.FlushCache()
+    ds = None
+    os.replace(tmp_file, geometry_file)
+
+def read_geometry_window(geometry_file, window):
+    ds = gdal.Open(geometry_file)
+    xsize, ysize = window[3] - window[2], window[1] - window[0]
+
+    return tuple(ds.GetRasterBand(b + 1).ReadAsArray(window[2], window[0], xsize, ysize) for b in range(len(GEOMETRY_BANDS)))
+
+def invert_tile(params, tile):
+    # tile in the coordinates of the output cubes, the inputs are only read in the corresponding window
+    nlines, ncols, n_img = params['img_data']
+    nlines_out, ncols_out = params['out_dim']
+    y0, x0 = params['offset']
+    window = (tile[0] + y0, tile[1] + y0, tile[2] + x0, tile[3] + x0)
+
+    range_cube = Cube(params['range_cube'], ncols, nlines, n_img)
+    azimuth_cube = Cube(params['azimuth_cube'], ncols, nlines, n_img)
+
+    # G from the geometry file or computed for the window
+    if(params['geometry']):
+        coeffs = read_geometry_window(params['geometry'], window)
+    else:
+        coeffs = compute_window_coefficients(params, window)
+    coeffs = mask_G_coefficients(coeffs, params['max_cond'])
+
+    uslope, uz = invert_maps(range_cube.window(*window), azimuth_cube.window(*window), coeffs)
+
+    # the output cubes are preallocated by the main process, write the tile directly in the files
+    outputs = [(params['uslope'], n_img, uslope), (params['uz'], n_img, uz), (params['cond'], 1, coeffs[4][:, :, np.newaxis])]
+    for out_filename, out_img, data in outputs:
+        writer = CubeWriter(params['dest'], out_filename, nlines_out, ncols_out, out_img, mode='r+')
+        writer.write_window(tile[0], tile[2], data)
+        writer.flush()
+
+    return np.count_nonzero(np.isnan(coeffs[0]))
+
 ########
 # MAIN #
 ########
@@ -466,6 +546,11 @@ heading = arguments['--heading']
 dest_path = arguments['--dest']
 ext = arguments['--ext']
 
+if(arguments['--max_cond']):
+    max_cond = float(arguments['--max_cond'])
+else:
+    max_cond = None
+
 ## Read and prepare all input data
 
 # get cube dimensions from one of the cubes 
@@ -486,16 +571,17 @@ else:
     crop = None
     print('No crop option is set. Process the full extent of cube')
 
-range_maps = read_cube(range_cube_file, ncols, nlines, n_img, crop)
-azimuth_maps = read_cube(azimuth_cube_file, ncols, nlines, n_img, crop)
-
-# read other files
-aspect = read_tif(aspect_file, crop)
+if(arguments['--tile']):
+    tile_size = int(arguments['--tile'])
+else:
+    tile_size = 512
 
-plt.imshow(aspect)
-plt.show()
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
 
-incidence = read_file(incidence_file, nlines, ncols, crop)
+geometry_file = arguments['--geometry']
 
 # define angles for projection and convert in radians
 
@@ -505,52 +591,33 @@ print('Phi = {} rad ({} Grad)'.format(phi, -360 + float(heading) + 90))
 heading_rad = np.radians(float(heading))
 print('H = {} rad ({} Grad)'.format(heading_rad, heading))
 
+# get the final size of cube to avoid a lot of conditions
+nlines_final = nlines_crop if crop else nlines
+ncols_final = ncols_crop if crop else ncols
+print(nlines_final, ncols_final)
+offset = (crop[0], crop[2]) if crop else (0, 0)
+
+# print test pixel for reference, get the pixel in the middle (only this pixel is read)
+test_x, test_y = int(nlines_final/2), int(ncols_final/2)
+test_window = (offset[0] + test_x, offset[0] + test_x + 1, offset[1] + test_y, offset[1] + test_y + 1)
+incidence = read_file(incidence_file, nlines, ncols, test_window)
+aspect = read_tif(aspect_file, test_window)
+
 theta = np.radians(90 - incidence)
-# print test pixel for reference, get the pixel in the middle
-test_x, test_y = int(aspect.shape[0]/2), int(aspect.shape[1]/2)
-print(aspect.shape, test_x, test_y)
-print('Theta = {} rad ({} Grad) of pixel {},{}'.format(theta[test_x][test_y], 90 - incidence[test_x][test_y], test_x, test_y))
+print('Theta = {} rad ({} Grad) of pixel {},{}'.format(theta[0][0], 90 - incidence[0][0], test_x, test_y))
 
 conv_aspect = np.mod(aspect - 90, 360)
 omega = np.radians(conv_aspect)
-print('Omega = {} rad ({} Grad) of pixel {},{}'.format(omega[test_x][1], conv_aspect[test_x][test_y], test_x, test_y))
+print('Omega = {} rad ({} Grad) of pixel {},{}'.format(omega[0][0], conv_aspect[0][0], test_x, test_y))
 
-# construct G matrix
-
-# need to generate G for each pixel individually
-
-#G = construct_G(i, j, phi, heading_rad, theta, omega)
+# G is generated for each pixel individually when the tiles are inverted
 print('G for pixel {},{}'.format(test_x, test_y))
-G = construct_G(test_x, test_y, phi, heading_rad, theta, omega)
+G = construct_G(0, 0, phi, heading_rad, theta, omega)
 print(G)
 
 
 ## 1: Apply inversion to all images of cube
 
-# get the final size of cube to avoid a lot of conditions
-nlines_final = nlines_crop if crop else nlines
-ncols_final = ncols_crop if crop else ncols
-print(nlines_final, ncols_final)
-img_data_final = (nlines_final, ncols_final, n_img)
-
-uslope_cube = np.zeros((nlines_final, ncols_final, n_img))
-uz_cube = np.zeros((nlines_final, ncols_final, n_img))
-
-for l in range(n_img):
-    print('Start inverting map {}/{}'.format(l, n_img-1))
-    range_map = range_maps[:,:,l].reshape((nlines_final,ncols_final))
-    azimuth_map = azimuth_maps[:,:,l].reshape((nlines_final,ncols_final))
-
-    # return the map of uslope and uz als tuple
-    invert_results = invert_single_map(range_map, azimuth_map, phi, heading_rad, theta, omega)
-    
-    uslope_map, uz_map = invert_results[0], invert_results[1]
-
-    uslope_cube[:,:,l] = uslope_map
-    uz_cube[:,:,l] = uz_map
-
-## 2: Save the inverted cubes as file
-
 # save projected maps to cube + hdr file
 # for slope direction (u_slope) and vertical (u_z)
 
@@ -561,9 +628,46 @@ else:
     uslope_filename = 'depl_cumule_uslope_{}'.format(ext)
     uz_filename = 'depl_cumule_uz_{}'.format(ext)
 
-save_cube(dest_path, uslope_filename, uslope_cube)
-save_cube_metadata(dest_path, uslope_filename, img_data_final)
+cond_filename = uslope_filename.replace('depl_cumule_uslope', 'G_cond')
+
+# preallocate the output cubes, the tiles are written directly in the files and the cubes are never completely in memory
+uslope_writer = CubeWriter(dest_path, uslope_filename, nlines_final, ncols_final, n_img)
+uz_writer = CubeWriter(dest_path, uz_filename, nlines_final, ncols_final, n_img)
+cond_writer = CubeWriter(dest_path, cond_filename, nlines_final, ncols_final, 1)
+
+params = {'range_cube': range_cube_file, 'azimuth_cube': azimuth_cube_file, 'inc': incidence_file, 'aspect': aspect_file,
+          'img_data': img_data, 'offset': offset, 'out_dim': (nlines_final, ncols_final),
+          'phi': phi, 'heading_rad': heading_rad, 'max_cond': max_cond, 'geometry': geometry_file,
+          'dest': dest_path, 'uslope': uslope_filename, 'uz': uz_filename, 'cond': cond_filename}
+
+# the geometry does not depend on the cubes, compute it once and reuse it
+if(geometry_file):
+    geometry_metadata = get_geometry_metadata(heading, incidence_file, aspect_file, nlines, ncols)
+    if(check_geometry_file(geometry_file, geometry_metadata)):
+        print('Use existing geometry file {}'.format(geometry_file))
+    else:
+        save_geometry_file(geometry_file, geometry_metadata, params, tile_size)
+
+tiles = get_tiles(nlines_final, ncols_final, tile_size)
+print('Invert {} tiles of {}x{} pixel with {} job(s)'.format(len(tiles), tile_size, tile_size, jobs))
+
+n_masked = 0
+if(jobs > 1):
+    # fork: the script has no main guard
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(invert_tile, params, tile) for tile in tiles]
+        for k, future in enumerate(futures):
+            n_masked += future.result()
+            print('Tile {}/{} done'.format(k + 1, len(tiles)))
+else:
+    for k, tile in enumerate(tiles):
+        n_masked += invert_tile(params, tile)
+        print('Tile {}/{} done'.format(k + 1, len(tiles)))
+
+print('{} pixel with singular or ill-conditioned G are set to NaN'.format(n_masked))
 
-save_cube(dest_path, uz_filename, uz_cube)
-save_cube_metadata(dest_path, uz_filename, img_data_final)
+## 2: Save the metadata of the inverted cubes and the condition number of G
 
+uslope_writer.close()
+uz_writer.close()
+cond_writer.close()
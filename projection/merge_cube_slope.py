@@ -28,7 +28,6 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
 import pandas as pd
 from pathlib import Path
@@ -37,27 +36,12 @@ from dateutil import parser
 import docopt
 from matplotlib import pyplot as plt
 from scipy.interpolate import interp1d
+from aspsar.cube import Cube, CubeWriter
 
 #############
 # FUCNTIONS #
 #############
 
-def read_cube(cube_file, ncol, nlines, n_img):
-
-    print('Start reading cube file')
-
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
-
-    print('Finished reading cube file')
-
-    return maps
-
 def get_img_dim(data_path):
     #ds = gdal.Open(os.path.join(data_path, 'depl_cumule_slope'))
     ds = gdal.Open(data_path)
@@ -66,33 +50,6 @@ def get_img_dim(data_path):
     
     return (ncol, nlines, n_img)
 
-def save_cube(dest_path, out_filename, maps):
-    print('Writing cube')
-
-    fid = open(os.path.join(dest_path, out_filename), 'wb')
-    maps[:,:,:].flatten().astype('float32').tofile(fid)
-    fid.close()
-
-
-def save_cube_metadata(dest_path, out_filename, img_data):
-    nrow, ncol, nimg = img_data[0], img_data[1], img_data[2]
-
-    # be careful here with ncol, nrow (normal: lines=nrow; samples=ncol)
-    with open(os.path.join(dest_path, '{}.hdr'.format(out_filename)), 'w') as hdr_file:
-        hdr_file.write("ENVI\n")
-        hdr_file.write("samples = {}\n".format(ncol))
-        hdr_file.write("lines = {}\n".format(nrow))
-        hdr_file.write("bands = {}\n".format(nimg))
-        hdr_file.write("header offset = 0\n")
-        hdr_file.write("file type = ENVI Standard\n")
-        hdr_file.write("data type = 4\n")  # 4 represents float32, adjust if needed
-
-    # save also .in file to plot pixel
-    with open(os.path.join(dest_path, 'lect_{}.in'.format(out_filename)), 'w') as lect_file:
-        lect_file.write('\t{}\t{}\t{}'.format(ncol, nrow, nimg))
-
-
-
 ########
 # MAIN #
 ########
@@ -161,39 +118,24 @@ for i, num in enumerate(dates1):
 # then take second time series and add offset map
 # combine
 
-cube1 = read_cube(cube_file1, img_dim1[0], img_dim1[1], img_dim1[2])
-cube2 = read_cube(cube_file2, img_dim2[0], img_dim2[1], img_dim2[2])
+cube1 = Cube(cube_file1, img_dim1[0], img_dim1[1], img_dim1[2])
+cube2 = Cube(cube_file2, img_dim2[0], img_dim2[1], img_dim2[2])
 
 # get maps to interpolate between to get offset value for second time series
 
-cube1_smaller_map = cube1[:,:,first_smaller_index]
-cube1_higher_map = cube1[:,:,first_higher_index]
+cube1_smaller_map = cube1.band(first_smaller_index)
+cube1_higher_map = cube1.band(first_higher_index)
 
 interp_function = interp1d([dates1[first_smaller_index], dates1[first_higher_index]], [cube1_smaller_map, cube1_higher_map], axis=0, kind='linear', fill_value='extrapolate')
 
 offset_map = interp_function(start_dates2)
 
-# add offset to all dates2 maps
-
-cube2_with_offset = np.zeros((nlines2, ncol2, n_img2))
-
-# for sorting the combined array, set pixel [0,0] of each map to the corresponding date_dec
-for l in range(n_img2):
-    
-    cube2_with_offset[:,:,l] = cube2[:,:,l] + offset_map
-    cube2_with_offset[0,0,l] = float(dates2[l])
-
-for k in range(n_img1):
-    cube1[0,0,k] = float(dates1[k])
-
-
-combined_cubes = np.concatenate((cube1, cube2_with_offset), axis=2)
-
-# sort based on the first pixel - should work as well without the reference pixel (apply same sort to list_dates files with the same indices)
+# sort the combined maps by date, pixel [0,0] of each map is set to the corresponding date_dec
+# should work as well without the reference pixel (apply same sort to list_dates files with the same indices)
 # can be changed, but keep it like that now until it is a problem
-sort_values = combined_cubes[0,0,:]
+# (dates1 as float32 like the maps of cube1)
+sort_values = np.concatenate((np.array(dates1, dtype=np.float32), np.array(dates2, dtype=np.float64)))
 sorted_indices = np.argsort(sort_values)
-sorted_cubes = combined_cubes[:,:,sorted_indices]
 
 
 # adjust at one point
@@ -204,12 +146,18 @@ else:
     ext = 'slope'
 
 if(arguments['--direction']):
-    save_cube(dest_path, '{}_depl_cumule_{}_{}_PAZ_TSX'.format(name, direction, ext), sorted_cubes)
-
-    save_cube_metadata(dest_path, '{}_depl_cumule_{}_{}_PAZ_TSX'.format(name, direction, ext), sorted_cubes.shape)
+    out_filename = '{}_depl_cumule_{}_{}_PAZ_TSX'.format(name, direction, ext)
 else:
-    save_cube(dest_path, '{}_depl_cumule_{}_PAZ_TSX'.format(name, ext), sorted_cubes)
-
-    save_cube_metadata(dest_path, '{}_depl_cumule_{}_PAZ_TSX'.format(name, ext), sorted_cubes.shape)
-
-
+    out_filename = '{}_depl_cumule_{}_PAZ_TSX'.format(name, ext)
+
+# write the sorted maps one after the other, only one map of each cube is in memory
+with CubeWriter(dest_path, out_filename, nlines1, ncol1, n_img1 + n_img2) as writer:
+    for l, k in enumerate(sorted_indices):
+        if(k < n_img1):
+            single_map = cube1.band(k)
+            single_map[0,0] = float(dates1[k])
+        else:
+            # add offset to the dates2 maps
+            single_map = cube2.band(k - n_img1) + offset_map
+            single_map[0,0] = float(dates2[k - n_img1])
+        writer.write_band(l, single_map)
@@ -7,12 +7,18 @@ DATA_DIR=$1
 CORREL_DIR=$2
 DATE1=$3
 DATE2=$4
+# optional: number of threads, overwrites THREADS of asp_parameters.txt (set by process_stereo.py --jobs)
+JOB_THREADS=$5
 # name of directory for pair processing results f.e. 20220717_20221104
 PAIR=$DATE1"_"$DATE2
 
 # load asp_parameters.txt in DATA_DIR (DATA_DIR = WORK_DIR)
 . $DATA_DIR"/asp_parameters.txt"
 
+if [ -n "$JOB_THREADS" ]; then
+    THREADS=$JOB_THREADS
+fi
+
 IMG_PRE=$DATA_DIR"/GEOTIFF/"$3".VV.mod_log.tif"
 IMG_POST=$DATA_DIR"/GEOTIFF/"$4".VV.mod_log.tif"
 
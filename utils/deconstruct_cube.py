@@ -24,13 +24,13 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
 import pandas as pd
 from pathlib import Path
 import shutil
 from dateutil import parser
 import docopt
+from aspsar.cube import Cube
 
 
 #############
@@ -47,23 +47,6 @@ def save_to_file(data, output_path, ncol, nrow, proj, geotransform):
 
     dst_band.WriteArray(data)
 
-def read_cube(cube_file, ncol, nlines, n_img):
-
-    print('Start reading cube file')
-
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
-
-    print('Finished reading cube file')
-
-    return maps
-
-
 
 ########
 # MAIN #
@@ -95,12 +78,12 @@ else:
     proj = ds.GetProjection()
     geotransform = ds.GetGeoTransform()
 
-maps = read_cube(cube_file, ncols, nlines, n_img)
+cube = Cube(cube_file, ncols, nlines, n_img)
 
 # add later option to save all files
 for l in range(n_img):
     if(l == dest_img-1):
-        curr_map = maps[:,:,l].reshape((nlines, ncols))
+        curr_map = cube.band(l)
 
 
         print('Save image {} of {} total images in cube'.format(n_img, n_img))
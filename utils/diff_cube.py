@@ -24,11 +24,11 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 import pandas as pd
 from osgeo import gdal
 import shutil
 import docopt
+from aspsar.cube import Cube
 
 
 #############
@@ -45,22 +45,6 @@ def save_to_file(data, output_path, ncol, nrow, proj, geotransform):
 
     dst_band.WriteArray(data)
 
-def read_cube(cube_file, ncol, nlines, n_img):
-
-    print('Start reading cube file')
-
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
-
-    print('Finished reading cube file')
-
-    return maps
-
 
 ########
 # MAIN #
@@ -93,7 +77,7 @@ ds_ref = gdal.Open(ref_file)
 proj = ds_ref.GetProjection()
 geotransform = ds_ref.GetGeoTransform()
 
-maps = read_cube(cube_file, ncols, nlines, n_img)
+cube = Cube(cube_file, ncols, nlines, n_img)
 
 list_images = pd.read_csv(list_images_file, sep='\s+', header=None)
 
@@ -104,8 +88,8 @@ with open(diff_file) as file:
 
         date1_index = list_images.index[list_images[1] == int(date1)].tolist()
         date2_index = list_images.index[list_images[1] == int(date2)].tolist()
-        # squeeze to remove the single dimension (nlines,ncols,1) to (nlines,ncols) 
-        diff_map = np.squeeze(maps[:,:,date2_index] - maps[:,:,date1_index])
+        # only read the two maps of the pair from the cube
+        diff_map = cube.band(date2_index[0]) - cube.band(date1_index[0])
         
         diff_file = os.path.join(dest_path, '{}_{}-{}.tif'.format(cube_name, date1, date2))
         print(diff_map.shape) 
@@ -4,14 +4,23 @@
 mask_result_export_cc.py
 -------------
 Mask the adjusted correlation results in EXPORT/ADJUSTED based on their corresponding correlation coefficient map in EXPORT/CC and save them in MASKED/CC
+CC is read once per pair and H and V are masked together, window by window.
+With --virtual only the mask is saved (packed bits, EXPORT/MASKS/<name>/<pair>.npz) and applied on read by prepare_result_export.py,
+prepare_nsbas_process.py and mask_cube_binary.py, no masked copies of the maps are written.
 
-Usage: mask_result_export_cc.py [--f] --data=<path>
+Usage: mask_result_export_cc.py [--f] --data=<path> [--min_cc=<value>] [--max_cc=<value>] [--dilate=<value>] [--jobs=<value>] [--block=<value>] [--virtual=<name>]
 mask_result_export_cc.py -h | --help
 
 Options:
 -h | --help         Show this screen
 --data              Path to EXPORT directory
 --f                 Force recomputation of EXPORT directory
+--min_cc            Keep pixels with CC >= min_cc [default: keep only CC == 1]
+--max_cc            Keep pixels with CC <= max_cc
+--dilate            Extend the masked regions by this number of pixels [default: 0]
+--jobs              Number of pairs masked in parallel [default: 1]
+--block             Number of lines read at once [default: 512]
+--virtual           Save only the masks in EXPORT/MASKS/<name> instead of the masked maps in EXPORT/MASKED
 
 """
 ##########
@@ -25,43 +34,89 @@ import pandas as pd
 from pathlib import Path
 import shutil
 import docopt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+from aspsar.masks import get_mask_dir, get_mask_file, pack_rows, save_mask_bits
 
 #############
 # FUNCTIONS #
 #############
 
-def read_from_file(input_file, n_band):
+def get_bad_mask(cc, min_cc=None, max_cc=None, dilate=0):
+    # True where the pixel is masked, without thresholds only CC == 1 is kept
+    if(min_cc is None and max_cc is None):
+        good = (cc == 1)
+    else:
+        good = np.isfinite(cc)
+        if(min_cc is not None):
+            good &= (cc >= min_cc)
+        if(max_cc is not None):
+            good &= (cc <= max_cc)
 
-    ds = gdal.OpenEx(input_file, allowed_drivers=['GTiff'])
-    ds_band = ds.GetRasterBand(n_band)
-    raw_disparity = ds_band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-    ncol, nrow = ds.RasterXSize, ds.RasterYSize
-    # return (raw_disparity, ncol, nrow) XSize=col YSize=row
-    return (raw_disparity, ncol, nrow)
+    bad = ~good
+    if(dilate > 0):
+        bad = ndimage.binary_dilation(bad, structure=np.ones((2*dilate + 1, 2*dilate + 1), dtype=bool))
 
-def save_to_file(data, output_path, ncol, nrow):
-    drv = gdal.GetDriverByName('GTiff')
-    dst_ds = drv.Create(output_path, ncol, nrow, 1, gdal.GDT_Float32)
-    dst_band = dst_ds.GetRasterBand(1)
-    dst_band.WriteArray(data)
-
-# path to current pair cc file, adjusted input file, destination dir (EXPORT/MASKED),
-def mask_origin_with_cc(cc_curr_pair, origin_file, destination_dir):
-    cc_data = read_from_file(cc_curr_pair, 1)
-    cc, ncol, nrow = cc_data[0], cc_data[1], cc_data[2]
+    return bad
 
-    origin_data = read_from_file(origin_file, 1)
-    origin = origin_data[0]
+def create_output_file(output_path, ncol, nrow):
+    drv = gdal.GetDriverByName('GTiff')
+    return drv.Create(output_path, ncol, nrow, 1, gdal.GDT_Float32)
+
+# path to current pair cc file, adjusted input files (H, V), destination dir (EXPORT/MASKED)
+# mask_file: also save the mask as packed bits (virtual mask), origin_files can be empty then
+def mask_origin_with_cc(cc_curr_pair, origin_files, destination_dir, min_cc=None, max_cc=None, dilate=0, block_rows=512, mask_file=None):
+    cc_ds = gdal.OpenEx(cc_curr_pair, allowed_drivers=['GTiff'])
+    ncol, nrow = cc_ds.RasterXSize, cc_ds.RasterYSize
+    cc_band = cc_ds.GetRasterBand(1)
+
+    origin_bands, out_ds = [], []
+    for origin_file in origin_files:
+        origin_ds = gdal.OpenEx(origin_file, allowed_drivers=['GTiff'])
+        origin_bands.append((origin_ds, origin_ds.GetRasterBand(1)))
+
+        output_path = os.path.join(destination_dir, '{}_MASK.tif'.format(os.path.basename(origin_file).split('.')[0]))
+        dst_ds = create_output_file(output_path, ncol, nrow)
+        dst_ds.SetMetadata({'MIN_CC': str(min_cc), 'MAX_CC': str(max_cc), 'DILATE': str(dilate)})
+        out_ds.append(dst_ds)
+
+    bits = []
+    for y in range(0, nrow, block_rows):
+        rows = min(block_rows, nrow - y)
+
+        # read CC with a halo of dilate lines, the dilation needs the neighbouring lines
+        y0, y1 = max(0, y - dilate), min(nrow, y + rows + dilate)
+        cc = cc_band.ReadAsArray(0, y0, ncol, y1 - y0)
+        bad = get_bad_mask(cc, min_cc, max_cc, dilate)[y - y0:y - y0 + rows]
+        if(mask_file):
+            bits.append(pack_rows(bad))
+
+        # check if mask is true, if true - set to NaN, else keep origin value (float32)
+        for (origin_ds, origin_band), dst_ds in zip(origin_bands, out_ds):
+            origin = origin_band.ReadAsArray(0, y, ncol, rows)
+            dst_ds.GetRasterBand(1).WriteArray(np.where(bad, np.float32(np.nan), origin.astype(np.float32)), 0, y)
+
+    for dst_ds in out_ds:
+        dst_ds.FlushCache()
+
+    if(mask_file):
+        save_mask_bits(mask_file, np.concatenate(bits), (nrow, ncol), {'MIN_CC': min_cc, 'MAX_CC': max_cc, 'DILATE': dilate})
+
+def mask_pair(i, n_pairs, f, adj_dir, cc_dir, masked_dir, min_cc, max_cc, dilate, block_rows, virtual=None):
+    curr_pair = '{}_{}'.format(f.split('_')[0], f.split('_')[1])
+    print('Start masking pair({}/{}): {}'.format(i+1, n_pairs, curr_pair))
 
-    # prepare array to mask, keep values == 1
-    mask_array = np.where(cc == 1, True, False)
-    
-    # check if mask is true, if true - keep origin value, else set to NaN
-    origin_masked = np.where(mask_array, origin, np.nan)
+    h_origin = os.path.join(adj_dir, '{}-F-H_wm.tif'.format(curr_pair))
+    v_origin = os.path.join(adj_dir, '{}-F-V_wm.tif'.format(curr_pair))
+    cc_curr_pair = os.path.join(cc_dir, f)
 
-    output_path = os.path.join(destination_dir, '{}_MASK.tif'.format(os.path.basename(origin_file).split('.')[0]))
-    
-    save_to_file(origin_masked, output_path, ncol, nrow)
+    if(virtual):
+        # only the mask, the maps are masked when they are read
+        mask_file = get_mask_file(os.path.dirname(adj_dir), virtual, curr_pair)
+        mask_origin_with_cc(cc_curr_pair, [], masked_dir, min_cc, max_cc, dilate, block_rows, mask_file)
+    else:
+        mask_origin_with_cc(cc_curr_pair, [h_origin, v_origin], masked_dir, min_cc, max_cc, dilate, block_rows)
 
 ########
 # MAIN #
@@ -75,26 +130,49 @@ export_dir = arguments['--data']
 adj_dir = os.path.join(export_dir, 'ADJUSTED')
 cc_dir = os.path.join(export_dir, 'CC')
 
-masked_dir = os.path.join(export_dir, 'MASKED')
-Path(masked_dir).mkdir(parents=True, exist_ok=True)
-
-
-for i, f in enumerate(os.listdir(cc_dir)):
-    curr_pair = '{}_{}'.format(f.split('_')[0], f.split('_')[1])
-    print('Start masking pair({}/{}): {}'.format(i+1, len(os.listdir(cc_dir)), curr_pair))
-
-    h_origin = os.path.join(adj_dir, '{}-F-H_wm.tif'.format(curr_pair))
-    v_origin = os.path.join(adj_dir, '{}-F-V_wm.tif'.format(curr_pair))
-    cc_curr_pair = os.path.join(cc_dir, f)
-    
-    
-    mask_origin_with_cc(cc_curr_pair, h_origin, masked_dir)
-    mask_origin_with_cc(cc_curr_pair, v_origin, masked_dir)
-    
-
-
-
-
+virtual = arguments['--virtual']
 
+if(virtual):
+    masked_dir = get_mask_dir(export_dir, virtual)
+else:
+    masked_dir = os.path.join(export_dir, 'MASKED')
+Path(masked_dir).mkdir(parents=True, exist_ok=True)
 
 
+if(arguments['--min_cc']):
+    min_cc = float(arguments['--min_cc'])
+else:
+    min_cc = None
+
+if(arguments['--max_cc']):
+    max_cc = float(arguments['--max_cc'])
+else:
+    max_cc = None
+
+if(arguments['--dilate']):
+    dilate = int(arguments['--dilate'])
+else:
+    dilate = 0
+
+if(arguments['--jobs']):
+    jobs = int(arguments['--jobs'])
+else:
+    jobs = 1
+
+if(arguments['--block']):
+    block_rows = int(arguments['--block'])
+else:
+    block_rows = 512
+
+cc_files = sorted([f for f in os.listdir(cc_dir) if f.endswith('_CC.tif')])
+args_list = [(i, len(cc_files), f, adj_dir, cc_dir, masked_dir, min_cc, max_cc, dilate, block_rows, virtual) for i, f in enumerate(cc_files)]
+
+if(jobs > 1):
+    # fork: the script has no main guard
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(mask_pair, *args) for args in args_list]
+        for future in futures:
+            future.result()
+else:
+    for args in args_list:
+        mask_pair(*args)
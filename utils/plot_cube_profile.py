@@ -30,7 +30,6 @@ Options:
 
 import os, sys
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
 from pathlib import Path
 import docopt
@@ -39,6 +38,7 @@ import matplotlib.cm as cm
 import matplotlib.colors as mcolors
 import matplotlib.gridspec as gridspec
 import pandas as pd
+from aspsar.cube import Cube
 
 #############
 # FUNCTIONS #
@@ -51,31 +51,6 @@ def read_tif(input_file):
 
     return values
 
-def get_cube_dimension(cube_file):
-    ds = gdal.Open(cube_file)
-    ncols, nlines = ds.RasterXSize, ds.RasterYSize
-    n_img = ds.RasterCount
-    
-    img_data = (nlines, ncols, n_img)
-
-    return img_data
-
-def read_cube(cube_file, ncol, nlines, n_img):
-
-    print('Start reading cube file')
-
-    cubei = np.fromfile(cube_file,dtype=np.float32)
-    cube = as_strided(cubei[:nlines*ncol*n_img])
-
-    kk = np.flatnonzero(np.logical_or(cube==9990, cube==9999))
-    cube[kk] = float('NaN')
-    maps_temp = as_strided(cube.reshape((nlines,ncol,n_img)))
-    maps = np.copy(maps_temp)
-
-    print('Finished reading cube file')
-
-    return maps
-
 def prepare_arrows(plot_map, lstart, lend, angles, amplitudes):
     xmin = min(lstart[0], lend[0])
     xmax = max(lstart[0], lend[0])
@@ -144,11 +119,10 @@ if(arguments['--cbarmarks']):
 else:
     mark_dates = None
 
-cube_dim = get_cube_dimension(cube_file)
-nlines, ncols, n_img = cube_dim
-
-# read cube
-maps = read_cube(cube_file, ncols, nlines, n_img)
+# open cube, maps are read when they are plotted
+cube = Cube(cube_file)
+nlines, ncols, n_img = cube.shape
+last_map = cube.band(n_img-1)
 
 # read dates to get date values
 
@@ -177,8 +151,8 @@ cols = np.linspace(lstart[0], lend[0], num_steps).astype(int)
 
 # plot last map of cube for reference
 # masked map based of values outside 1st-99th percentile
-p1, p2 = np.nanpercentile(maps[:,:,n_img-1], 1), np.nanpercentile(maps[:,:,n_img-1], 99)
-map_plot = np.ma.masked_outside(maps[:,:,n_img-1], p1, p2) 
+p1, p2 = np.nanpercentile(last_map, 1), np.nanpercentile(last_map, 99)
+map_plot = np.ma.masked_outside(last_map, p1, p2) 
 
 # adjust to plot the profile according to the crop
 if(arguments['--crop']):
@@ -213,7 +187,7 @@ if(arguments['--aspect']):
 cmap = cm.Spectral 
 norm = mcolors.Normalize(vmin=0, vmax=n_img - 1)
 
-last_map_profile = maps[rows,cols,n_img-1]
+last_map_profile = last_map[rows,cols]
 mask_indices = np.where((last_map_profile > p2) | (last_map_profile < p1))[0]
 
 # take mean values of given window around each pixel of the profile
@@ -229,7 +203,7 @@ else:
 
 # plot profile lines
 for i in range(n_img):
-    img_slice = maps[:,:,i]
+    img_slice = cube.band(i)
     # get pixel along the line
     profile = img_slice[rows,cols]
 